@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# alarms of the batteries, which are aggregated to the alarms of the virtual battery
+ALARM_PATHS = (
+    "/Alarms/LowVoltage",
+    "/Alarms/HighVoltage",
+    "/Alarms/LowCellVoltage",
+    "/Alarms/HighCellVoltage",
+    "/Alarms/LowSoc",
+    "/Alarms/HighChargeCurrent",
+    "/Alarms/HighDischargeCurrent",
+    "/Alarms/CellImbalance",
+    "/Alarms/InternalFailure",
+    "/Alarms/HighChargeTemperature",
+    "/Alarms/LowChargeTemperature",
+    "/Alarms/HighTemperature",
+    "/Alarms/LowTemperature",
+    "/Alarms/BmsCable",
+)
+
+# alarm levels: 0 = ok, 1 = warning, 2 = alarm
+MAX_LEVEL = 2
+# value of an alarm, which the battery does not publish
+MISSING = MAX_LEVEL + 1
+
+
+class AlarmMatrix:
+    """
+    Alarms of the aggregated batteries as matrix of batteries x alarm types, packed into a bytearray.
+
+    The matrix and the number of batteries at each level of each alarm are updated when an alarm changes,
+    so the max. level of an alarm and the batteries, which raised it, are known without reading all values.
+    """
+
+    def __init__(self, dbusMon):
+        """
+        :param dbusMon: DbusMon instance, which monitors the batteries
+        """
+        self._dbusMon = dbusMon
+        self._column = {path: column for column, path in enumerate(ALARM_PATHS)}
+        self._width = len(ALARM_PATHS)
+        # {service: row}
+        self._rows = {}
+        # row: service, None for a free row
+        self._services = []
+        self._matrix = bytearray()
+        # per alarm: number of batteries at level 0, 1, 2 and without value
+        self._counts = [[0] * (MISSING + 1) for _ in ALARM_PATHS]
+        # per alarm: {service: level} of the batteries with level > 0
+        self._raised = [{} for _ in ALARM_PATHS]
+        for path in ALARM_PATHS:
+            dbusMon.add_value_listener(path, self._value_changed)
+
+    def __contains__(self, service):
+        return service in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    @staticmethod
+    def _level(value) -> int:
+        if value is None:
+            return MISSING
+        return min(max(int(value), 0), MAX_LEVEL)
+
+    def _set(self, row, column, level):
+        index = row * self._width + column
+        old = self._matrix[index]
+        if old == level:
+            return
+        self._matrix[index] = level
+        counts = self._counts[column]
+        counts[old] -= 1
+        counts[level] += 1
+        raised = self._raised[column]
+        service = self._services[row]
+        if 0 < level <= MAX_LEVEL:
+            raised[service] = level
+        else:
+            raised.pop(service, None)
+
+    def add(self, service):
+        """
+        Add a battery and read all of its alarms.
+        """
+        if service in self._rows:
+            return
+        try:
+            row = self._services.index(None)
+            self._services[row] = service
+        except ValueError:
+            row = len(self._services)
+            self._services.append(service)
+            self._matrix.extend([MISSING] * self._width)
+        self._rows[service] = row
+        for column in range(self._width):
+            # a new row is counted as missing, until its value is read
+            self._matrix[row * self._width + column] = MISSING
+            self._counts[column][MISSING] += 1
+        self.refresh(service)
+
+    def remove(self, service):
+        row = self._rows.pop(service)
+        for column in range(self._width):
+            self._set(row, column, MISSING)
+            self._counts[column][MISSING] -= 1
+        self._services[row] = None
+
+    def select(self, services):
+        """
+        Use the alarms of these batteries only, i.e. the batteries in the aggregation.
+
+        :param services: dbus services of the batteries
+        """
+        services = set(services)
+        for service in [service for service in self._rows if service not in services]:
+            self.remove(service)
+        for service in services:
+            self.add(service)
+
+    def refresh(self, service):
+        """
+        Read all alarms of the battery again.
+        """
+        row = self._rows[service]
+        dbusmon = self._dbusMon.dbusmon
+        for path, column in self._column.items():
+            self._set(row, column, self._level(dbusmon.get_value(service, path)))
+
+    def _value_changed(self, service_name, path, value):
+        row = self._rows.get(service_name)
+        if row is not None:
+            self._set(row, self._column[path], self._level(value))
+
+    def maximum(self, path):
+        """
+        :param path: path of the alarm, one of ALARM_PATHS
+        :return: highest level of the alarm of all batteries, which publish it, None if no battery publishes it
+        """
+        counts = self._counts[self._column[path]]
+        for level in range(MAX_LEVEL, -1, -1):
+            if counts[level]:
+                return level
+        return None
+
+    def raised_by(self, path) -> dict:
+        """
+        :param path: path of the alarm, one of ALARM_PATHS
+        :return: {service: level} of the batteries, which raised the alarm
+        """
+        return dict(self._raised[self._column[path]])
+
+    def missing(self, path) -> int:
+        """
+        :return: number of batteries, which do not publish the alarm
+        """
+        return self._counts[self._column[path]][MISSING]
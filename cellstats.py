@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import heapq
+import math
+import time
+from array import array
+
+# statistics of each cell, saved across restarts
+FIELDS = ("seconds", "mean", "m2", "ewma", "timeAbove", "timeBelow")
+
+
+class CellStatistics:
+    """
+    Streaming statistics of the cell voltages of the aggregated batteries to follow the drift of the cells.
+
+    Per cell the mean and variance (Welford), an EWMA over time and the seconds above and below the cell voltage limits
+    are accumulated in fixed-size arrays with one row of cells per battery. Each sample costs O(1), the summary
+    of the drift of the cells is calculated at a low rate only.
+
+    The devices send a value only on change, so each voltage is weighted with the time it was held until the next
+    change, i.e. a cell sitting flat for hours does not count less than a noisy cell.
+    """
+
+    def __init__(self, dbusMon, cells, time_constant, low, high):
+        """
+        :param dbusMon: DbusMon instance, which monitors the batteries
+        :param cells: number of cells per battery
+        :param time_constant: time constant of the EWMA in seconds
+        :param low: cell voltage, below which the time is counted
+        :param high: cell voltage, above which the time is counted
+        """
+        self._dbusMon = dbusMon
+        self._cells = cells
+        self._timeConstant = time_constant
+        # limits of the cell voltage, changed on reload of the settings
+        self.low = low
+        self.high = high
+        self._paths = {"/Voltages/Cell%d" % (cell + 1): cell for cell in range(cells)}
+        # {service: row}
+        self._rows = {}
+        # row: battery name, None for a free row
+        self._names = []
+        # seconds of the mean and variance
+        self._seconds = array("d")
+        self._mean = array("d")
+        self._m2 = array("d")
+        self._ewma = array("d")
+        self._timeAbove = array("d")
+        self._timeBelow = array("d")
+        # monotonic time and voltage of the last sample, time 0 if there is none
+        self._time = array("d")
+        self._voltage = array("d")
+        # per row: spread of the EWMAs, its trend in V/day and the monotonic time of the last summary
+        self._spread = array("d")
+        self._trend = array("d")
+        self._summaryTime = array("d")
+        # {battery name: saved statistics}, applied when the battery is added
+        self._saved = {}
+        for path in self._paths:
+            dbusMon.add_value_listener(path, self._value_changed)
+
+    def __contains__(self, service):
+        return service in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _columns(self):
+        return (self._seconds, self._mean, self._m2, self._ewma, self._timeAbove, self._timeBelow, self._time, self._voltage)
+
+    def add(self, name, service):
+        """
+        Add a battery and restore its saved statistics, if any.
+
+        :param name: name of the battery, the statistics are saved with it
+        :param service: dbus service of the battery
+        """
+        if service in self._rows:
+            return
+        try:
+            row = self._names.index(None)
+            self._names[row] = name
+        except ValueError:
+            row = len(self._names)
+            self._names.append(name)
+            for column in self._columns():
+                column.extend([0.0] * self._cells)
+            self._spread.append(0.0)
+            self._trend.append(0.0)
+            self._summaryTime.append(0.0)
+        self._rows[service] = row
+
+        start = row * self._cells
+        for column in self._columns():
+            column[start : start + self._cells] = array("d", [0.0] * self._cells)
+        self._spread[row] = self._trend[row] = self._summaryTime[row] = 0.0
+        saved = self._saved.pop(name, None)
+        if saved is not None and len(saved["cells"]) == self._cells:
+            for cell, values in enumerate(saved["cells"]):
+                for column, value in zip(self._columns(), values):
+                    column[start + cell] = value
+            self._spread[row] = saved["spread"]
+            self._trend[row] = saved["trend"]
+        self.refresh(service)
+
+    def remove(self, service):
+        row = self._rows.pop(service)
+        # the statistics are kept, if the battery comes back
+        self._saved[self._names[row]] = self._battery_state(row)
+        self._names[row] = None
+
+    def select(self, batteries):
+        """
+        Use the cells of these batteries only, i.e. the batteries in the aggregation.
+
+        :param batteries: {name: dbus service} of the batteries
+        """
+        services = set(batteries.values())
+        for service in [service for service in self._rows if service not in services]:
+            self.remove(service)
+        for name, service in batteries.items():
+            self.add(name, service)
+
+    def refresh(self, service):
+        """
+        Sample all cell voltages of the battery.
+        """
+        row = self._rows[service]
+        now = time.monotonic()
+        dbusmon = self._dbusMon.dbusmon
+        for path, cell in self._paths.items():
+            self._sample(row * self._cells + cell, dbusmon.get_value(service, path), now)
+
+    def _value_changed(self, service_name, path, value):
+        row = self._rows.get(service_name)
+        if row is not None:
+            self._sample(row * self._cells + self._paths[path], value, time.monotonic())
+
+    def _sample(self, index, voltage, now):
+        if voltage is None:
+            # the time without values is not counted
+            self._time[index] = 0.0
+            return
+
+        last_time = self._time[index]
+        if last_time > 0:
+            dt = now - last_time
+            last_voltage = self._voltage[index]
+            if last_voltage > self.high:
+                self._timeAbove[index] += dt
+            elif last_voltage < self.low:
+                self._timeBelow[index] += dt
+            self._ewma[index] += (1 - math.exp(-dt / self._timeConstant)) * (voltage - self._ewma[index])
+            # Welford's algorithm weighted with the time, the last voltage was held for dt
+            if dt > 0:
+                seconds = self._seconds[index] + dt
+                delta = last_voltage - self._mean[index]
+                self._mean[index] += delta * dt / seconds
+                self._m2[index] += dt * delta * (last_voltage - self._mean[index])
+                self._seconds[index] = seconds
+        elif self._seconds[index] == 0:
+            self._ewma[index] = voltage
+
+        self._time[index] = now
+        self._voltage[index] = voltage
+
+    def _drifts(self, row):
+        """
+        :return: [(drift, cell), ...] of the cells with values, the drift is the EWMA of the cell minus the mean EWMA of the battery
+        """
+        start = row * self._cells
+        ewmas = [(self._ewma[start + cell], cell) for cell in range(self._cells) if self._seconds[start + cell] > 0 or self._time[start + cell] > 0]
+        if not ewmas:
+            return []
+        mean = math.fsum(ewma for ewma, _ in ewmas) / len(ewmas)
+        return [(ewma - mean, cell) for ewma, cell in ewmas]
+
+    def summary(self, k=5):
+        """
+        Update the spread and its trend of each battery and find the cells drifting most. O(number of cells).
+
+        :param k: number of cells drifting most
+        :return: {"batteries": {name: {"spread", "trend", "timeAbove", "timeBelow"}},
+                  "cells": [(drift, name, cell number, standard deviation over time), ...]} of the k cells drifting most
+        """
+        now = time.monotonic()
+        batteries = {}
+        cells = []
+        for row, name in enumerate(self._names):
+            if name is None:
+                continue
+            drifts = self._drifts(row)
+            if not drifts:
+                continue
+            spread = max(drifts)[0] - min(drifts)[0]
+            if self._summaryTime[row] > 0:
+                dt = now - self._summaryTime[row]
+                slope = (spread - self._spread[row]) / dt * 86400 if dt > 0 else 0.0
+                self._trend[row] += (1 - math.exp(-dt / self._timeConstant)) * (slope - self._trend[row])
+            self._spread[row] = spread
+            self._summaryTime[row] = now
+
+            start = row * self._cells
+            batteries[name] = {
+                "spread": spread,
+                "trend": self._trend[row],
+                "timeAbove": max(self._timeAbove[start : start + self._cells]),
+                "timeBelow": max(self._timeBelow[start : start + self._cells]),
+            }
+            cells.extend((drift, row, cell) for drift, cell in drifts)
+
+        worst = []
+        for drift, row, cell in heapq.nlargest(k, cells, key=lambda entry: abs(entry[0])):
+            index = row * self._cells + cell
+            seconds = self._seconds[index]
+            worst.append((drift, self._names[row], cell + 1, math.sqrt(self._m2[index] / seconds) if seconds > 0 else 0.0))
+        return {"batteries": batteries, "cells": worst}
+
+    def _battery_state(self, row) -> dict:
+        start = row * self._cells
+        columns = self._columns()[: len(FIELDS)]
+        return {
+            "cells": [[column[start + cell] for column in columns] for cell in range(self._cells)],
+            "spread": self._spread[row],
+            "trend": self._trend[row],
+        }
+
+    def state(self) -> dict:
+        """
+        :return: statistics of all batteries by name, serializable to JSON
+        """
+        state = dict(self._saved)
+        for row, name in enumerate(self._names):
+            if name is not None:
+                state[name] = self._battery_state(row)
+        return {"fields": FIELDS, "batteries": state}
+
+    def restore(self, state):
+        """
+        Restore the statistics saved by state(). They are applied when the batteries are added.
+        """
+        if list(state["fields"]) != list(FIELDS):
+            raise ValueError("Fields of the cell statistics changed")
+        self._saved = {name: saved for name, saved in state["batteries"].items() if name not in self._names}
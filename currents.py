@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import math
+import time
+
+
+class CurrentSources:
+    """
+    Registry of the Victron devices measuring the current of the batteries, i.e. MultiPlus/Quattro, MPPTs and SmartShunts.
+
+    The totals are updated when /Dc/0/Current or /Connected of a source changes, so reading them
+    in each cycle does not depend on the number of sources.
+    """
+
+    # role: (total, sign of the current in the total)
+    ROLES = {
+        "Multi/Quattro": ("ve", 1),
+        "MPPT": ("ve", 1),
+        # SmartShunt monitored as a battery
+        "SmartShunt": ("shunts", 1),
+        # SmartShunt in DC metering mode
+        "SmartShunt DC meter": ("shunts", -1),
+    }
+
+    def __init__(self, dbusMon):
+        """
+        :param dbusMon: DbusMon instance, which monitors the sources
+        """
+        self._dbusMon = dbusMon
+        # {service: role}
+        self._roles = {}
+        # {service: signed current counted in its total}
+        self._currents = {}
+        # {service: True, if the Multi/Quattro is connected}
+        self._connected = {}
+        # services without a valid current
+        self._invalid = set()
+        self._totals = {total: 0.0 for total, _ in self.ROLES.values()}
+        dbusMon.add_value_listener("/Dc/0/Current", self._value_changed)
+        dbusMon.add_value_listener("/Connected", self._value_changed)
+        dbusMon.add_device_listener(removed=self._device_removed)
+
+    def __contains__(self, service):
+        return service in self._roles
+
+    def __len__(self):
+        return len(self._roles)
+
+    def clear(self):
+        self._roles.clear()
+        self._currents.clear()
+        self._connected.clear()
+        self._invalid.clear()
+        self._totals = dict.fromkeys(self._totals, 0.0)
+
+    def add(self, service, role):
+        """
+        :param service: dbus service of the source
+        :param role: one of ROLES
+        """
+        if role not in self.ROLES:
+            raise ValueError("Unknown role of current source: %s" % role)
+        self._roles[service] = role
+        self.refresh(service)
+
+    def remove(self, service):
+        """
+        :return: role of the removed source
+        """
+        role = self._roles.pop(service)
+        total, _ = self.ROLES[role]
+        self._currents.pop(service, None)
+        self._connected.pop(service, None)
+        self._invalid.discard(service)
+        # sum again, so no rounding errors of the running total remain
+        self._totals[total] = math.fsum(current for s, current in self._currents.items() if self.ROLES[self._roles[s]][0] == total)
+        return role
+
+    def replace(self, old, new):
+        """
+        Use the same role for a source, which reappeared with another service name.
+        """
+        if old in self._roles:
+            self.add(new, self.remove(old))
+
+    def refresh(self, service):
+        """
+        Read the current of the source again and update its total.
+        """
+        role = self._roles[service]
+        total, sign = self.ROLES[role]
+        dbusmon = self._dbusMon.dbusmon
+        current = dbusmon.get_value(service, "/Dc/0/Current")
+        if role == "Multi/Quattro":
+            # the current of a switched off MultiPlus/Quattro is not counted
+            connected = dbusmon.get_value(service, "/Connected")
+            self._connected[service] = connected is not None and connected > 0
+            if connected is None:
+                current = None
+            elif connected <= 0:
+                current = 0.0
+
+        if current is None:
+            self._invalid.add(service)
+            current = 0.0
+        else:
+            self._invalid.discard(service)
+            current = sign * current
+        self._totals[total] += current - self._currents.get(service, 0.0)
+        self._currents[service] = current
+
+    def _value_changed(self, service_name, path, value):
+        if service_name in self._roles:
+            self.refresh(service_name)
+
+    def _device_removed(self, service_name, device_instance):
+        # the monitor does not know the service anymore, so its current is invalid
+        if service_name in self._roles:
+            self.refresh(service_name)
+
+    def total(self, total):
+        """
+        :param total: "ve" for MultiPlus/Quattro and MPPTs, "shunts" for SmartShunts
+        :return: sum of the signed currents of the sources
+        """
+        return self._totals[total]
+
+    def connected(self, service):
+        """
+        :return: True, if the MultiPlus/Quattro is connected
+        """
+        return self._connected.get(service, False)
+
+    def faults(self, total, max_age=0):
+        """
+        :param total: "ve" for MultiPlus/Quattro and MPPTs, "shunts" for SmartShunts
+        :param max_age: seconds without any value of a source, after which its current is stale, 0 to disable
+        :return: list of (service, reason) of the sources, whose current can not be used
+        """
+        faults = [(service, "returns None as current") for service in self._invalid if self.ROLES[self._roles[service]][0] == total]
+        if max_age > 0:
+            for service, role in self._roles.items():
+                age = self._dbusMon.data_age(service)
+                if self.ROLES[role][0] == total and service not in self._invalid and age is not None and age > max_age:
+                    faults.append((service, "no new values for %d s" % age))
+        return faults
+
+
+class CoulombCounter:
+    """
+    Integrates the battery current to the charge, sample by sample with the trapezoidal rule over the monotonic clock.
+
+    The samples are fed on each change of a current and in each update cycle, so transients between the
+    cycles are counted and a step of the wall clock does not change the charge.
+    """
+
+    def __init__(self):
+        # (monotonic time, current) of the last sample
+        self._last = None
+        # charge in Ah counted since the last take()
+        self._charge = 0.0
+        self.samples = 0
+        # sum of |trapezoid - rectangle| of all segments in Ah, i.e. the uncertainty due to the sampling
+        self.error = 0.0
+
+    def reset(self):
+        """
+        Forget the last sample, so the time until the next sample is not counted, i.e. while no values are available.
+        """
+        self._last = None
+
+    def sample(self, current, efficiency=1.0, now=None):
+        """
+        :param current: battery current in A, positive while charging
+        :param efficiency: factor of the charge counted while charging
+        :param now: monotonic time of the sample, default is now
+        """
+        if now is None:
+            now = time.monotonic()
+        if self._last is not None:
+            last_time, last_current = self._last
+            dt = (now - last_time) / 3600
+            if dt > 0:
+                if (last_current > 0) != (current > 0) and last_current != current:
+                    # split the segment at the zero crossing, so the efficiency is only applied to the charging part
+                    dt_zero = dt * last_current / (last_current - current)
+                    self._charge += self._segment(last_current, 0.0, dt_zero, efficiency)
+                    self._charge += self._segment(0.0, current, dt - dt_zero, efficiency)
+                else:
+                    self._charge += self._segment(last_current, current, dt, efficiency)
+                self.error += abs(current - last_current) / 2 * dt
+        self._last = (now, current)
+        self.samples += 1
+
+    @staticmethod
+    def _segment(current_1, current_2, dt, efficiency) -> float:
+        charge = (current_1 + current_2) / 2 * dt
+        return charge * efficiency if charge > 0 else charge
+
+    def take(self) -> float:
+        """
+        :return: charge in Ah counted since the last call
+        """
+        charge, self._charge = self._charge, 0.0
+        return charge
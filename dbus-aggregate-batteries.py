@@ -14,16 +14,22 @@ https://github.com/victronenergy/venus/wiki/dbus
 https://github.com/victronenergy/velib_python
 """
 
-from gi.repository import GLib
+from gi.repository import GLib, Gio
 import logging
 import sys
 import os
-import tempfile
+import signal
 import platform
 import dbus
+import json
 import re
 import settings
 from functions import Functions
+from alarms import ALARM_PATHS, AlarmMatrix
+from cellstats import CellStatistics
+from extremes import CELL_PATHS, TEMPERATURE_PATHS, ExtremesIndex
+from currents import CoulombCounter, CurrentSources
+from persistence import PersistenceScheduler, StateJournal
 
 # for UTC time stamps for logging
 from datetime import datetime as dt
@@ -31,7 +37,6 @@ from datetime import datetime as dt
 # for charge measurement
 import time as tt
 from dbusmon import DbusMon
-from threading import Thread
 
 # add ext folder to sys.path
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext"))
@@ -39,22 +44,101 @@ sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext"))
 # optionally from victron
 # sys.path.insert(1, "/opt/victronenergy/dbus-systemcalc-py/ext/velib_python")
 
-from vedbus import VeDbusService, VeDbusItemImport  # noqa: E402
+from vedbus import VeDbusService  # noqa: E402
 
 VERSION = "4.3.20260611-beta"
 
-_STATE_FILE_CHARGE = "/data/apps/dbus-aggregate-batteries/storedvalue_charge"
-_STATE_FILE_BALANCING = "/data/apps/dbus-aggregate-batteries/storedvalue_last_balancing"
-
-
-def _write_atomic(path: str, content: str) -> None:
-    """Write content atomically to path via a temporary file and os.replace."""
-    dir_ = os.path.dirname(path)
-    with tempfile.NamedTemporaryFile(mode="w", dir=dir_, delete=False, suffix=".tmp") as tmp:
-        tmp.write(content)
-        tmp.flush()
-        os.fsync(tmp.fileno())
-    os.replace(tmp.name, path)
+_STATE_FILE_JOURNAL = "/data/apps/dbus-aggregate-batteries/storedvalue_journal"
+_STATE_FILE_DISCOVERY = "/data/apps/dbus-aggregate-batteries/storedvalue_discovery"
+_STATE_FILE_SNAPSHOT = "/data/apps/dbus-aggregate-batteries/storedvalue_snapshot"
+_STATE_FILE_CELL_STATISTICS = "/data/apps/dbus-aggregate-batteries/storedvalue_cell_statistics"
+
+# number of the cells drifting most, which are published with the cell statistics
+_DRIFTING_CELLS = 5
+
+# state files of older versions, which are imported into the state journal, newest first
+_LEGACY_STATE_FILES = {
+    "charge": (
+        "/data/apps/dbus-aggregate-batteries/storedvalue_charge",
+        "/data/apps/dbus-aggregate-batteries/charge",
+    ),
+    "lastBalancing": (
+        "/data/apps/dbus-aggregate-batteries/storedvalue_last_balancing",
+        "/data/apps/dbus-aggregate-batteries/last_balancing",
+    ),
+}
+
+# controller state saved in the state journal, {key: attribute}
+_CONTROLLER_STATE = {
+    "charge": "_ownCharge",
+    "lastBalancing": "_lastBalancing",
+    "balancing": "_balancing",
+    "dynamicCVL": "_dynamicCVL",
+    "dynCVLactivated": "_dynCVLactivated",
+    "DCfeedActive": "_DCfeedActive",
+    "fullyDischarged": "_fullyDischarged",
+}
+
+# state of the charge control, which is restored only if saved less than CONTROLLER_STATE_MAX_AGE ago on the same day
+_TRANSIENT_STATE = ("balancing", "dynamicCVL", "dynCVLactivated", "DCfeedActive", "fullyDischarged")
+
+# published values, which are saved in the snapshot and published again on start
+_SNAPSHOT_PATHS = (
+    "/Dc/0/Voltage",
+    "/Dc/0/Current",
+    "/Dc/0/Power",
+    "/Soc",
+    "/Capacity",
+    "/InstalledCapacity",
+    "/ConsumedAmphours",
+    "/Dc/0/Temperature",
+    "/System/MinCellVoltage",
+    "/System/MaxCellVoltage",
+    "/Info/MaxChargeCurrent",
+    "/Info/MaxDischargeCurrent",
+    "/Info/MaxChargeVoltage",
+    "/Io/AllowToCharge",
+    "/Io/AllowToDischarge",
+    "/Io/AllowToBalance",
+)
+
+# share of the write budget for the snapshot, the rest is left for the charge in the state journal
+_SNAPSHOT_BUDGET_SHARE = 0.5
+
+
+# values, which every battery has to deliver to be aggregated, see _battery_fault()
+_BATTERY_PATHS = (
+    "/Dc/0/Current",
+    "/InstalledCapacity",
+    "/Dc/0/Temperature",
+    "/System/MaxCellTemperature",
+    "/System/MinCellTemperature",
+    "/System/MaxCellVoltage",
+    "/System/MinCellVoltage",
+    "/System/NrOfModulesOnline",
+    "/System/NrOfModulesOffline",
+    "/System/NrOfModulesBlockingCharge",
+    "/System/NrOfModulesBlockingDischarge",
+)
+
+
+# values of the batteries, which trigger the fast path of the charge/discharge limits, see _fast_limits()
+_FAST_PATH_PATHS = (
+    "/System/MaxCellVoltage",
+    "/System/MinCellVoltage",
+    "/System/NrOfModulesBlockingCharge",
+    "/System/NrOfModulesBlockingDischarge",
+)
+
+# values of the devices, which the search functions depend on, see _discovery_value_changed()
+_DISCOVERY_PATHS = (
+    "/ProductName",
+    "/CustomName",
+    "/DeviceInstance",
+    "/InstalledCapacity",
+    "/Soc",
+    "/System/NrOfCellsPerBattery",
+)
 
 
 def get_bus():
@@ -64,7 +148,14 @@ def get_bus():
 
 class DbusAggBatService(object):
 
-    def __init__(self, servicename="com.victronenergy.battery.aggregate"):
+    def __init__(self, servicename="com.victronenergy.battery.aggregate", startup_phases=None):
+        """
+        :param servicename: dbus service name of the aggregated battery
+        :param startup_phases: {phase: seconds} of the startup before the service is created, i.e. the imports
+        """
+        self._startTime = tt.monotonic()
+        # {phase: seconds}, logged when the first values are published
+        self._startupPhases = dict(startup_phases or {})
         self._fn = Functions()
         self._batteries_dict = {}
         """ dictionary with battery name as key and dbus service as value """
@@ -75,11 +166,25 @@ class DbusAggBatService(object):
         self._mppts_list = []
         """ list of dbus services of MPPTs, if found """
 
+        self._currents = None
+        """ registry of the devices measuring the current, if CURRENT_FROM_VICTRON """
+
+        self._alarms = None
+        """ alarms of the aggregated batteries """
+
+        # lowest and highest cell voltages and temperatures of all batteries, if EXTREMES_TOP_K > 0
+        self._cellExtremes = None
+        self._temperatureExtremes = None
+        # streaming statistics of all cell voltages, if CELL_STATISTICS_INTERVAL > 0
+        self._cellStatistics = None
+        self._cellStatisticsPublished = 0
+        self._cellStatisticsSaved = tt.monotonic()
+
         # store list of SmartShunts as specified in settings.py
         self._smartShunt_list = []
         """ list of dbus services of SmartShunts, if found """
 
-        # Initialize tread as None
+        # dbusmonitor, started when all paths are created
         self._dbusMon = None
 
         # the number of SmartShunts at the beginning of _smartShunt_list that are in the
@@ -87,6 +192,34 @@ class DbusAggBatService(object):
         self._num_battery_shunts = 0
         self._settings = None
         self._searchTrials = 1
+        # startup requirements {name: search function}, evaluated whenever a device appears on or leaves the dbus
+        # or a device fills in a value the search depends on
+        self._requirements = {}
+        # {name: seconds from the start of the service until the requirement was satisfied}
+        self._requirementWaits = {}
+        # {name: error message of the last unsatisfied search}
+        self._requirementErrors = {}
+        self._discoveryTimeout = None
+        # idle source of the next evaluation of the requirements after a value change
+        self._discoveryIdle = None
+        # set by the search functions, when the requirement is not satisfied
+        self._discoveryError = None
+        # True, if the devices were taken from the discovery cache
+        self._discoveryFromCache = False
+        # True, when all devices are found and the _update loop is running
+        self._running = False
+        # used devices, which disappeared from the dbus {service: (role, device instance)}
+        self._missingDevices = {}
+        self._recoveryStart = None
+        self._recoveryTimeout = None
+        # time, when the last missing device reappeared, to measure the time until fresh values are published
+        self._recoveryReappeared = None
+        # reason, why the charge and discharge current limits are held at 0 A, until fresh values are published
+        self._safeHold = None
+        # batteries excluded from the aggregation due to missing or stale values {name: reason}
+        self._excludedBatteries = {}
+        # last known installed capacity of each battery, the own Coulomb counter refers to the whole bank
+        self._batteryCapacity = {}
         self._readTrials = 1
         self._MaxChargeVoltage_old = 0
         self._MaxChargeCurrent_old = 0
@@ -102,7 +235,10 @@ class DbusAggBatService(object):
         logging.info("Initializing VeDbusService...")
         self._dbusservice = VeDbusService(servicename, self._dbusConn, register=False)
         logging.info("VeDbusService initialized")
-        self._timeOld = tt.time()
+        # own Coulomb counter, fed by each change of the battery current
+        self._coulomb = CoulombCounter()
+        # source of the integrated current, "Victron" or "BMS", the counter does not mix the samples of both
+        self._coulombSource = None
         # written when dynamic CVL limit activated
         self._DCfeedActive = False
         # Set True when starting dynamic CVL reduction. Set False when balancing is finished.
@@ -111,57 +247,38 @@ class DbusAggBatService(object):
         self._balancing = 0
         # Day in year
         self._lastBalancing = 0
+        # charge in Ah, restored from the state journal, starting with 0 Ah without journal.
+        # A negative value in the journal is replaced by the charge of the batteries, when they are found
+        self._ownCharge = 0.0
+        # DC-coupled PV feed-in to enable again, if the state of the dynamic CVL reduction was not restored
+        self._restoreFeedIn = None
         # set if the CVL needs to be reduced due to peaking
         self._dynamicCVL = False
         # last timestamp then the log was printed
         self._logLastPrintTimeStamp = 0
 
         self.SETTINGS_PATH_SHORT = "Devices/aggregatebatteries/CustomName"  # without /Settings/ prefix for AddSetting
-        self.SETTINGS_PATH = "/Settings/" + self.SETTINGS_PATH_SHORT  # with /Settings/ prefix for VeDbusItemImport
+        self.SETTINGS_PATH = "/Settings/" + self.SETTINGS_PATH_SHORT  # with /Settings/ prefix for the dbusmonitor
+
+        # the state files are written in the background within the budget of WRITE_BUDGET_PER_DAY
+        self._persistence = PersistenceScheduler(settings.WRITE_BUDGET_PER_DAY * 1024)
 
-        # read initial charge from text file
+        # read the charge, the day of the last balancing and the state of the controller
+        self._journal = StateJournal(_STATE_FILE_JOURNAL, self._persistence)
         try:
-            with open(_STATE_FILE_CHARGE, "r") as f:
-                self._ownCharge = float(f.readline().strip())
-            self._ownCharge_old = self._ownCharge
-            logging.info("Initial Ah read from file: %.0fAh" % (self._ownCharge))
-        except FileNotFoundError:
-            logging.warning("Charge file not found. Starting with 0 Ah.")
-            self._ownCharge = 0.0
-            self._ownCharge_old = self._ownCharge
-            _write_atomic(_STATE_FILE_CHARGE, "%.3f" % self._ownCharge)
-        except ValueError:
-            logging.warning("Charge file corrupt. Starting with 0 Ah.")
-            self._ownCharge = 0.0
-            self._ownCharge_old = self._ownCharge
-            _write_atomic(_STATE_FILE_CHARGE, "%.3f" % self._ownCharge)
+            self._load_state()
         except Exception:
-            logging.error("Charge file read error. Exiting...")
+            (
+                exception_type,
+                exception_object,
+                exception_traceback,
+            ) = sys.exc_info()
+            file = exception_traceback.tb_frame.f_code.co_filename
+            line = exception_traceback.tb_lineno
+            logging.error(f"State journal read error: {repr(exception_object)} of type {exception_type} in {file} line #{line}. Exiting...")
             tt.sleep(settings.TIME_BEFORE_RESTART)
             sys.exit(1)
-
-        # read the day of the last balancing from text file
-        if settings.OWN_CHARGE_PARAMETERS:
-            try:
-                with open(_STATE_FILE_BALANCING, "r") as f:
-                    self._lastBalancing = int(f.readline().strip())
-                # in days
-                time_unbalanced = int((dt.now()).strftime("%j")) - self._lastBalancing
-                if time_unbalanced < 0:
-                    # year change
-                    time_unbalanced += 365
-                logging.info("Last balancing done at the %d. day of the year" % (self._lastBalancing))
-                logging.info("Batteries balanced %d days ago." % time_unbalanced)
-            except FileNotFoundError:
-                logging.warning("Last balancing file not found. Treating as never balanced.")
-                self._lastBalancing = 0
-            except ValueError:
-                logging.warning("Last balancing file corrupt. Treating as never balanced.")
-                self._lastBalancing = 0
-            except Exception:
-                logging.error("Last balancing file read error. Exiting...")
-                tt.sleep(settings.TIME_BEFORE_RESTART)
-                sys.exit(1)
+        self._chargeSaved = tt.monotonic()
 
         # Create the management objects, as specified in the ccgx dbus-api document
         self._dbusservice.add_path("/Mgmt/ProcessName", __file__)
@@ -255,20 +372,27 @@ class DbusAggBatService(object):
         self._dbusservice.add_path("/TimeToGo", None, writeable=True)
 
         # Create alarm paths
-        self._dbusservice.add_path("/Alarms/LowVoltage", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/HighVoltage", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/LowCellVoltage", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/HighCellVoltage", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/LowSoc", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/HighChargeCurrent", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/HighDischargeCurrent", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/CellImbalance", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/InternalFailure", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/HighChargeTemperature", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/LowChargeTemperature", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/HighTemperature", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/LowTemperature", None, writeable=True)
-        self._dbusservice.add_path("/Alarms/BmsCable", None, writeable=True)
+        for path in ALARM_PATHS:
+            self._dbusservice.add_path(path, None, writeable=True)
+
+        # Create paths of the lowest and highest cell voltages and temperatures
+        for rank in range(1, settings.EXTREMES_TOP_K + 1):
+            for extreme in ("Lowest", "Highest"):
+                self._dbusservice.add_path("/Extremes/%sCell%d" % (extreme, rank), None, gettextcallback=lambda a, x: "{:.3f}V".format(x))
+                self._dbusservice.add_path("/Extremes/%sCell%dId" % (extreme, rank), None)
+                self._dbusservice.add_path("/Extremes/%sTemperature%d" % (extreme, rank), None, gettextcallback=lambda a, x: "{:.1f}C".format(x))
+                self._dbusservice.add_path("/Extremes/%sTemperature%dId" % (extreme, rank), None)
+        if settings.EXTREMES_TOP_K > 0:
+            self._dbusservice.add_path("/Extremes/CellVoltageSpread", None, gettextcallback=lambda a, x: "{:.3f}V".format(x))
+            self._dbusservice.add_path("/Extremes/TemperatureSpread", None, gettextcallback=lambda a, x: "{:.1f}C".format(x))
+
+        # Create paths of the cells drifting most, the paths of each battery are created with its first statistics
+        if settings.CELL_STATISTICS_INTERVAL > 0:
+            for rank in range(1, _DRIFTING_CELLS + 1):
+                self._dbusservice.add_path("/CellStatistics/DriftingCell%d" % rank, None, gettextcallback=lambda a, x: "{:+.3f}V".format(x))
+                self._dbusservice.add_path("/CellStatistics/DriftingCell%dId" % rank, None)
+                # standard deviation of the voltage weighted with the time, see CellStatistics
+                self._dbusservice.add_path("/CellStatistics/DriftingCell%dStdDev" % rank, None, gettextcallback=lambda a, x: "{:.3f}V".format(x))
 
         # Create control paths
         self._dbusservice.add_path(
@@ -293,30 +417,769 @@ class DbusAggBatService(object):
         self._dbusservice.add_path("/Io/AllowToDischarge", None, writeable=True)
         self._dbusservice.add_path("/Io/AllowToBalance", None, writeable=True)
 
-        x = Thread(target=self._startMonitor)
-        x.start()
+        # Create diagnostic paths
+        self._dbusservice.add_path("/Diagnostics/PendingSettingsWrites", 0)
+        self._dbusservice.add_path("/Diagnostics/TimeToFirstFreshValue", None, gettextcallback=lambda a, x: "{:.3f}s".format(x))
+        self._dbusservice.add_path("/Diagnostics/RecoveryTime", None, gettextcallback=lambda a, x: "{:.3f}s".format(x))
+        self._dbusservice.add_path("/Diagnostics/Recoveries", 0)
+        self._dbusservice.add_path("/Diagnostics/FastPathLatency", None, gettextcallback=lambda a, x: "{:.3f}ms".format(x))
+        self._dbusservice.add_path("/Diagnostics/FastPathUpdates", 0)
+        self._dbusservice.add_path("/Diagnostics/ConfigReloads", 0)
+        self._dbusservice.add_path("/Diagnostics/RestartRequired", 0)
+        self._dbusservice.add_path("/Diagnostics/PersistenceWrites", 0)
+        self._dbusservice.add_path("/Diagnostics/PersistenceLatency", None, gettextcallback=lambda a, x: "{:.3f}ms".format(x))
+        self._dbusservice.add_path("/Diagnostics/PersistenceBytes", 0, gettextcallback=lambda a, x: "{:d}B".format(x))
+        self._dbusservice.add_path("/Diagnostics/PendingFileWrites", 0)
+        self._dbusservice.add_path("/Diagnostics/CoulombSamples", 0)
+        self._dbusservice.add_path("/Diagnostics/CoulombError", 0, gettextcallback=lambda a, x: "{:.3f}Ah".format(x))
+
+        # time of the last saved snapshot and seconds from start until the first values from the batteries were published
+        self._snapshotSaved = 0
+        self._firstFreshValue = None
+        # publish the values of the last run, until fresh values are available
+        if settings.SNAPSHOT_INTERVAL > 0:
+            self._publish_snapshot()
+
+        # the config files are read again on SIGHUP and, if enabled, when config.ini is saved
+        self._reloadTimeout = None
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGHUP, self._sighup)
+        if settings.RELOAD_ON_CONFIG_CHANGE:
+            self._configMonitor = Gio.File.new_for_path(settings.custom_config_file_path).monitor_file(Gio.FileMonitorFlags.NONE, None)
+            self._configMonitor.connect("changed", self._config_changed)
+
+        # the VeDbusService is registered, when the dbusmonitor has scanned the dbus
+        self._startMonitor()
 
-        # wait that Dbus monitor is running else there is no data
-        while self._dbusMon is None:
-            tt.sleep(1)
+    # #################################################################################
+    # #################################################################################
+    # ## Starting battery dbus monitor, the dbus is scanned from the GLib main loop ###
+    # #################################################################################
+    # #################################################################################
 
-        # search com.victronenergy.settings
-        GLib.timeout_add_seconds(settings.UPDATE_INTERVAL_FIND_DEVICES, self._find_settings)
+    def _startMonitor(self):
+        logging.info("Starting dbusmonitor...")
+        self._dbusMon = DbusMon(
+            scan_complete_callback=self._monitor_ready,
+            bus=self._dbusConn if settings.SHARED_DBUS_CONNECTION else None,
+        )
+        logging.info("dbusmonitor started, scanning dbus...")
+
+    def _monitor_ready(self, dbusMon):
+        self._startupPhases["monitor scan"] = dbusMon.scan_duration
 
         # register VeDbusService after all paths where added and all data is available
         logging.info("Registering VeDbusService...")
+        start = tt.monotonic()
         self._dbusservice.register()
+        self._startupPhases["register"] = tt.monotonic() - start
 
-    # #############################################################################################################
-    # #############################################################################################################
-    # ## Starting battery dbus monitor in external thread (otherwise collision with AggregateBatteries service) ###
-    # #############################################################################################################
-    # #############################################################################################################
+        for connection in dbusMon.connection_report():
+            if connection["match_rules"] is None:
+                logging.info("|- D-Bus connection of %s (%s): match rules not tracked" % (connection["connection"], connection["unique_name"]))
+                continue
+            logging.info(
+                "|- D-Bus connection of %s (%s): %d match rules" % (connection["connection"], connection["unique_name"], len(connection["match_rules"]))
+            )
+            for rule, receivers in connection["match_rules"]:
+                logging.debug("   |- %s (%d receivers)" % (rule, receivers))
+
+        # called from the main loop when the dbus scan is complete: search all devices at once
+        self._requirements = {"settings": self._find_settings}
+        self._discoveryStart = tt.monotonic()
+        if self._use_discovery_cache():
+            self._discoveryFromCache = True
+            self._requirementWaits["cached devices"] = tt.monotonic() - self._startTime
+        else:
+            self._requirements["batteries"] = self._find_batteries
+            if settings.CURRENT_FROM_VICTRON:
+                # if current from Victron stuff search multi/quattro and MPPTs on DBus
+                self._requirements["multis"] = self._find_multis
+                if settings.NR_OF_MPPTS > 0:
+                    self._requirements["mppts"] = self._find_mppts
+        if settings.CURRENT_FROM_VICTRON:
+            self._currents = CurrentSources(dbusMon)
+        self._alarms = AlarmMatrix(dbusMon)
+        if settings.EXTREMES_TOP_K > 0:
+            self._cellExtremes = ExtremesIndex(dbusMon, CELL_PATHS[: settings.NR_OF_CELLS_PER_BATTERY])
+            self._temperatureExtremes = ExtremesIndex(dbusMon, TEMPERATURE_PATHS)
+        if settings.CELL_STATISTICS_INTERVAL > 0:
+            self._cellStatistics = CellStatistics(
+                dbusMon, settings.NR_OF_CELLS_PER_BATTERY, settings.CELL_STATISTICS_TIME_CONSTANT, settings.MIN_CELL_VOLTAGE, settings.MAX_CELL_VOLTAGE
+            )
+            self._load_cell_statistics()
+        dbusMon.add_device_listener(added=self._device_added, removed=self._device_removed)
+        for path in set(_DISCOVERY_PATHS + (settings.BATTERY_PRODUCT_NAME_PATH, settings.BATTERY_INSTANCE_NAME_PATH, settings.SMARTSHUNT_INSTANCE_NAME_PATH)):
+            dbusMon.add_value_listener(path, self._discovery_value_changed)
+        if settings.FAST_PATH_LIMITS:
+            for path in _FAST_PATH_PATHS:
+                dbusMon.add_value_listener(path, self._fast_limits)
+        # after the listener of the current registry, so its totals are already updated
+        dbusMon.add_value_listener("/Dc/0/Current", self._current_changed)
+        # all requirements have to be satisfied within the time of SEARCH_TRIALS searches
+        self._discoveryTimeout = GLib.timeout_add_seconds(
+            settings.SEARCH_TRIALS * settings.UPDATE_INTERVAL_FIND_DEVICES,
+            self._discovery_timeout,
+        )
+        self._evaluate_requirements()
 
-    def _startMonitor(self):
-        logging.info("Starting dbusmonitor...")
-        self._dbusMon = DbusMon()
-        logging.info("dbusmonitor started")
+    # #################################################################################
+    # #################################################################################
+    # ## evaluate the startup requirements when devices appear on or leave the dbus ###
+    # #################################################################################
+    # #################################################################################
+
+    def _evaluate_requirements(self):
+        """
+        Evaluate all unsatisfied startup requirements against the services known to the dbusmonitor.
+        Start the _update loop, when all are satisfied, else wait for the next device, which appears or leaves.
+        """
+        for name, search in list(self._requirements.items()):
+            self._discoveryError = None
+            if search():
+                del self._requirements[name]
+                self._requirementErrors.pop(name, None)
+                self._requirementWaits[name] = tt.monotonic() - self._startTime
+            else:
+                self._requirementErrors[name] = self._discoveryError
+        if self._requirements:
+            return
+
+        GLib.source_remove(self._discoveryTimeout)
+        self._discoveryTimeout = None
+        self._startupPhases["discovery"] = tt.monotonic() - self._discoveryStart
+        logging.info("> All devices found after %d searches" % self._searchTrials)
+        for name, wait in self._requirementWaits.items():
+            logging.info("|- %s: %.3f s after start" % (name, wait))
+        if not self._discoveryFromCache:
+            self._save_discovery_cache()
+        if self._currents is not None:
+            self._register_current_sources()
+        self._check_battery_curves()
+
+        # all devices found, publish the first values now and start the _update loop
+        self._running = True
+        self._coulomb.reset()
+        start = tt.monotonic()
+        self._update()
+        self._startupPhases["first publish"] = tt.monotonic() - start
+        GLib.timeout_add_seconds(settings.UPDATE_INTERVAL_DATA, self._update)
+        self._log_startup_phases()
+
+    def _register_current_sources(self):
+        self._currents.clear()
+        if self._multi is not None:
+            self._currents.add(self._multi, "Multi/Quattro")
+        for service in self._mppts_list:
+            self._currents.add(service, "MPPT")
+        for i, service in enumerate(self._smartShunt_list):
+            # the battery-mode SmartShunts are at the beginning of the list
+            self._currents.add(service, "SmartShunt" if i < self._num_battery_shunts else "SmartShunt DC meter")
+
+    def _join_mppt(self, service):
+        """
+        Count the current of an MPPT, which appeared after the start, i.e. a new solar charger.
+        """
+        if self._currents is None or settings.NR_OF_MPPTS <= 0 or settings.MPPT_KEYWORD not in service or service in self._currents:
+            return
+        self._mppts_list.append(service)
+        self._currents.add(service, "MPPT")
+        logging.info("MPPT %s (%s) joined, %d MPPT(s) used" % (service, self._dbusMon.dbusmon.get_value(service, "/ProductName"), len(self._mppts_list)))
+        self._save_discovery_cache()
+
+    def _log_startup_phases(self):
+        try:
+            total = "%.3f s" % Functions.get_process_age()
+        except Exception:
+            total = "unknown"
+        logging.info("> Startup completed, first values published %s after process start" % total)
+        for phase, duration in self._startupPhases.items():
+            logging.info("|- %s: %.3f s" % (phase, duration))
+
+    # ############################################################################
+    # ############################################################################
+    # ## recovery of used devices, which disappeared from and reappear on dbus ###
+    # ############################################################################
+    # ############################################################################
+
+    def _device_role(self, service):
+        """
+        :return: the role of the service in the aggregation, or None if not used
+        """
+        if service in self._batteries_dict.values():
+            return "battery"
+        if service in self._smartShunt_list:
+            return "SmartShunt"
+        if service == self._multi:
+            return "Multi/Quattro"
+        if service in self._mppts_list:
+            return "MPPT"
+        return None
+
+    def _start_recovery(self, service, role, device_instance):
+        self._missingDevices[service] = (role, device_instance)
+        if role == "battery":
+            # the battery is excluded from the aggregation, until it reappears
+            logging.warning("%s %s disappeared from the dbus" % (role, service))
+            return
+
+        logging.warning("%s %s disappeared from the dbus, waiting for it to reappear" % (role, service))
+        if self._recoveryStart is not None:
+            return
+
+        # hold safe limits, while the aggregation is paused
+        self._recoveryStart = tt.monotonic()
+        with self._dbusservice as bus:
+            for path in ("/Info/MaxChargeCurrent", "/Info/MaxDischargeCurrent"):
+                if bus[path] is not None:
+                    bus[path] = bus[path] * settings.RECOVERY_LIMIT_FACTOR
+        logging.warning(
+            "|- Aggregation paused, CCL: %sA, DCL: %sA" % (self._dbusservice["/Info/MaxChargeCurrent"], self._dbusservice["/Info/MaxDischargeCurrent"])
+        )
+        self._recoveryTimeout = GLib.timeout_add_seconds(settings.RECOVERY_TIMEOUT, self._recovery_timeout)
+
+    def _rebind_device(self, service, device_instance) -> bool:
+        """
+        Use a reappeared device again, either with the same service name or with the same
+        service class and device instance, i.e. if a battery is connected to another port.
+
+        :return: True, if the service replaced a missing device
+        """
+        service_class = ".".join(service.split(".")[:3])
+        for missing, (role, missing_instance) in self._missingDevices.items():
+            if missing == service or (".".join(missing.split(".")[:3]) == service_class and missing_instance == device_instance):
+                break
+        else:
+            return False
+
+        del self._missingDevices[missing]
+        if missing != service:
+            # replace the old service name in the device lists
+            self._batteries_dict = {name: (service if s == missing else s) for name, s in self._batteries_dict.items()}
+            self._smartShunt_list = [service if s == missing else s for s in self._smartShunt_list]
+            self._mppts_list = [service if s == missing else s for s in self._mppts_list]
+            if self._multi == missing:
+                self._multi = service
+            self._save_discovery_cache()
+        if self._currents is not None:
+            # read the current of the reappeared device again
+            self._currents.replace(missing, service)
+        logging.info("%s %s reappeared as %s" % (role, missing, service))
+
+        if any(role != "battery" for role, _ in self._missingDevices.values()):
+            return True
+
+        if self._recoveryTimeout is not None:
+            # all devices are back, resume the aggregation
+            GLib.source_remove(self._recoveryTimeout)
+            self._recoveryTimeout = None
+            logging.info("> All devices reappeared after %.3f s, aggregation resumed" % (tt.monotonic() - self._recoveryStart))
+            self._recoveryStart = None
+            # the charge is not counted for the time without values
+            self._coulomb.reset()
+        # publish fresh values now
+        self._recoveryReappeared = tt.monotonic()
+        self._readTrials = 1
+        self._update()
+        return True
+
+    def _recovery_timeout(self):
+        """
+        A used device did not reappear within RECOVERY_TIMEOUT. Hold safe limits and look for the missing devices
+        among the services on the dbus, i.e. if a reappearance was missed. Repeated every RECOVERY_TIMEOUT.
+        """
+        for service, (role, device_instance) in self._missingDevices.items():
+            if role != "battery":
+                logging.error("%s %s did not reappear within %d s." % (role, service, tt.monotonic() - self._recoveryStart))
+        self._hold_safe_limits("Aggregation paused")
+
+        for service in self._dbusMon.service_names("com.victronenergy"):
+            if not self._missingDevices:
+                break
+            self._rebind_device(service, self._dbusMon.dbusmon.get_device_instance(service))
+        # the source is removed by _rebind_device(), when all devices are back
+        return self._recoveryTimeout is not None
+
+    def _hold_safe_limits(self, reason):
+        """
+        Stop charging and discharging, while no valid values can be aggregated. The _update loop and the
+        search of the devices keep running, the limits are calculated again with the next fresh values.
+
+        :param reason: logged, when the limits are set to 0
+        """
+        if self._safeHold is None:
+            logging.error("%s, charge and discharge current limits held at 0 A until fresh values are available" % reason)
+        self._safeHold = reason
+        with self._dbusservice as bus:
+            bus["/Info/MaxChargeCurrent"] = 0
+            bus["/Info/MaxDischargeCurrent"] = 0
+
+    def _battery_fault(self, service):
+        """
+        :param service: dbus service of the battery
+        :return: reason why the battery can not be aggregated, or None if its values are complete and fresh
+        """
+        if service in self._missingDevices:
+            return "disappeared from the dbus"
+        age = self._dbusMon.data_age(service)
+        if age is None:
+            return "disappeared from the dbus"
+        if settings.BATTERY_STALE_TIME > 0 and age > settings.BATTERY_STALE_TIME:
+            return "no new values for %d s" % age
+
+        paths = list(_BATTERY_PATHS)
+        if settings.CAN_batteries:
+            if self._dbusMon.dbusmon.get_value(service, "/Dc/0/Voltage") is None and self._dbusMon.dbusmon.get_value(service, "/Voltages/Sum") is None:
+                return "no value of /Dc/0/Voltage and /Voltages/Sum"
+        else:
+            paths += ["/Dc/0/Voltage", "/Dc/0/Power", "/Voltages/Sum"]
+            if not settings.OWN_SOC:
+                paths += ["/ConsumedAmphours", "/Capacity", "/Soc"]
+        if settings.OWN_CHARGE_PARAMETERS:
+            paths += ["/Voltages/Cell%d" % (j + 1) for j in range(settings.NR_OF_CELLS_PER_BATTERY)]
+        else:
+            paths += ["/Info/MaxChargeCurrent", "/Info/MaxDischargeCurrent", "/Info/MaxChargeVoltage"]
+        for path in paths:
+            if self._dbusMon.dbusmon.get_value(service, path) is None:
+                return "no value of %s" % path
+        return None
+
+    def _select_batteries(self):
+        """
+        Exclude batteries with missing or stale values from this aggregation cycle and log changes.
+
+        :return: dictionary with battery name as key and dbus service as value of the batteries to aggregate
+        """
+        batteries = {}
+        excluded = {}
+        for name, service in self._batteries_dict.items():
+            reason = self._battery_fault(service)
+            if reason is None:
+                batteries[name] = service
+            else:
+                excluded[name] = reason
+
+        for name, reason in excluded.items():
+            if name not in self._excludedBatteries:
+                logging.warning("Battery %s excluded from the aggregation: %s" % (name, reason))
+        for name in self._excludedBatteries:
+            if name not in excluded:
+                logging.info("Battery %s aggregated again" % name)
+        if excluded.keys() != self._excludedBatteries.keys():
+            logging.info("|- Aggregating %d of %d batteries" % (len(batteries), len(self._batteries_dict)))
+        self._excludedBatteries = excluded
+        return batteries
+
+    # #####################################################################
+    # #####################################################################
+    # ## discovery cache, devices found at the last start of the driver ###
+    # #####################################################################
+    # #####################################################################
+
+    def _discovery_config(self) -> dict:
+        """
+        :return: the settings, which affect the discovery, a changed setting invalidates the discovery cache
+        """
+        config = {
+            "NR_OF_BATTERIES": settings.NR_OF_BATTERIES,
+            "NR_OF_CELLS_PER_BATTERY": settings.NR_OF_CELLS_PER_BATTERY,
+            "NR_OF_MPPTS": settings.NR_OF_MPPTS,
+            "BATTERY_SERVICE_NAME": settings.BATTERY_SERVICE_NAME,
+            "DCLOAD_SERVICE_NAME": settings.DCLOAD_SERVICE_NAME,
+            "BATTERY_PRODUCT_NAME_PATH": settings.BATTERY_PRODUCT_NAME_PATH,
+            "BATTERY_PRODUCT_NAME": settings.BATTERY_PRODUCT_NAME,
+            "BATTERY_INSTANCE_NAME_PATH": settings.BATTERY_INSTANCE_NAME_PATH,
+            "MULTI_KEYWORD": settings.MULTI_KEYWORD,
+            "MPPT_KEYWORD": settings.MPPT_KEYWORD,
+            "SMARTSHUNT_NAME_KEYWORD": settings.SMARTSHUNT_NAME_KEYWORD,
+            "SMARTSHUNT_INSTANCE_NAME_PATH": settings.SMARTSHUNT_INSTANCE_NAME_PATH,
+            "CURRENT_FROM_VICTRON": settings.CURRENT_FROM_VICTRON,
+            "USE_SMARTSHUNTS": settings.USE_SMARTSHUNTS,
+        }
+        # compare as stored in the file, i.e. tuples become lists
+        return json.loads(json.dumps(config))
+
+    def _save_discovery_cache(self):
+        dbusmon = self._dbusMon.dbusmon
+        cache = {
+            "config": self._discovery_config(),
+            "batteries": {name: [service, dbusmon.get_device_instance(service)] for name, service in self._batteries_dict.items()},
+            "smartshunts": [[service, dbusmon.get_device_instance(service)] for service in self._smartShunt_list],
+            "num_battery_shunts": self._num_battery_shunts,
+            "multi": [self._multi, dbusmon.get_device_instance(self._multi)] if self._multi is not None else None,
+            "mppts": [[service, dbusmon.get_device_instance(service)] for service in self._mppts_list],
+        }
+        self._persistence.schedule(_STATE_FILE_DISCOVERY, json.dumps(cache), critical=True)
+
+    def _use_discovery_cache(self) -> bool:
+        """
+        Validate the devices of the discovery cache in one pass against the dbusmonitor and use them, if all match.
+
+        :return: True, if the cached devices are used, False if a full discovery is needed
+        """
+        try:
+            with open(_STATE_FILE_DISCOVERY, "r") as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            logging.warning("Discovery cache corrupt. Searching all devices.")
+            return False
+
+        dbusmon = self._dbusMon.dbusmon
+
+        def present(entry):
+            # the service is on the dbus with the same device instance
+            service, device_instance = entry
+            return service in dbusmon.servicesByName and dbusmon.get_device_instance(service) == device_instance
+
+        mismatch = None
+        try:
+            if cache["config"] != self._discovery_config():
+                mismatch = "settings changed"
+            elif len(cache["batteries"]) != settings.NR_OF_BATTERIES:
+                mismatch = "number of batteries"
+            elif not all(present(entry) for entry in cache["batteries"].values()):
+                mismatch = "battery not found"
+            elif not all(
+                settings.BATTERY_PRODUCT_NAME in str(dbusmon.get_value(service, settings.BATTERY_PRODUCT_NAME_PATH))
+                for service, _ in cache["batteries"].values()
+            ):
+                mismatch = "battery product name"
+            elif not settings.CAN_batteries and not all(
+                dbusmon.get_value(service, "/System/NrOfCellsPerBattery") == settings.NR_OF_CELLS_PER_BATTERY for service, _ in cache["batteries"].values()
+            ):
+                mismatch = "number of cells"
+            elif self._ownCharge < 0 and any(
+                dbusmon.get_value(service, "/Soc") is None or dbusmon.get_value(service, "/InstalledCapacity") is None
+                for service, _ in cache["batteries"].values()
+            ):
+                # the initial charge is taken from the batteries, the full discovery waits for their values
+                mismatch = "SoC not published yet"
+            elif not all(present(entry) for entry in cache["smartshunts"]):
+                mismatch = "SmartShunt not found"
+            elif cache["multi"] is not None and not present(cache["multi"]):
+                mismatch = "Multi/Quattro not found"
+            elif not all(present(entry) for entry in cache["mppts"]):
+                mismatch = "MPPT not found"
+        except (KeyError, TypeError, ValueError):
+            mismatch = "invalid content"
+
+        if mismatch is not None:
+            logging.info("> Discovery cache not valid (%s). Searching all devices." % mismatch)
+            return False
+
+        self._batteries_dict = {name: service for name, (service, _) in cache["batteries"].items()}
+        self._smartShunt_list = [service for service, _ in cache["smartshunts"]]
+        self._num_battery_shunts = cache["num_battery_shunts"]
+        self._multi = cache["multi"][0] if cache["multi"] is not None else None
+        self._mppts_list = [service for service, _ in cache["mppts"]]
+
+        Soc = 0
+        InstalledCapacity = 0
+        for name, service in self._batteries_dict.items():
+            self._add_cell_voltage_paths(name)
+            battery_capacity = dbusmon.get_value(service, "/InstalledCapacity")
+            if battery_capacity is not None:
+                self._batteryCapacity[name] = battery_capacity
+            # accumulate battery capacities and Soc if not read from charge file
+            if self._ownCharge < 0:
+                battery_capacity = dbusmon.get_value(service, "/InstalledCapacity")
+                Soc += dbusmon.get_value(service, "/Soc") * battery_capacity
+                InstalledCapacity += battery_capacity
+        if self._ownCharge < 0:
+            self._ownCharge = Soc / 100.0
+
+        logging.info(
+            "> Discovery cache valid: %d batteries, %d SmartShunts, %d MultiPlus/Quattro, %d MPPT(s)"
+            % (len(self._batteries_dict), len(self._smartShunt_list), 0 if self._multi is None else 1, len(self._mppts_list))
+        )
+        for name, service in self._batteries_dict.items():
+            logging.info("|- %s: %s" % (name, service))
+        return True
+
+    # ###################################################
+    # ###################################################
+    # ## controller state, saved in the state journal ###
+    # ###################################################
+    # ###################################################
+
+    def _controller_state(self) -> dict:
+        state = {key: getattr(self, attribute) for key, attribute in _CONTROLLER_STATE.items()}
+        # the charge is saved only if changed significantly, see CHARGE_SAVE_PRECISION
+        state["charge"] = round(self._ownCharge_old, 3)
+        return state
+
+    def _load_state(self):
+        """
+        Replay the state journal. State files of older versions are imported into the journal and removed.
+        """
+        state = self._journal.load()
+        imported = self._import_legacy_state()
+        rewrite = state is None or imported
+        if state is None and not imported:
+            logging.warning("State journal not found. Starting with 0 Ah, treating as never balanced.")
+        state = dict(state or {}, **imported)
+
+        if any(key in state for key in _TRANSIENT_STATE):
+            invalid = self._state_invalid(state)
+            if invalid is None:
+                logging.info(
+                    "Controller state restored: balancing state %d, dynamic CVL reduction %s"
+                    % (state.get("balancing", 0), "active" if state.get("dynamicCVL") else "inactive")
+                )
+            else:
+                logging.info("Controller state not restored, %s" % invalid)
+                if state.get("dynCVLactivated") and state.get("DCfeedActive"):
+                    # the DC-coupled PV feed-in was disabled by the dynamic CVL reduction, enable it again when the settings are found
+                    self._restoreFeedIn = state["DCfeedActive"]
+                for key in _TRANSIENT_STATE:
+                    state.pop(key, None)
+
+        for key, attribute in _CONTROLLER_STATE.items():
+            if key in state:
+                setattr(self, attribute, state[key])
+        self._ownCharge = float(self._ownCharge)
+        self._ownCharge_old = self._ownCharge
+        self._stateSaved = self._controller_state()
+        # a restored transient state is recorded again with the next update
+        self._stateRecorded = tt.monotonic() - settings.CONTROLLER_STATE_MAX_AGE
+        if rewrite:
+            # synchronously, so the old files can be removed
+            self._journal.reset(self._journal_record(self._stateSaved))
+            for paths in _LEGACY_STATE_FILES.values():
+                for path in paths:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                        logging.info("|- %s imported into the state journal and removed" % path)
+
+        logging.info("Initial Ah read from state journal: %.0fAh" % (self._ownCharge))
+        if settings.OWN_CHARGE_PARAMETERS:
+            # in days
+            time_unbalanced = int((dt.now()).strftime("%j")) - self._lastBalancing
+            if time_unbalanced < 0:
+                # year change
+                time_unbalanced += 365
+            logging.info("Last balancing done at the %d. day of the year" % (self._lastBalancing))
+            logging.info("Batteries balanced %d days ago." % time_unbalanced)
+
+    def _state_invalid(self, state):
+        """
+        :return: reason, why the transient controller state can not be restored, or None if valid
+        """
+        if "time" not in state or "day" not in state:
+            return "no time stamp"
+        age = tt.time() - state["time"]
+        # the time stamp is rounded, so a state saved just now may be up to 0.05 s in the future
+        if age < -0.1 or age > settings.CONTROLLER_STATE_MAX_AGE:
+            return "saved %d s ago" % age
+        if state["day"] != int((dt.now()).strftime("%j")):
+            return "saved on another day"
+        return None
+
+    def _journal_record(self, state) -> dict:
+        # the time stamp is needed to check the validity of the transient state after a restart
+        return dict(state, time=round(tt.time(), 1), day=int((dt.now()).strftime("%j")))
+
+    def _import_legacy_state(self) -> dict:
+        """
+        :return: {key: value} read from the state files of older versions
+        """
+        imported = {}
+        for key, paths in _LEGACY_STATE_FILES.items():
+            for path in paths:
+                if not os.path.isfile(path):
+                    continue
+                try:
+                    with open(path, "r") as f:
+                        value = f.readline().strip()
+                    imported[key] = float(value) if key == "charge" else int(value)
+                    break
+                except ValueError:
+                    logging.warning("%s corrupt, not imported" % path)
+        return imported
+
+    def _save_state(self):
+        """
+        Append the controller state to the journal, if it changed.
+        A change of other values than the charge is written regardless of the budget of WRITE_BUDGET_PER_DAY.
+        While the charge control is not idle, the state is appended again every CONTROLLER_STATE_MAX_AGE / 2,
+        so it is restored after a crash or power loss.
+        """
+        state = self._controller_state()
+        if state == self._stateSaved:
+            if not self._controller_active(state) or tt.monotonic() - self._stateRecorded < settings.CONTROLLER_STATE_MAX_AGE / 2:
+                return
+            critical = True
+        else:
+            critical = any(state[key] != self._stateSaved.get(key) for key in state if key != "charge")
+        self._journal.record(self._journal_record(state), critical)
+        self._stateSaved = state
+        self._stateRecorded = tt.monotonic()
+
+    @staticmethod
+    def _controller_active(state) -> bool:
+        # the saved DC-coupled PV feed-in setting matters only while the dynamic CVL reduction disabled it
+        return any(state[key] for key in _TRANSIENT_STATE if key != "DCfeedActive")
+
+    # ########################################################################
+    # ########################################################################
+    # ## snapshot of the published values, published again after a restart ###
+    # ########################################################################
+    # ########################################################################
+
+    def _save_snapshot(self):
+        self._snapshotSaved = tt.time()
+        snapshot = {
+            "time": self._snapshotSaved,
+            "values": {path: self._dbusservice[path] for path in _SNAPSHOT_PATHS},
+        }
+        self._persistence.schedule(_STATE_FILE_SNAPSHOT, json.dumps(snapshot), share=_SNAPSHOT_BUDGET_SHARE)
+
+    def _publish_snapshot(self):
+        """
+        Publish the values of the last snapshot, if it is not older than SNAPSHOT_MAX_AGE.
+        The charge and discharge current limits are reduced by SNAPSHOT_LIMIT_FACTOR.
+        """
+        try:
+            with open(_STATE_FILE_SNAPSHOT, "r") as f:
+                snapshot = json.load(f)
+            age = tt.time() - snapshot["time"]
+            values = snapshot["values"]
+        except FileNotFoundError:
+            return
+        except (ValueError, KeyError, TypeError):
+            logging.warning("Snapshot file corrupt. Starting without values.")
+            return
+
+        if not 0 <= age <= settings.SNAPSHOT_MAX_AGE:
+            logging.info("Snapshot is %.0f s old, not published" % age)
+            return
+
+        for path in _SNAPSHOT_PATHS:
+            value = values.get(path)
+            if value is not None and path in ("/Info/MaxChargeCurrent", "/Info/MaxDischargeCurrent"):
+                value *= settings.SNAPSHOT_LIMIT_FACTOR
+            self._dbusservice[path] = value
+        logging.info(
+            "Snapshot of %.0f s ago published, CCL: %sA, DCL: %sA until fresh values are available"
+            % (age, self._dbusservice["/Info/MaxChargeCurrent"], self._dbusservice["/Info/MaxDischargeCurrent"])
+        )
+
+    def _save_cell_statistics(self):
+        self._cellStatisticsSaved = tt.monotonic()
+        self._persistence.schedule(_STATE_FILE_CELL_STATISTICS, json.dumps(self._cellStatistics.state()))
+
+    def _load_cell_statistics(self):
+        """
+        Restore the cell statistics saved before the restart. They are applied, when the batteries are aggregated.
+        """
+        try:
+            with open(_STATE_FILE_CELL_STATISTICS, "r") as f:
+                self._cellStatistics.restore(json.load(f))
+        except FileNotFoundError:
+            return
+        except (ValueError, KeyError, TypeError):
+            logging.warning("Cell statistics file corrupt. Starting without statistics.")
+
+    def _publish_cell_statistics(self, bus):
+        """
+        Publish the spread of the cells of each battery with its trend and the cells drifting most.
+
+        :param bus: VeDbusService of the virtual battery
+        """
+        summary = self._cellStatistics.summary(_DRIFTING_CELLS)
+        for name, battery in summary["batteries"].items():
+            prefix = "/CellStatistics/%s" % re.sub("[^A-Za-z0-9_]+", "", name)
+            values = {
+                prefix + "/Spread": (round(battery["spread"], 4), "{:.3f}V"),
+                prefix + "/SpreadTrend": (round(battery["trend"], 4), "{:+.4f}V/day"),
+                prefix + "/TimeAboveMax": (round(battery["timeAbove"] / 3600, 2), "{:.2f}h"),
+                prefix + "/TimeBelowMin": (round(battery["timeBelow"] / 3600, 2), "{:.2f}h"),
+            }
+            for path, (value, text) in values.items():
+                # created with the first statistics of the battery
+                if path not in bus:
+                    bus.add_path(path, None, gettextcallback=lambda a, x, text=text: text.format(x))
+                bus[path] = value
+
+        cells = summary["cells"]
+        for rank in range(1, _DRIFTING_CELLS + 1):
+            if rank <= len(cells):
+                drift, name, cell, deviation = cells[rank - 1]
+                bus["/CellStatistics/DriftingCell%d" % rank] = round(drift, 4)
+                bus["/CellStatistics/DriftingCell%dId" % rank] = "%s: Cell%d" % (name, cell)
+                bus["/CellStatistics/DriftingCell%dStdDev" % rank] = round(deviation, 4)
+            else:
+                bus["/CellStatistics/DriftingCell%d" % rank] = None
+                bus["/CellStatistics/DriftingCell%dId" % rank] = None
+                bus["/CellStatistics/DriftingCell%dStdDev" % rank] = None
+
+    def _add_cell_voltage_paths(self, BatteryName):
+        """
+        Create the cell voltage paths of a battery, if SEND_CELL_VOLTAGES is set.
+
+        :param BatteryName: name of the battery, which is part of the path
+        """
+        if settings.SEND_CELL_VOLTAGES != 1:
+            return
+        for cellId in range(1, (settings.NR_OF_CELLS_PER_BATTERY) + 1):
+            cellPath = "/Voltages/%s_Cell%d" % (
+                re.sub("[^A-Za-z0-9_]+", "", BatteryName),
+                cellId,
+            )
+            # already created, if the batteries are searched again after a device change
+            if cellPath in self._dbusservice:
+                continue
+            self._dbusservice.add_path(
+                cellPath,
+                None,
+                writeable=True,
+                gettextcallback=lambda a, x: "{:.3f}V".format(x),
+            )
+
+    def _device_added(self, service, device_instance):
+        if self._requirements:
+            self._searchTrials += 1
+            self._evaluate_requirements()
+        elif self._running:
+            if self._missingDevices and self._rebind_device(service, device_instance):
+                return
+            self._join_mppt(service)
+
+    def _device_removed(self, service, device_instance):
+        if self._requirements:
+            self._searchTrials += 1
+            self._evaluate_requirements()
+        elif self._running:
+            role = self._device_role(service)
+            # the aggregation continues without SmartShunts, if their absence is ignored
+            if role is not None and not (role == "SmartShunt" and settings.IGNORE_SMARTSHUNT_ABSENCE):
+                self._start_recovery(service, role, device_instance)
+
+    def _discovery_value_changed(self, service_name, path, value):
+        """
+        A device already on the dbus filled in a value, i.e. a battery which did not publish its name or number of cells yet.
+        Called from the signal handler, so the requirements are evaluated once from the main loop for all changes.
+        """
+        if self._requirements and self._discoveryIdle is None:
+            self._discoveryIdle = GLib.idle_add(self._discovery_idle)
+
+    def _discovery_idle(self):
+        self._discoveryIdle = None
+        if self._requirements:
+            self._searchTrials += 1
+            self._evaluate_requirements()
+        return False
+
+    def _discovery_timeout(self):
+        """
+        Not all devices were found within SEARCH_TRIALS searches. Hold safe limits instead of the values of the snapshot
+        and keep searching on each device change. Repeated to log the missing devices, until all are found.
+        """
+        for name in self._requirements:
+            logging.error(self._requirementErrors.get(name) or "%s not found." % name)
+        self._hold_safe_limits("Not all devices found")
+        return True
 
     # ####################################################################
     # ####################################################################
@@ -325,58 +1188,44 @@ class DbusAggBatService(object):
     # ####################################################################
     # ####################################################################
 
+    def _restore_feed_in(self) -> bool:
+        """
+        Enable the DC-coupled PV feed-in again, which was disabled by the dynamic CVL reduction before the restart.
+        The write is repeated until it succeeds.
+        """
+        self._dbusMon.writes.write(self._settings, "/Settings/CGwacs/OvervoltageFeedIn", self._restoreFeedIn, callback=self._feed_in_restored)
+        return False
+
+    def _feed_in_restored(self, success):
+        if success:
+            logging.info("DC-coupled PV feed-in re-activated, it was disabled by the dynamic CVL reduction before the restart")
+            self._restoreFeedIn = None
+        else:
+            logging.warning("DC-coupled PV feed-in not re-activated, trying again in %d s" % settings.UPDATE_INTERVAL_FIND_DEVICES)
+            GLib.timeout_add_seconds(settings.UPDATE_INTERVAL_FIND_DEVICES, self._restore_feed_in)
+
     def _find_settings(self) -> bool:
         logging.info("Searching Settings: Trial Nr. %d" % self._searchTrials)
-        try:
-            for service in self._dbusConn.list_names():
-                if "com.victronenergy.settings" in service:
-                    self._settings = service
-                    logging.info("|- com.victronenergy.settings found")
-        except Exception:
-            (
-                exception_type,
-                exception_object,
-                exception_traceback,
-            ) = sys.exc_info()
-            file = exception_traceback.tb_frame.f_code.co_filename
-            line = exception_traceback.tb_lineno
-            logging.debug(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
-
-            pass
+        for service in self._dbusMon.service_names("com.victronenergy.settings"):
+            self._settings = service
+            logging.info("|- com.victronenergy.settings found")
 
         if self._settings is not None:
-            self._searchTrials = 1
+            # apply the saved CustomName and follow its changes, the dbusmonitor keeps it up to date
+            self._dbusMon.add_value_listener(self.SETTINGS_PATH, self._callback_saved_custom_name)
+            if self._dbusMon.has_path(self._settings, self.SETTINGS_PATH):
+                self._callback_saved_custom_name(self._settings, self.SETTINGS_PATH, self._dbusMon.dbusmon.get_value(self._settings, self.SETTINGS_PATH))
+            else:
+                # create the setting once, later changes are plain writes
+                self._add_custom_name_setting()
+            if self._restoreFeedIn is not None:
+                self._restore_feed_in()
 
-            # try to read saved CustomName from settings and apply it if exists
-            try:
-                setting_item = VeDbusItemImport(self._dbusConn, self._settings, self.SETTINGS_PATH, createsignal=False)
-                if setting_item.exists:
-                    custom_name = setting_item.get_value()
-                    if custom_name is not None and custom_name != "AggregateBatteries":
-                        self._dbusservice["/CustomName"] = custom_name
-                        logging.info(f'   |- Custom name restored from settings: "{custom_name}"')
-            except Exception:
-                (
-                    exception_type,
-                    exception_object,
-                    exception_traceback,
-                ) = sys.exc_info()
-                file = exception_traceback.tb_frame.f_code.co_filename
-                line = exception_traceback.tb_lineno
-                logging.debug(f"Could not read CustomName from settings: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
-
-            # search batteries on DBus if present
-            GLib.timeout_add_seconds(settings.UPDATE_INTERVAL_FIND_DEVICES, self._find_batteries)
-            # all OK, stop calling this function
-            return False
-        elif self._searchTrials < settings.SEARCH_TRIALS:
-            self._searchTrials += 1
-            # next trial
+            # all OK
             return True
         else:
-            logging.error("com.victronenergy.settings not found. Exiting...")
-            tt.sleep(settings.TIME_BEFORE_RESTART)
-            sys.exit(1)
+            self._discoveryError = "com.victronenergy.settings not found."
+            return False
 
     # #####################################################################
     # #####################################################################
@@ -393,6 +1242,8 @@ class DbusAggBatService(object):
         # no SmartShunts in the battery category have been found yet
         self._num_battery_shunts = 0
         batteriesCount = 0
+        # batteries with another number of cells than NR_OF_CELLS_PER_BATTERY, they are not used
+        cellsMismatch = 0
 
         # the following two variables are used when self._ownCharge (read from
         # the charge file), is negative
@@ -434,10 +1285,8 @@ class DbusAggBatService(object):
         shuntName = ""
         logging.info("Searching batteries: Trial Nr. %d" % self._searchTrials)
 
-        # if Dbus monitor not running yet, new trial instead of exception
         try:
-            service_names = [str(name) for name in self._dbusConn.list_names() if "com.victronenergy" in str(name)]
-            for service in sorted(service_names):
+            for service in self._dbusMon.service_names("com.victronenergy"):
                 logging.info("|- Dbusmonitor sees: %s" % (service))
                 # Current device is in Victron "battery" service
                 battery_service = settings.BATTERY_SERVICE_NAME in service
@@ -450,6 +1299,24 @@ class DbusAggBatService(object):
                     if (productName is not None) and (settings.BATTERY_PRODUCT_NAME in productName):
                         logging.info('   |- Correct battery product name "%s" found' % productName)
 
+                        # searched again, when the battery publishes its number of cells, see _discovery_value_changed()
+                        nr_of_cells = self._dbusMon.dbusmon.get_value(service, "/System/NrOfCellsPerBattery")
+                        if not settings.CAN_batteries and nr_of_cells is None:
+                            logging.info("   |- Number of cells not published yet")
+                            continue
+                        # CAN batteries do not need to publish the number of cells
+                        if nr_of_cells is not None and nr_of_cells != settings.NR_OF_CELLS_PER_BATTERY:
+                            logging.error("   |- Number of battery cells does not match config, battery not used:")
+                            logging.error("      |- Cells found in battery:         %s" % nr_of_cells)
+                            logging.error("      |- Cells specified in config file: %d" % settings.NR_OF_CELLS_PER_BATTERY)
+                            cellsMismatch += 1
+                            continue
+                        if self._ownCharge < 0 and (
+                            self._dbusMon.dbusmon.get_value(service, "/Soc") is None or self._dbusMon.dbusmon.get_value(service, "/InstalledCapacity") is None
+                        ):
+                            logging.info("   |- SoC not published yet")
+                            continue
+
                         # Custom name, if exists
                         try:
                             BatteryName = self._dbusMon.dbusmon.get_value(service, settings.BATTERY_INSTANCE_NAME_PATH)
@@ -475,6 +1342,10 @@ class DbusAggBatService(object):
                         logging.info("   |- Product name: %s" % self._dbusMon.dbusmon.get_value(service, "/ProductName"))
 
                         batteriesCount += 1
+                        # the bank capacity includes batteries, which are excluded from the first aggregation
+                        battery_capacity = self._dbusMon.dbusmon.get_value(service, "/InstalledCapacity")
+                        if battery_capacity is not None:
+                            self._batteryCapacity[BatteryName] = battery_capacity
 
                         # accumulate battery capacities and Soc if not read from charge file
                         if self._ownCharge < 0:
@@ -485,37 +1356,7 @@ class DbusAggBatService(object):
                             logging.info("      |- SoC: %f / %f Ah" % (battery_soc / 100.0, battery_capacity))
 
                         # Create voltage paths with battery names
-                        if settings.SEND_CELL_VOLTAGES == 1:
-                            for cellId in range(1, (settings.NR_OF_CELLS_PER_BATTERY) + 1):
-                                self._dbusservice.add_path(
-                                    "/Voltages/%s_Cell%d"
-                                    % (
-                                        re.sub("[^A-Za-z0-9_]+", "", BatteryName),
-                                        cellId,
-                                    ),
-                                    None,
-                                    writeable=True,
-                                    gettextcallback=lambda a, x: "{:.3f}V".format(x),
-                                )
-
-                        # Check if Nr. of cells is equal
-                        nr_of_cells = self._dbusMon.dbusmon.get_value(service, "/System/NrOfCellsPerBattery")
-
-                        if settings.CAN_batteries:
-                            if nr_of_cells is not None and nr_of_cells != settings.NR_OF_CELLS_PER_BATTERY:
-                                logging.error("     |- Number of battery cells does not match config:")
-                                logging.error("        |- Cells found in battery:         %d" % nr_of_cells)
-                                logging.error("        |- Cells specified in config file: %d" % settings.NR_OF_CELLS_PER_BATTERY)
-                                logging.error("Exiting...")
-                                tt.sleep(settings.TIME_BEFORE_RESTART)
-                                sys.exit(1)
-                        elif nr_of_cells != settings.NR_OF_CELLS_PER_BATTERY:
-                            logging.error("     |- Number of battery cells does not match config:")
-                            logging.error("        |- Cells found in battery:         %d" % nr_of_cells)
-                            logging.error("        |- Cells specified in config file: %d" % settings.NR_OF_CELLS_PER_BATTERY)
-                            logging.error("Exiting...")
-                            tt.sleep(settings.TIME_BEFORE_RESTART)
-                            sys.exit(1)
+                        self._add_cell_voltage_paths(BatteryName)
 
                         # end of section
 
@@ -551,16 +1392,14 @@ class DbusAggBatService(object):
                                     elif isinstance(settings.USE_SMARTSHUNTS[shunt_id], str):
                                         include_shunt = settings.USE_SMARTSHUNTS[shunt_id] == shuntName
 
-                                    # Bail out with an error if list entry is neither string integer nor string
+                                    # the search fails until the config is fixed, if list entry is neither integer nor string
                                     else:
-                                        logging.error(
-                                            '   |- Bad element #%d in "%s" in USE_SMARTSHUNTS list. Entries need to be '
-                                            + " VRM instancmbers or Name strings. Exiting...",
-                                            shunt_id + 1,
-                                            settings.USE_SMARTSHUNTS[shunt_id],
+                                        self._discoveryError = (
+                                            'Bad element #%d "%s" in USE_SMARTSHUNTS list. Entries need to be VRM instance numbers or Name strings.'
+                                            % (shunt_id + 1, settings.USE_SMARTSHUNTS[shunt_id])
                                         )
-                                        tt.sleep(settings.TIME_BEFORE_RESTART)
-                                        sys.exit(1)
+                                        logging.error("   |- %s" % self._discoveryError)
+                                        return False
 
                                     # if a shunt has been matched as one the user defined and we haven't included it
                                     # yet, we can get out of this loop
@@ -614,38 +1453,31 @@ class DbusAggBatService(object):
 
         # make sure the correct number of batteries and SmartShunts has been found
         if (batteriesCount == settings.NR_OF_BATTERIES) and (len(self._smartShunt_list) >= NR_OF_SMARTSHUNTS):
+            memory_report = self._dbusMon.memory_report()
+            logging.info("> Dbusmonitor holds %.1f kB for %d services" % (sum(memory_report.values()) / 1024, len(memory_report)))
+            for service in sorted(memory_report):
+                logging.debug("|- %s: %d bytes" % (service, memory_report[service]))
+
             if self._ownCharge < 0:
                 self._ownCharge = Soc / 100.0
                 Soc /= InstalledCapacity
-            if settings.CURRENT_FROM_VICTRON:
-                self._searchTrials = 1
-                # if current from Victron stuff search multi/quattro on DBus
-                GLib.timeout_add_seconds(settings.UPDATE_INTERVAL_FIND_DEVICES, self._find_multis)
-            else:
-                self._timeOld = tt.time()
-                # if current from BMS start the _update loop
-                GLib.timeout_add_seconds(settings.UPDATE_INTERVAL_DATA, self._update)
 
-            # all OK, stop calling this function
-            return False
-        # if the correct number has not been found yet, repeat until SEARCH_TRIALS is reached
-        elif self._searchTrials < settings.SEARCH_TRIALS:
-            self._searchTrials += 1
-            # next trial
+            # all OK
             return True
-        # bail out if correct number of batteries and SmartShunts can not be found after SEARCH_TRIALS tries
+        # if the correct number has not been found yet, wait for the next device change
+        # until the search time is over
         else:
             if NR_OF_SMARTSHUNTS > 0:
-                logging.error(
-                    "Required nr of batteries (%d) or SmartShunts (%d) not found. Exiting...",
+                self._discoveryError = "Required nr of batteries (%d) or SmartShunts (%d) not found." % (
                     settings.NR_OF_BATTERIES,
                     NR_OF_SMARTSHUNTS,
                 )
             else:
                 logging.info(self._batteries_dict)
-                logging.error("Required number of batteries not found. Exiting...")
-            tt.sleep(settings.TIME_BEFORE_RESTART)
-            sys.exit(1)
+                self._discoveryError = "Required number of batteries not found."
+            if cellsMismatch:
+                self._discoveryError += " %d battery(ies) with another number of cells than NR_OF_CELLS_PER_BATTERY." % cellsMismatch
+            return False
 
     # #########################################################################
     # #########################################################################
@@ -653,52 +1485,24 @@ class DbusAggBatService(object):
     # #########################################################################
     # #########################################################################
 
-    def _find_multis(self):
+    def _find_multis(self) -> bool:
         # only search for MultiPlus/Quattro devices if that is specified, possible use-cases:
         # - no MultiPlus/Quattro device installed (examples: a pure DC system, a different inverter/charger is used)
         # - current detection of MultiPlus/Quattro is not wanted (i.e. SmartShunts are used instead)
         # may still want to aggregate their batteries when using no inverter/no Victron inverter/charger)
         if len(settings.MULTI_KEYWORD) > 0:
             logging.info("Searching MultiPlus/Quattro VEbus: Trial Nr. %d" % self._searchTrials)
-            try:
-                for service in self._dbusConn.list_names():
-                    if settings.MULTI_KEYWORD in service:
-                        self._multi = service
-                        logging.info("|- %s found." % ((self._dbusMon.dbusmon.get_value(service, "/ProductName")),))
-            except Exception:
-                (
-                    exception_type,
-                    exception_object,
-                    exception_traceback,
-                ) = sys.exc_info()
-                file = exception_traceback.tb_frame.f_code.co_filename
-                line = exception_traceback.tb_lineno
-                logging.debug(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+            for service in self._dbusMon.service_names(settings.MULTI_KEYWORD):
+                self._multi = service
+                logging.info("|- %s found." % ((self._dbusMon.dbusmon.get_value(service, "/ProductName")),))
 
-                pass
-
-            logging.info("> 1 MultiPlus/Quattro found.")
             if self._multi is None:
-                if self._searchTrials < settings.SEARCH_TRIALS:
-                    self._searchTrials += 1
-                    # next trial
-                    return True
-                else:
-                    logging.error("Multi/Quattro not found. Exiting...")
-                    tt.sleep(settings.TIME_BEFORE_RESTART)
-                    sys.exit(1)
-
-        if settings.NR_OF_MPPTS > 0:
-            self._searchTrials = 1
-            # search MPPTs on DBus if present
-            GLib.timeout_add_seconds(settings.UPDATE_INTERVAL_FIND_DEVICES, self._find_mppts)
-        else:
-            self._timeOld = tt.time()
-            # if no MPPTs start the _update loop
-            GLib.timeout_add_seconds(settings.UPDATE_INTERVAL_DATA, self._update)
+                self._discoveryError = "Multi/Quattro not found."
+                return False
+            logging.info("> 1 MultiPlus/Quattro found.")
 
-        # all OK, stop calling this function
-        return False
+        # all OK
+        return True
 
     # ############################################################
     # ############################################################
@@ -706,97 +1510,361 @@ class DbusAggBatService(object):
     # ############################################################
     # ############################################################
 
-    def _find_mppts(self):
+    def _find_mppts(self) -> bool:
         self._mppts_list = []
         mpptsCount = 0
         logging.info("Searching MPPT(s): Trial Nr. %d" % self._searchTrials)
-        try:
-            for service in self._dbusConn.list_names():
-                if settings.MPPT_KEYWORD in service:
-                    self._mppts_list.append(service)
-                    logging.info("|- %s found." % ((self._dbusMon.dbusmon.get_value(service, "/ProductName")),))
-                    mpptsCount += 1
-        except Exception:
-            (
-                exception_type,
-                exception_object,
-                exception_traceback,
-            ) = sys.exc_info()
-            file = exception_traceback.tb_frame.f_code.co_filename
-            line = exception_traceback.tb_lineno
-            logging.debug(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
-
-            pass
+        for service in self._dbusMon.service_names(settings.MPPT_KEYWORD):
+            self._mppts_list.append(service)
+            logging.info("|- %s found." % ((self._dbusMon.dbusmon.get_value(service, "/ProductName")),))
+            mpptsCount += 1
 
         logging.info("> %d MPPT(s) found." % (mpptsCount))
-        if mpptsCount == settings.NR_OF_MPPTS:
-            self._timeOld = tt.time()
-            GLib.timeout_add_seconds(settings.UPDATE_INTERVAL_DATA, self._update)
-            # all OK, stop calling this function
-            return False
-        elif self._searchTrials < settings.SEARCH_TRIALS:
-            self._searchTrials += 1
-            # next trial
+        # further MPPTs join while running, see _join_mppt()
+        if mpptsCount >= settings.NR_OF_MPPTS:
+            # all OK
             return True
         else:
-            logging.error("Required number of MPPTs not found. Exiting...")
-            tt.sleep(settings.TIME_BEFORE_RESTART)
-            sys.exit(1)
+            self._discoveryError = "Required number of MPPTs not found."
+            return False
+
+    def _add_custom_name_setting(self):
+        """
+        Create the setting com.victronenergy.settings/Settings/Devices/aggregatebatteries/CustomName asynchronously.
+        """
+        logging.info(f"|- Setting {self.SETTINGS_PATH} doesn't exist, creating it...")
+        # AddSetting(group, name, default_value, type, min, max)
+        # type 's' = string, empty string for group means root /Settings/
+        self._dbusConn.call_async(
+            self._settings,
+            "/Settings",
+            "com.victronenergy.Settings",
+            "AddSetting",
+            None,
+            ["", self.SETTINGS_PATH_SHORT, self._dbusservice["/CustomName"], "s", "", ""],
+            lambda *args: logging.info(f"Successfully created setting {self.SETTINGS_PATH}"),
+            lambda e: logging.warning(f"Failed to create setting via AddSetting: {e}"),
+        )
+
+    def _callback_saved_custom_name(self, service_name, path, value):
+        """
+        Apply the custom name saved in com.victronenergy.settings/Settings/Devices/aggregatebatteries/CustomName
+
+        :param service_name: The settings service
+        :param path: The settings path
+        :param value: The saved custom name
+        """
+        if service_name != self._settings or value is None or value == "" or value == self._dbusservice["/CustomName"]:
+            return
+        self._dbusservice["/CustomName"] = value
+        logging.info(f'   |- Custom name restored from settings: "{value}"')
 
     def _callback_changed_custom_name(self, path, value):
         """
         Save the custom name to the dbus service com.victronenergy.settings/Settings/Devices/aggregatebatteries/CustomName
 
+        The value is written asynchronously, so the SetValue call from the GUI returns immediately.
+
         :param path: The dbus path being changed
         :param value: The new custom name value
-        :return: The value if successful, None if failed
+        :return: True if accepted, False if the settings are not found yet
         """
+        if self._settings is None:
+            logging.warning(f'CustomName change to "{value}" failed: com.victronenergy.settings not found yet')
+            return False
 
-        try:
-            # First check if the setting path exists in the settings service
-            setting_exists = False
+        self._dbusMon.writes.write(self._settings, self.SETTINGS_PATH, value)
+        logging.info(f'CustomName changed to "{value}"')
+        return True
+
+    # ####################################################
+    # ####################################################
+    # ## reload of the config files without restarting ###
+    # ####################################################
+    # ####################################################
+
+    def _sighup(self):
+        logging.info("SIGHUP received")
+        self._reload_settings()
+        # keep the signal handler
+        return True
+
+    def _config_changed(self, monitor, file, other_file, event_type):
+        if event_type not in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED):
+            return
+        # wait until the editor has finished writing, multiple events cause one reload
+        if self._reloadTimeout is None:
+            self._reloadTimeout = GLib.timeout_add_seconds(1, self._reload_timeout)
+
+    def _reload_timeout(self):
+        self._reloadTimeout = None
+        logging.info("%s changed" % settings.PATH_CONFIG_USER)
+        self._reload_settings()
+        return False
+
+    def _reload_settings(self):
+        """
+        Read the config files again. Called from the main loop, so the new values are used from the next update on.
+        """
+        logging.info("> Reloading config files")
+        changed = settings.reload()
+        if changed is None:
+            return
+        logging.info("|- %d value(s) changed" % len(changed))
+        with self._dbusservice as bus:
+            bus["/Diagnostics/ConfigReloads"] += 1
+            bus["/Diagnostics/RestartRequired"] = int(any(name in settings.RESTART_REQUIRED for name in changed))
+        if self._cellStatistics is not None:
+            self._cellStatistics.low = settings.MIN_CELL_VOLTAGE
+            self._cellStatistics.high = settings.MAX_CELL_VOLTAGE
+        if self._running:
+            self._check_battery_curves()
+
+    # #######################################################################
+    # #######################################################################
+    # ## fast path of the charge/discharge limits between regular updates ###
+    # #######################################################################
+    # #######################################################################
+
+    def _cell_overvoltage(self, service):
+        """
+        :param service: dbus service of the battery
+        :return: sum of the voltages of all cells above MAX_CELL_VOLTAGE
+        """
+        cellOvervoltage = 0
+        for j in range(settings.NR_OF_CELLS_PER_BATTERY):
+            cellVoltage = self._dbusMon.dbusmon.get_value(service, "/Voltages/Cell%d" % (j + 1))
+            if cellVoltage > settings.MAX_CELL_VOLTAGE:
+                cellOvervoltage += cellVoltage - settings.MAX_CELL_VOLTAGE
+        return cellOvervoltage
+
+    def _capacity_share(self, batteries) -> float:
+        """
+        Share of the aggregated batteries in the installed capacity of the whole bank, to scale the current limits
+        to the remaining batteries, if some are excluded.
+
+        :param batteries: {name: service} of the aggregated batteries
+        :return: share between 0 and 1, 1 if the capacities are not known yet
+        """
+        bank = sum(self._batteryCapacity.values())
+        if bank <= 0:
+            return 1.0
+        return sum(self._batteryCapacity.get(name, 0) for name in batteries) / bank
+
+    def _limit_factor(self, batteries, cellVoltage, curve, curvesPerBattery, path):
+        """
+        :param batteries: {name: dbus service} of the aggregated batteries
+        :param cellVoltage: max./min. cell voltage of all batteries
+        :param curve: compiled curve of the bank, see settings.compile_curves()
+        :param curvesPerBattery: {name: compiled curve} of the batteries with own curve
+        :param path: /System/MaxCellVoltage or /System/MinCellVoltage of the batteries for their own curves
+        :return: factor of the max. charge/discharge current
+        """
+        if not curvesPerBattery:
+            return curve(cellVoltage)
+        dbusmon = self._dbusMon.dbusmon
+        # the voltages of all batteries sharing a curve are evaluated at once
+        voltages = {}
+        for name, service in batteries.items():
+            voltages.setdefault(curvesPerBattery.get(name, curve), []).append(dbusmon.get_value(service, path))
+        # batteries without value, i.e. not published yet, are left out
+        factors = [factor for batteryCurve, values in voltages.items() for factor in batteryCurve.many(values) if factor is not None]
+        return min(factors) if factors else curve(cellVoltage)
+
+    def _check_battery_curves(self):
+        """
+        Warn about own curves of batteries, whose name matches no battery. Called after the discovery and a reload.
+        """
+        for option, curves in (
+            ("BATTERY_CHARGE_CURVES", settings.CHARGE_CURVES_PER_BATTERY),
+            ("BATTERY_DISCHARGE_CURVES", settings.DISCHARGE_CURVES_PER_BATTERY),
+        ):
+            for name in curves:
+                if name in self._batteries_dict:
+                    continue
+                warning = '"%s" in "%s" matches no battery, its curve is not used' % (name, option)
+                if warning not in settings.warnings_in_config:
+                    settings.warnings_in_config.append(warning)
+                    logging.warning(warning)
+
+    def _fast_limits(self, service_name, path, value):
+        """
+        Lower the charge/discharge limits immediately, when a battery publishes a new max./min. cell voltage
+        or starts blocking charge/discharge. Called from the signal handler of the monitor.
+
+        The limits are never raised here, the next _update() calculates all values again.
+        """
+        start = tt.monotonic()
+        if not self._running or self._recoveryTimeout is not None:
+            return
+        batteries = {name: service for name, service in self._batteries_dict.items() if name not in self._excludedBatteries}
+        services = list(batteries.values())
+        if service_name not in services:
+            return
+
+        dbusmon = self._dbusMon.dbusmon
+        limits = {}
+        if any(dbusmon.get_value(service, "/System/NrOfModulesBlockingCharge") for service in services):
+            limits["/Info/MaxChargeCurrent"] = 0
+        if any(dbusmon.get_value(service, "/System/NrOfModulesBlockingDischarge") for service in services):
+            limits["/Info/MaxDischargeCurrent"] = 0
+
+        if settings.OWN_CHARGE_PARAMETERS:
+            MaxCellVoltage = self._fn._max([dbusmon.get_value(service, "/System/MaxCellVoltage") for service in services])
+            MinCellVoltage = self._fn._min([dbusmon.get_value(service, "/System/MinCellVoltage") for service in services])
             try:
-                # Try to get the value to check if it exists
-                test_item = VeDbusItemImport(self._dbusConn, self._settings, self.SETTINGS_PATH, createsignal=False)
-                setting_exists = test_item.exists
-            except Exception:
-                setting_exists = False
-
-            # If setting doesn't exist, create it using AddSetting D-Bus method
-            if not setting_exists:
-                logging.info(f"Setting {self.SETTINGS_PATH} doesn't exist, creating it...")
-                try:
-                    settings_obj = self._dbusConn.get_object(self._settings, "/Settings")
-                    settings_iface = dbus.Interface(settings_obj, "com.victronenergy.Settings")
-                    # AddSetting(group, name, default_value, type, min, max)
-                    # type 's' = string, empty string for group means root /Settings/
-                    settings_iface.AddSetting("", self.SETTINGS_PATH_SHORT, value, "s", "", "")
-                    logging.info(f"Successfully created setting {self.SETTINGS_PATH}")
-                except dbus.exceptions.DBusException as e:
-                    logging.warning(f"Failed to create setting via AddSetting: {e}")
-                    # Setting might already exist, continue to try setting it
-
-            # Now set the value using VeDbusItemImport directly (bypasses dbusmonitor)
-            setting_item = VeDbusItemImport(self._dbusConn, self._settings, self.SETTINGS_PATH, createsignal=False)
-            result = setting_item.set_value(value)
-
-            if result == 0:
-                logging.info(f'CustomName successfully changed to "{value}"')
-                return value
-            else:
-                logging.warning(f'CustomName change to "{value}" failed with result: {result}')
-                return False
+                if MaxCellVoltage is not None:
+                    limits.setdefault(
+                        "/Info/MaxChargeCurrent",
+                        settings.MAX_CHARGE_CURRENT
+                        * self._capacity_share(batteries)
+                        * self._limit_factor(batteries, MaxCellVoltage, settings.CHARGE_CURVE, settings.CHARGE_CURVES_PER_BATTERY, "/System/MaxCellVoltage"),
+                    )
+                    if MaxCellVoltage >= settings.MAX_CELL_VOLTAGE:
+                        # same reduction as the dynamic CVL reduction in _update()
+                        limits["/Info/MaxChargeVoltage"] = min(
+                            dbusmon.get_value(service, "/Voltages/Sum") - self._cell_overvoltage(service) for service in services
+                        )
+                if MinCellVoltage is not None:
+                    if MinCellVoltage <= settings.MIN_CELL_VOLTAGE:
+                        # the hysteresis of the discharge is left to _update()
+                        limits["/Info/MaxDischargeCurrent"] = 0
+                    else:
+                        limits.setdefault(
+                            "/Info/MaxDischargeCurrent",
+                            settings.MAX_DISCHARGE_CURRENT
+                            * self._capacity_share(batteries)
+                            * self._limit_factor(
+                                batteries, MinCellVoltage, settings.DISCHARGE_CURVE, settings.DISCHARGE_CURVES_PER_BATTERY, "/System/MinCellVoltage"
+                            ),
+                        )
+            except TypeError:
+                # a cell voltage or voltage sum is None, the regular update handles the battery
+                pass
 
-        except Exception:
-            (
-                exception_type,
-                exception_object,
-                exception_traceback,
-            ) = sys.exc_info()
-            file = exception_traceback.tb_frame.f_code.co_filename
-            line = exception_traceback.tb_lineno
-            logging.warning(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
-            return False
+        lowered = {limit_path: limit for limit_path, limit in limits.items() if self._dbusservice[limit_path] is None or limit < self._dbusservice[limit_path]}
+        if not lowered:
+            return
+        with self._dbusservice as bus:
+            for limit_path, limit in lowered.items():
+                bus[limit_path] = limit
+        latency = (tt.monotonic() - start) * 1000
+        with self._dbusservice as bus:
+            bus["/Diagnostics/FastPathLatency"] = round(latency, 3)
+            bus["/Diagnostics/FastPathUpdates"] += 1
+        logging.debug("Fast path: %s lowered %.3f ms after %s of %s changed" % (lowered, latency, path, service_name))
+
+    # #####################################################################
+    # #####################################################################
+    # ## lowest and highest values of all cells and temperature sensors ###
+    # #####################################################################
+    # #####################################################################
+
+    def _publish_extremes(self, bus, kind, index):
+        """
+        Publish the EXTREMES_TOP_K lowest and highest values of the index with the names of the batteries.
+
+        :param bus: VeDbusService of the virtual battery
+        :param kind: "Cell" or "Temperature"
+        :param index: ExtremesIndex of the kind
+        """
+        # the unique battery names, a custom name may be missing or used twice
+        names = {service: name for name, service in self._batteries_dict.items()}
+        for extreme, values in (("Lowest", index.lowest(settings.EXTREMES_TOP_K)), ("Highest", index.highest(settings.EXTREMES_TOP_K))):
+            for rank in range(1, settings.EXTREMES_TOP_K + 1):
+                if rank <= len(values):
+                    value, service, path = values[rank - 1]
+                    bus["/Extremes/%s%s%d" % (extreme, kind, rank)] = value
+                    bus["/Extremes/%s%s%dId" % (extreme, kind, rank)] = "%s: %s" % (names.get(service, service), path.rsplit("/", 1)[1])
+                else:
+                    bus["/Extremes/%s%s%d" % (extreme, kind, rank)] = None
+                    bus["/Extremes/%s%s%dId" % (extreme, kind, rank)] = None
+
+    # ################################################################
+    # ################################################################
+    # ## Coulomb counter fed by each change of the battery current ###
+    # ################################################################
+    # ################################################################
+
+    def _victron_current(self, current_ve, current_shunts) -> float:
+        """
+        :param current_ve: sum of the currents of MultiPlus/Quattro and MPPTs
+        :param current_shunts: sum of the signed currents of the SmartShunts
+        :return: battery current measured by the Victron devices
+        """
+        # When a battery-mode SmartShunt is configured to be the
+        # authoritative bank-current source (`SMARTSHUNT_AS_BATTERY_CURRENT`
+        # = True), use current_shunts directly and ignore the Quattro+MPPT
+        # sum. This is the right choice for setups where the SmartShunt is
+        # wired in-line with the bank — its reading already includes the
+        # Multi/MPPT contributions, so adding them again would double-count.
+        # Falls through to the original additive behaviour when the flag
+        # is False (default) or no battery-mode shunt is in the list.
+        if settings.SMARTSHUNT_AS_BATTERY_CURRENT and self._num_battery_shunts > 0:
+            return current_shunts
+        if settings.INVERT_SMARTSHUNTS:
+            return current_ve - current_shunts
+        return current_ve + current_shunts
+
+    def _current_changed(self, service_name, path, value):
+        """
+        Value listener of /Dc/0/Current, feeds the battery current to the Coulomb counter between the updates.
+        """
+        if not self._running or self._recoveryTimeout is not None:
+            return
+        # the same source as in _update(): the Victron devices, if all of their currents are valid, else the BMS
+        if (
+            self._currents is not None
+            and not self._currents.faults("ve", settings.CURRENT_STALE_TIME)
+            and not self._currents.faults("shunts", settings.CURRENT_STALE_TIME)
+        ):
+            if service_name not in self._currents:
+                return
+            self._coulomb_sample(self._victron_current(self._currents.total("ve"), self._currents.total("shunts")), "Victron")
+        else:
+            if service_name not in self._batteries_dict.values():
+                return
+            dbusmon = self._dbusMon.dbusmon
+            currents = [dbusmon.get_value(service, "/Dc/0/Current") for name, service in self._batteries_dict.items() if name not in self._excludedBatteries]
+            if not currents or None in currents:
+                return
+            self._coulomb_sample(sum(currents), "BMS")
+
+    def _coulomb_sample(self, current, source):
+        """
+        Feed the current to the Coulomb counter. When the source changes, the time since the last sample is not counted,
+        so no segment is integrated between a current of the Victron devices and one of the BMS.
+
+        :param current: battery current in A
+        :param source: "Victron" or "BMS"
+        """
+        if source != self._coulombSource:
+            if self._coulombSource is not None:
+                logging.info(
+                    "Coulomb counter: current taken from %s instead of %s, the time since the last sample is not counted" % (source, self._coulombSource)
+                )
+            self._coulomb.reset()
+            self._coulombSource = source
+        self._coulomb.sample(current, settings.BATTERY_EFFICIENCY)
+
+    # #########################################
+    # #########################################
+    # ## saving the state files before exit ###
+    # #########################################
+    # #########################################
+
+    def shutdown(self):
+        """
+        Write the current charge and all pending state files regardless of the budget. Called on SIGTERM/SIGINT.
+
+        :return: True, if all files are written
+        """
+        self._ownCharge_old = self._ownCharge
+        self._save_state()
+        if self._cellStatistics is not None:
+            self._save_cell_statistics()
+        logging.info("> Writing %d state file(s)" % self._persistence.pending)
+        return self._persistence.flush()
 
     # #################################################################################
     # #################################################################################
@@ -805,10 +1873,15 @@ class DbusAggBatService(object):
     # #################################################################################
 
     def _update(self):
+        # aggregation paused, while a used device except of a battery is missing
+        if self._recoveryTimeout is not None:
+            return True
 
         # DC
         Voltage = 0
         Current = 0
+        # source of the current, replaced by "Victron" if the current of the Victron devices is used
+        CurrentSource = "BMS"
         Power = 0
 
         # Capacity
@@ -839,28 +1912,11 @@ class DbusAggBatService(object):
         VoltagesSum_dict = {}
         chargeVoltageReduced_list = []
 
-        # Alarms
-        # lists to find maxima
-        LowVoltage_alarm_list = []
-        HighVoltage_alarm_list = []
-        LowCellVoltage_alarm_list = []
-        HighCellVoltage_alarm_list = []
-        LowSoc_alarm_list = []
-        HighChargeCurrent_alarm_list = []
-        HighDischargeCurrent_alarm_list = []
-        CellImbalance_alarm_list = []
-        InternalFailure_alarm_list = []
-        HighChargeTemperature_alarm_list = []
-        LowChargeTemperature_alarm_list = []
-        HighTemperature_alarm_list = []
-        LowTemperature_alarm_list = []
-        BmsCable_alarm_list = []
-
         # Charge/discharge parameters
 
-        # the minimum of MaxChargeCurrent * NR_OF_BATTERIES to be transmitted
+        # the minimum of MaxChargeCurrent * number of aggregated batteries to be transmitted
         MaxChargeCurrent_list = []
-        # the minimum of MaxDischargeCurrent * NR_OF_BATTERIES to be transmitted
+        # the minimum of MaxDischargeCurrent * number of aggregated batteries to be transmitted
         MaxDischargeCurrent_list = []
         # if some cells are above MAX_CELL_VOLTAGE, store here the sum of differences for each battery
         MaxChargeVoltage_list = []
@@ -878,7 +1934,21 @@ class DbusAggBatService(object):
         ####################################################
 
         try:
-            for i in self._batteries_dict:
+            # degraded mode: batteries with missing or stale values are left out,
+            # the read trials only count cycles without any battery to aggregate
+            step = "Select batteries"
+            i = None
+            batteries = self._select_batteries()
+            if not batteries:
+                raise ValueError("No battery with complete and fresh values")
+            self._alarms.select(batteries.values())
+            if self._cellExtremes is not None:
+                self._cellExtremes.select(batteries.values())
+                self._temperatureExtremes.select(batteries.values())
+            if self._cellStatistics is not None:
+                self._cellStatistics.select(batteries)
+
+            for i in batteries:
 
                 # DC
                 # to detect error
@@ -911,7 +1981,9 @@ class DbusAggBatService(object):
 
                 # Capacity
                 step = "Read and calculate capacity, SoC, Time to go"
-                InstalledCapacity += self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/InstalledCapacity")
+                installed_capacity_get = self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/InstalledCapacity")
+                InstalledCapacity += installed_capacity_get
+                self._batteryCapacity[i] = installed_capacity_get
 
                 if not settings.OWN_SOC:
                     if settings.CAN_batteries:
@@ -1011,32 +2083,10 @@ class DbusAggBatService(object):
                 for j in range(settings.NR_OF_CELLS_PER_BATTERY):
                     cellVoltages_dict["%s_Cell%d" % (i, j + 1)] = self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Voltages/Cell%d" % (j + 1))
 
-                # Alarms
-                step = "Read alarms"
-                LowVoltage_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/LowVoltage"))
-                HighVoltage_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/HighVoltage"))
-                LowCellVoltage_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/LowCellVoltage"))
-                HighCellVoltage_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/HighCellVoltage"))
-                LowSoc_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/LowSoc"))
-                HighChargeCurrent_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/HighChargeCurrent"))
-                HighDischargeCurrent_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/HighDischargeCurrent"))
-                CellImbalance_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/CellImbalance"))
-                InternalFailure_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/InternalFailure"))
-                HighChargeTemperature_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/HighChargeTemperature"))
-                LowChargeTemperature_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/LowChargeTemperature"))
-                HighTemperature_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/HighTemperature"))
-                LowTemperature_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/LowTemperature"))
-                BmsCable_alarm_list.append(self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Alarms/BmsCable"))
-
                 # calculate reduction of charge voltage as sum of overvoltages of all cells
                 if settings.OWN_CHARGE_PARAMETERS:
                     step = "Calculate CVL reduction"
-                    cellOvervoltage = 0
-                    for j in range(settings.NR_OF_CELLS_PER_BATTERY):
-                        cellVoltage = self._dbusMon.dbusmon.get_value(self._batteries_dict[i], "/Voltages/Cell%d" % (j + 1))
-                        if cellVoltage > settings.MAX_CELL_VOLTAGE:
-                            cellOvervoltage += cellVoltage - settings.MAX_CELL_VOLTAGE
-                    chargeVoltageReduced_list.append(VoltagesSum_dict[i] - cellOvervoltage)
+                    chargeVoltageReduced_list.append(VoltagesSum_dict[i] - self._cell_overvoltage(self._batteries_dict[i]))
 
                 # Aggregate charge/discharge parameters
                 else:
@@ -1100,43 +2150,28 @@ class DbusAggBatService(object):
             file = exception_traceback.tb_frame.f_code.co_filename
             line = exception_traceback.tb_lineno
             locals_at_error = exception_traceback.tb_frame.f_locals
-            logging.error(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
-            logging.error(f"Local variables at error: {locals_at_error}")
-            logging.error("Occured during step %s, Battery %s." % (step, i))
-            logging.error("Read trial nr. %d" % self._readTrials)
+            # logged until the limits are held, not on every cycle while no battery delivers values
+            if self._readTrials <= settings.READ_TRIALS:
+                logging.error(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+                logging.error(f"Local variables at error: {locals_at_error}")
+                logging.error("Occured during step %s, Battery %s." % (step, i))
+                logging.error("Read trial nr. %d" % self._readTrials)
             self._readTrials += 1
             if self._readTrials > settings.READ_TRIALS:
-                logging.error("DBus read failed. Exiting...")
-                tt.sleep(settings.TIME_BEFORE_RESTART)
-                sys.exit(1)
-            else:
-                # next call allowed
-                return True
+                self._hold_safe_limits("DBus read failed %d times" % settings.READ_TRIALS)
+            # next call allowed
+            return True
 
         #####################################################
         # Process collected values (except of dictionaries) #
         #####################################################
 
-        # averaging
-        Voltage = Voltage / settings.NR_OF_BATTERIES
-        Temperature = Temperature / settings.NR_OF_BATTERIES
-        VoltagesSum = sum(VoltagesSum_dict.values()) / settings.NR_OF_BATTERIES
-
-        # find max in alarms
-        LowVoltage_alarm = self._fn._max(LowVoltage_alarm_list)
-        HighVoltage_alarm = self._fn._max(HighVoltage_alarm_list)
-        LowCellVoltage_alarm = self._fn._max(LowCellVoltage_alarm_list)
-        HighCellVoltage_alarm = self._fn._max(HighCellVoltage_alarm_list)
-        LowSoc_alarm = self._fn._max(LowSoc_alarm_list)
-        HighChargeCurrent_alarm = self._fn._max(HighChargeCurrent_alarm_list)
-        HighDischargeCurrent_alarm = self._fn._max(HighDischargeCurrent_alarm_list)
-        CellImbalance_alarm = self._fn._max(CellImbalance_alarm_list)
-        InternalFailure_alarm = self._fn._max(InternalFailure_alarm_list)
-        HighChargeTemperature_alarm = self._fn._max(HighChargeTemperature_alarm_list)
-        LowChargeTemperature_alarm = self._fn._max(LowChargeTemperature_alarm_list)
-        HighTemperature_alarm = self._fn._max(HighTemperature_alarm_list)
-        LowTemperature_alarm = self._fn._max(LowTemperature_alarm_list)
-        BmsCable_alarm = self._fn._max(BmsCable_alarm_list)
+        # averaging over the aggregated batteries
+        Voltage = Voltage / len(batteries)
+        Temperature = Temperature / len(batteries)
+        VoltagesSum = sum(VoltagesSum_dict.values()) / len(batteries)
+        # capacity of the whole bank including excluded batteries, used by the own Coulomb counter
+        BankCapacity = sum(self._batteryCapacity.values())
 
         # find max. charge voltage (if needed)
         if not settings.OWN_CHARGE_PARAMETERS:
@@ -1150,8 +2185,9 @@ class DbusAggBatService(object):
                 MaxChargeCurrent = sum(MaxChargeCurrent_list)
                 MaxDischargeCurrent = sum(MaxDischargeCurrent_list)
             else:
-                MaxChargeCurrent = self._fn._min(MaxChargeCurrent_list) * settings.NR_OF_BATTERIES
-                MaxDischargeCurrent = self._fn._min(MaxDischargeCurrent_list) * settings.NR_OF_BATTERIES
+                # scaled to the capacity of the remaining batteries, if some are excluded
+                MaxChargeCurrent = self._fn._min(MaxChargeCurrent_list) * settings.NR_OF_BATTERIES * self._capacity_share(batteries)
+                MaxDischargeCurrent = self._fn._min(MaxDischargeCurrent_list) * settings.NR_OF_BATTERIES * self._capacity_share(batteries)
 
         AllowToCharge = self._fn._min(AllowToCharge_list)
         AllowToDischarge = self._fn._min(AllowToDischarge_list)
@@ -1163,100 +2199,49 @@ class DbusAggBatService(object):
 
         if settings.CURRENT_FROM_VICTRON:
             success = True
-            # variable to accumulate currents measured by Victron stuff (i.e. MultiPlus/Quattro, SmartShunts, MPPTs)
-            Current_VE = 0
-            try:
-                # Read MultiPlus/Quattro data only when one is used and has been found
-                # MultiPlus/Quattro `Connected` value will go to 0 if it exists but is switch off (VE-BUS remains connected)
-                # by the user (either via Digital Multi Control, Cerbo, VRM, or the device itself)
-                if self._multi is not None:
-                    Multi_Connected = self._dbusMon.dbusmon.get_value(self._multi, "/Connected")
-                    # Read current only when MultiPlus/Quattro is connected
-                    if Multi_Connected > 0:
-                        # get DC current of multiPlus/quattro (or system of them)
-                        Current_VE = self._dbusMon.dbusmon.get_value(self._multi, "/Dc/0/Current")
-                        # Output to log that MultiPlus/Quattro is connected again
-                        if not self._multi_connected:
-                            logging.info("MultiPlus/Quattro is connected")
-                        self._multi_connected = True  # keep track of state to notice if state changes at next round
-                    else:
-                        # Output to log when MultiPlus/Quattro state changed from connected (at last read) to not connected
-                        if self._multi_connected:
-                            logging.info("MultiPlus/Quattro is not connected")
-                        self._multi_connected = False  # keep track of state to notice if state changes at next round
-
-                for i in range(settings.NR_OF_MPPTS):
-                    # add DC current of all MPPTs (if present)
-                    Current_VE += self._dbusMon.dbusmon.get_value(self._mppts_list[i], "/Dc/0/Current")
-
-            except Exception:
-                (
-                    exception_type,
-                    exception_object,
-                    exception_traceback,
-                ) = sys.exc_info()
-                file = exception_traceback.tb_frame.f_code.co_filename
-                line = exception_traceback.tb_lineno
-                logging.debug(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
-
+            # the currents measured by Victron stuff (i.e. MultiPlus/Quattro, SmartShunts, MPPTs) are summed up
+            # by the registry whenever they change, see currents.py
+            # MultiPlus/Quattro `Connected` value will go to 0 if it exists but is switch off (VE-BUS remains connected)
+            # by the user (either via Digital Multi Control, Cerbo, VRM, or the device itself)
+            if self._multi is not None:
+                if self._currents.connected(self._multi):
+                    # Output to log that MultiPlus/Quattro is connected again
+                    if not self._multi_connected:
+                        logging.info("MultiPlus/Quattro is connected")
+                    self._multi_connected = True  # keep track of state to notice if state changes at next round
+                else:
+                    # Output to log when MultiPlus/Quattro state changed from connected (at last read) to not connected
+                    if self._multi_connected:
+                        logging.info("MultiPlus/Quattro is not connected")
+                    self._multi_connected = False  # keep track of state to notice if state changes at next round
+
+            # MultiPlus/Quattro and MPPTs
+            faults = self._currents.faults("ve", settings.CURRENT_STALE_TIME)
+            if faults:
+                for service, reason in faults:
+                    logging.debug("%s %s" % (service, reason))
                 success = False
+            Current_VE = self._currents.total("ve")
 
-            Current_SHUNTS = 0
-            try:
-                # go over all SmartShunts
-                for i in range(len(self._smartShunt_list)):
-                    shunt_current = self._dbusMon.dbusmon.get_value(self._smartShunt_list[i], "/Dc/0/Current")
-                    if shunt_current is None:
-                        raise ValueError(f"SmartShunt {self._smartShunt_list[i]} returns None as current")
-
-                    # SmartShunt is monitored as a battery
-                    if i < self._num_battery_shunts:
-                        Current_SHUNTS += shunt_current
-                    # SmartShunt is in DC metering mode
-                    else:
-                        Current_SHUNTS -= shunt_current
-
-            except Exception as err:
-                (
-                    exception_type,
-                    exception_object,
-                    exception_traceback,
-                ) = sys.exc_info()
-                file = exception_traceback.tb_frame.f_code.co_filename
-                line = exception_traceback.tb_lineno
-                logging.debug(f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
-
-                logging.error("Error during SmartShunt polling: %s" % (err))
+            # SmartShunts, monitored as a battery are added, in DC metering mode subtracted
+            faults = self._currents.faults("shunts", settings.CURRENT_STALE_TIME)
+            if faults:
+                for service, reason in faults:
+                    logging.error("Error during SmartShunt polling: SmartShunt %s %s" % (service, reason))
                 if settings.IGNORE_SMARTSHUNT_ABSENCE:
                     success = False
-                    pass
                 else:
                     self._readTrials += 1
                     if self._readTrials > settings.READ_TRIALS:
-                        tt.sleep(settings.TIME_BEFORE_RESTART)
-                        sys.exit(1)
-                    else:
-                        # next call allowed
-                        return True
+                        self._hold_safe_limits("SmartShunt polling failed %d times" % settings.READ_TRIALS)
+                    # next call allowed
+                    return True
+            Current_SHUNTS = self._currents.total("shunts")
 
             if success:
-                # When a battery-mode SmartShunt is configured to be the
-                # authoritative bank-current source (`SMARTSHUNT_AS_BATTERY_CURRENT`
-                # = True), use Current_SHUNTS directly and ignore the Quattro+MPPT
-                # sum. This is the right choice for setups where the SmartShunt is
-                # wired in-line with the bank — its reading already includes the
-                # Multi/MPPT contributions, so adding them again would double-count.
-                # Falls through to the original additive behaviour when the flag
-                # is False (default) or no battery-mode shunt is in the list.
-                if settings.SMARTSHUNT_AS_BATTERY_CURRENT and self._num_battery_shunts > 0:
-                    Current = Current_SHUNTS
-                else:
-                    if settings.INVERT_SMARTSHUNTS:
-                        Current_VE -= Current_SHUNTS
-                    else:
-                        Current_VE += Current_SHUNTS
-                    # BMS current overwritten only if no exception raised
-                    Current = Current_VE
+                # BMS current overwritten only if no exception raised
+                Current = self._victron_current(Current_VE, Current_SHUNTS)
+                CurrentSource = "Victron"
                 # calculate own power (not read from BMS)
                 Power = Voltage * Current
             else:
@@ -1302,7 +2287,6 @@ class DbusAggBatService(object):
                     if Voltage <= CVL_NORMAL:
                         self._balancing = 0
                         self._lastBalancing = int((dt.now()).strftime("%j"))
-                        _write_atomic(_STATE_FILE_BALANCING, "%s" % self._lastBalancing)
                         logging.info("CVL increase for balancing de-activated")
 
                 if self._balancing == 0:
@@ -1310,13 +2294,12 @@ class DbusAggBatService(object):
 
             # if normal charging voltage is 100% SoC and balancing is finished
             elif (time_unbalanced > 0) and (Voltage >= CVL_BALANCING) and ((MaxCellVoltage - MinCellVoltage) < settings.CELL_DIFF_MAX):
-                logging.info("Balancing goal reached with full charging set as normal. Updating storedvalue_last_balancing file")
+                logging.info("Balancing goal reached with full charging set as normal. Saving the day of the last balancing")
                 self._lastBalancing = int((dt.now()).strftime("%j"))
-                _write_atomic(_STATE_FILE_BALANCING, "%s" % self._lastBalancing)
 
             if Voltage >= CVL_BALANCING:
                 # reset Coulumb counter to 100%
-                self._ownCharge = InstalledCapacity
+                self._ownCharge = BankCapacity
 
             # manage dynamic CVL reduction
             if MaxCellVoltage >= settings.MAX_CELL_VOLTAGE:
@@ -1333,7 +2316,7 @@ class DbusAggBatService(object):
                         )
 
                         # disable DC-coupled PV feed-in
-                        self._dbusMon.dbusmon.set_value(
+                        self._dbusMon.writes.write(
                             "com.victronenergy.settings",
                             "/Settings/CGwacs/OvervoltageFeedIn",
                             0,
@@ -1356,7 +2339,7 @@ class DbusAggBatService(object):
                     if (MaxCellVoltage - MinCellVoltage) < settings.CELL_DIFF_MAX:
 
                         # re-enable DC-feed if it was enabled before
-                        self._dbusMon.dbusmon.set_value(
+                        self._dbusMon.writes.write(
                             "com.victronenergy.settings",
                             "/Settings/CGwacs/OvervoltageFeedIn",
                             self._DCfeedActive,
@@ -1378,10 +2361,16 @@ class DbusAggBatService(object):
             if NrOfModulesBlockingCharge > 0:
                 MaxChargeCurrent = 0
             else:
-                MaxChargeCurrent = settings.MAX_CHARGE_CURRENT * self._fn._interpolate(
-                    settings.CELL_CHARGE_LIMITING_VOLTAGE,
-                    settings.CELL_CHARGE_LIMITED_CURRENT,
-                    MaxCellVoltage,
+                MaxChargeCurrent = (
+                    settings.MAX_CHARGE_CURRENT
+                    * self._capacity_share(batteries)
+                    * self._limit_factor(
+                        batteries,
+                        MaxCellVoltage,
+                        settings.CHARGE_CURVE,
+                        settings.CHARGE_CURVES_PER_BATTERY,
+                        "/System/MaxCellVoltage",
+                    )
                 )
 
             # manage discharge current
@@ -1393,10 +2382,16 @@ class DbusAggBatService(object):
             if (NrOfModulesBlockingDischarge > 0) or (self._fullyDischarged):
                 MaxDischargeCurrent = 0
             else:
-                MaxDischargeCurrent = settings.MAX_DISCHARGE_CURRENT * self._fn._interpolate(
-                    settings.CELL_DISCHARGE_LIMITING_VOLTAGE,
-                    settings.CELL_DISCHARGE_LIMITED_CURRENT,
-                    MinCellVoltage,
+                MaxDischargeCurrent = (
+                    settings.MAX_DISCHARGE_CURRENT
+                    * self._capacity_share(batteries)
+                    * self._limit_factor(
+                        batteries,
+                        MinCellVoltage,
+                        settings.DISCHARGE_CURVE,
+                        settings.DISCHARGE_CURVES_PER_BATTERY,
+                        "/System/MinCellVoltage",
+                    )
                 )
 
         # SoC resetting if OWN_SOC = True and OWN_CHARGE_PARAMETERS = False
@@ -1404,7 +2399,7 @@ class DbusAggBatService(object):
             if settings.OWN_SOC:
                 # reset Coulumb counter to 100%
                 if MaxCellVoltage >= settings.MAX_CELL_VOLTAGE_SOC_FULL:
-                    self._ownCharge = InstalledCapacity
+                    self._ownCharge = BankCapacity
                 if (MinCellVoltage <= settings.MIN_CELL_VOLTAGE_SOC_EMPTY) and settings.ZERO_SOC:
                     # reset Coulumb counter to 0%
                     self._ownCharge = 0
@@ -1413,27 +2408,27 @@ class DbusAggBatService(object):
         # own Coulomb counter (runs even the BMS values are used) #
         ###########################################################
 
-        deltaTime = tt.time() - self._timeOld
-        self._timeOld = tt.time()
-        if Current > 0:
-            # charging (with efficiency)
-            self._ownCharge += Current * (deltaTime / 3600) * settings.BATTERY_EFFICIENCY
-        else:
-            # discharging
-            self._ownCharge += Current * (deltaTime / 3600)
+        # the charge between the updates is counted by _current_changed(), charging with efficiency
+        self._coulomb_sample(Current, CurrentSource)
+        self._ownCharge += self._coulomb.take()
         self._ownCharge = max(self._ownCharge, 0)
-        self._ownCharge = min(self._ownCharge, InstalledCapacity)
-
-        # store the charge into text file if changed significantly (avoid frequent file access)
-        if abs(self._ownCharge - self._ownCharge_old) >= (settings.CHARGE_SAVE_PRECISION * InstalledCapacity):
-            _write_atomic(_STATE_FILE_CHARGE, "%.3f" % self._ownCharge)
+        self._ownCharge = min(self._ownCharge, BankCapacity)
+
+        # store the charge into text file if changed significantly or not saved for CHARGE_SAVE_INTERVAL (avoid frequent file access)
+        chargeDelta = abs(self._ownCharge - self._ownCharge_old)
+        chargeAge = tt.monotonic() - self._chargeSaved
+        if chargeDelta >= (settings.CHARGE_SAVE_PRECISION * BankCapacity) or (
+            chargeDelta > 0 and settings.CHARGE_SAVE_INTERVAL > 0 and chargeAge >= settings.CHARGE_SAVE_INTERVAL
+        ):
             self._ownCharge_old = self._ownCharge
+            self._chargeSaved = tt.monotonic()
+        self._save_state()
 
         # overwrite BMS charge values
         if settings.OWN_SOC:
             Capacity = self._ownCharge
-            Soc = 100 * self._ownCharge / InstalledCapacity
-            ConsumedAmphours = -InstalledCapacity + self._ownCharge  # zero if fully charged, otherwise negative
+            Soc = 100 * self._ownCharge / BankCapacity
+            ConsumedAmphours = -BankCapacity + self._ownCharge  # zero if fully charged, otherwise negative
             if (self._dbusMon.dbusmon.get_value("com.victronenergy.system", "/SystemState/LowSoc") == 0) and (Current < 0):
                 TimeToGo = -3600 * self._ownCharge / Current
             else:
@@ -1485,28 +2480,33 @@ class DbusAggBatService(object):
                 for cellId, currentCell in enumerate(cellVoltages_dict):
                     bus["/Voltages/%s" % (re.sub("[^A-Za-z0-9_]+", "", currentCell))] = cellVoltages_dict[currentCell]
 
+            # send the lowest and highest cell voltages and temperatures, the indexes are updated on each change
+            if self._cellExtremes is not None:
+                self._publish_extremes(bus, "Cell", self._cellExtremes)
+                self._publish_extremes(bus, "Temperature", self._temperatureExtremes)
+                spread = self._cellExtremes.spread()
+                bus["/Extremes/CellVoltageSpread"] = None if spread is None else round(spread, 3)
+                bus["/Extremes/TemperatureSpread"] = self._temperatureExtremes.spread()
+
+            # send the summary of the cell statistics, the statistics are updated on each change of a cell voltage
+            if self._cellStatistics is not None and tt.monotonic() - self._cellStatisticsPublished >= settings.CELL_STATISTICS_INTERVAL:
+                self._cellStatisticsPublished = tt.monotonic()
+                self._publish_cell_statistics(bus)
+
             # send battery state
             bus["/System/NrOfCellsPerBattery"] = settings.NR_OF_CELLS_PER_BATTERY
             bus["/System/NrOfModulesOnline"] = NrOfModulesOnline
-            bus["/System/NrOfModulesOffline"] = NrOfModulesOffline
+            bus["/System/NrOfModulesOffline"] = NrOfModulesOffline + len(self._excludedBatteries)
             bus["/System/NrOfModulesBlockingCharge"] = NrOfModulesBlockingCharge
             bus["/System/NrOfModulesBlockingDischarge"] = NrOfModulesBlockingDischarge
 
-            # send alarms
-            bus["/Alarms/LowVoltage"] = LowVoltage_alarm
-            bus["/Alarms/HighVoltage"] = HighVoltage_alarm
-            bus["/Alarms/LowCellVoltage"] = LowCellVoltage_alarm
-            bus["/Alarms/HighCellVoltage"] = HighCellVoltage_alarm
-            bus["/Alarms/LowSoc"] = LowSoc_alarm
-            bus["/Alarms/HighChargeCurrent"] = HighChargeCurrent_alarm
-            bus["/Alarms/HighDischargeCurrent"] = HighDischargeCurrent_alarm
-            bus["/Alarms/CellImbalance"] = CellImbalance_alarm
-            bus["/Alarms/InternalFailure"] = InternalFailure_alarm
-            bus["/Alarms/HighChargeTemperature"] = HighChargeTemperature_alarm
-            bus["/Alarms/LowChargeTemperature"] = LowChargeTemperature_alarm
-            bus["/Alarms/HighTemperature"] = HighTemperature_alarm
-            bus["/Alarms/LowTemperature"] = LowTemperature_alarm
-            bus["/Alarms/BmsCable"] = BmsCable_alarm
+            # send alarms, the max. level of each alarm is updated by the alarm matrix on each change
+            for path in ALARM_PATHS:
+                alarm = self._alarms.maximum(path)
+                if alarm and alarm != bus[path]:
+                    names = [name for name, service in self._batteries_dict.items() if service in self._alarms.raised_by(path)]
+                    logging.warning("%s: level %d raised by %s" % (path, alarm, ", ".join(names)))
+                bus[path] = alarm
 
             # send charge/discharge control
             bus["/Info/MaxChargeCurrent"] = MaxChargeCurrent
@@ -1532,6 +2532,37 @@ class DbusAggBatService(object):
             bus["/Io/AllowToDischarge"] = AllowToDischarge
             bus["/Io/AllowToBalance"] = AllowToBalance
 
+            bus["/Diagnostics/PendingSettingsWrites"] = self._dbusMon.writes.pending
+            bus["/Diagnostics/PersistenceWrites"] = self._persistence.writes
+            bus["/Diagnostics/PersistenceBytes"] = self._persistence.bytes_written
+            bus["/Diagnostics/PendingFileWrites"] = self._persistence.pending
+            bus["/Diagnostics/CoulombSamples"] = self._coulomb.samples
+            bus["/Diagnostics/CoulombError"] = round(self._coulomb.error, 3)
+            if self._persistence.latency is not None:
+                bus["/Diagnostics/PersistenceLatency"] = round(self._persistence.latency * 1000, 3)
+
+            if self._recoveryReappeared is not None:
+                recoveryTime = tt.monotonic() - self._recoveryReappeared
+                self._recoveryReappeared = None
+                bus["/Diagnostics/RecoveryTime"] = round(recoveryTime, 3)
+                bus["/Diagnostics/Recoveries"] += 1
+                logging.info("Fresh values published %.3f s after the devices reappeared" % recoveryTime)
+
+            if self._safeHold is not None:
+                logging.info("Fresh values published, the limits are no longer held at 0 A (%s)" % self._safeHold)
+                self._safeHold = None
+
+            if self._firstFreshValue is None:
+                self._firstFreshValue = tt.monotonic() - self._startTime
+                bus["/Diagnostics/TimeToFirstFreshValue"] = round(self._firstFreshValue, 3)
+                logging.info("First fresh values published %.3f s after start" % self._firstFreshValue)
+
+        if settings.SNAPSHOT_INTERVAL > 0 and tt.time() - self._snapshotSaved >= settings.SNAPSHOT_INTERVAL:
+            self._save_snapshot()
+
+        if self._cellStatistics is not None and tt.monotonic() - self._cellStatisticsSaved >= settings.CELL_STATISTICS_SAVE_INTERVAL:
+            self._save_cell_statistics()
+
         # ##########################################################
         # ################ Periodic logging ########################
         # ##########################################################
@@ -1566,6 +2597,15 @@ def main():
 
     logging.basicConfig(level=settings.LOGGING)
 
+    # time from the process start until here without reading the settings
+    try:
+        startup_phases = {
+            "import": Functions.get_process_age() - settings.LOAD_DURATION,
+            "settings load": settings.LOAD_DURATION,
+        }
+    except Exception:
+        startup_phases = {"settings load": settings.LOAD_DURATION}
+
     logging.info("")
     logging.info("*** Starting dbus-aggregate-batteries ***")
 
@@ -1577,6 +2617,9 @@ def main():
     # show the version of the driver
     logging.info(f"dbus-aggregate-batteries v{VERSION}")
 
+    for warning in settings.warnings_in_config:
+        logging.warning(warning)
+
     # print config errors and exit if there are any
     if settings.errors_in_config:
         logging.error("Errors in config file:")
@@ -1597,27 +2640,23 @@ def main():
 
     from dbus.mainloop.glib import DBusGMainLoop
 
-    # Check if old value files exist, if yes rename them
-    if os.path.isfile("/data/apps/dbus-aggregate-batteries/charge"):
-        os.rename(
-            "/data/apps/dbus-aggregate-batteries/charge",
-            "/data/apps/dbus-aggregate-batteries/storedvalue_charge",
-        )
-        logging.info("Charge file renamed to storedvalue_charge")
-
-    if os.path.isfile("/data/apps/dbus-aggregate-batteries/last_balancing"):
-        os.rename(
-            "/data/apps/dbus-aggregate-batteries/last_balancing",
-            "/data/apps/dbus-aggregate-batteries/storedvalue_last_balancing",
-        )
-        logging.info("Bast_balancing file renamed to storedvalue_last_balancing")
-
     DBusGMainLoop(set_as_default=True)
 
-    DbusAggBatService()
+    service = DbusAggBatService(startup_phases=startup_phases)
 
     logging.info("Connected to DBus, and switching over to GLib.MainLoop()")
     mainloop = GLib.MainLoop()
+
+    # write the state files before the service is stopped
+    def stop(name):
+        logging.info("%s received, exiting..." % name)
+        service.shutdown()
+        mainloop.quit()
+        return False
+
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, stop, "SIGTERM")
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, stop, "SIGINT")
+
     mainloop.run()
 
 
@@ -3,6 +3,9 @@
 import os
 import sys
 import logging
+import time
+from collections import defaultdict, deque
+from functools import partial
 
 # add ext folder to sys.path
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext", "velib_python"))
@@ -10,14 +13,663 @@ sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext", "velib_python"
 # optionally from victron
 # sys.path.insert(1, "/opt/victronenergy/dbus-systemcalc-py/ext/velib_python")
 
-from dbusmonitor import DbusMonitor  # noqa: E402
+from dbusmonitor import AsyncDbusMonitor, ScanProgress, VE_INTERFACE, notfound  # noqa: E402
 from dbus.mainloop.glib import DBusGMainLoop  # noqa: E402
+from ve_utils import add_name_owner_changed_receiver, unwrap_dbus_value  # noqa: E402
+from gi.repository import GLib  # noqa: E402
+import dbus  # noqa: E402
 
-# from gi.repository import GLib  # not accessed
+
+class CompactMonitoredValue:
+    """
+    Slotted replacement for dbusmonitor.MonitoredValue.
+
+    Every monitored path of every service holds one of these, so dropping the
+    per-instance __dict__ is what shrinks the monitor on devices with little RAM.
+    The options are not stored per value, but in a subclass shared by all values
+    with the same options object, see for_options().
+    """
+
+    __slots__ = ("value", "text")
+
+    options = None
+
+    # {id(options): (options, subclass)}, the options are kept to keep their id valid
+    _classes = {}
+
+    def __init__(self, value, text):
+        self.value = value
+        self.text = text
+
+    @classmethod
+    def for_options(cls, options):
+        """
+        :return: subclass with the options as class attribute
+        """
+        entry = cls._classes.get(id(options))
+        if entry is None:
+            entry = cls._classes[id(options)] = (options, type(cls.__name__, (cls,), {"__slots__": (), "options": options}))
+        return entry[1]
+
+    # For legacy code, allow treating this as a tuple/list
+    def __iter__(self):
+        return iter((self.value, self.text, self.options))
+
+
+class CompactService:
+    """
+    Slotted replacement for dbusmonitor.Service with the same interface.
+    """
+
+    __slots__ = ("id", "name", "paths", "_seen", "deviceInstance", "lastUpdate")
+
+    def __init__(self, id, serviceName, deviceInstance):
+        self.id = id
+        self.name = sys.intern(str(serviceName))
+        self.paths = {}
+        self._seen = set()
+        self.deviceInstance = deviceInstance
+        # monotonic time of the last value received from the service
+        self.lastUpdate = time.monotonic()
+
+    # For legacy code, attributes can still be accessed as if keys from a dictionary
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def set_seen(self, path):
+        # the path may be a dbus.String, which can not be interned directly
+        self._seen.add(sys.intern(str(path)))
+
+    def seen(self, path):
+        return path in self._seen
+
+    @property
+    def service_class(self):
+        return ".".join(self.name.split(".")[:3])
+
+
+class AsyncLegacyScan:
+    """
+    Scan of a service which does not support GetItems.
+
+    Does the same as DbusMonitor.scan_dbus_service_legacy(), but all GetValue/GetText
+    requests are sent at once with call_async instead of one blocking call after the other.
+    """
+
+    def __init__(self, monitor, serviceName, serviceId, onfinish):
+        self._monitor = monitor
+        self._serviceName = serviceName
+        self._serviceId = serviceId
+        self._onfinish = onfinish
+        self._deviceInstance = None
+        self._paths = monitor.dbusTree.get(".".join(serviceName.split(".")[0:3]), None)
+        self._values = {}
+        self._texts = {}
+        self._pending = 0
+        self._next_step = None
+        self._failed = False
+
+    def start(self):
+        if self._paths is None:
+            self._finish(False)
+        elif self._serviceName in ("com.victronenergy.settings", "com.victronenergy.platform") or self._serviceName.startswith("com.victronenergy.vecan."):
+            self._device_instance_done(0)
+        else:
+            self._call("/DeviceInstance", "GetValue", self._device_instance_done, self._device_instance_error)
+
+    def _call(self, path, method, reply_handler, error_handler):
+        self._monitor.dbusConn.call_async(self._serviceName, path, VE_INTERFACE, method, "", [], reply_handler, error_handler)
+
+    def _expect(self, count, next_step):
+        self._pending = count
+        self._next_step = next_step
+        if count == 0:
+            next_step()
+
+    def _one_done(self):
+        self._pending -= 1
+        if self._pending == 0:
+            self._next_step()
+
+    def _device_instance_error(self, exc):
+        logging.info("       %s was skipped because it has no device instance" % self._serviceName)
+        self._finish(False)
+
+    def _device_instance_done(self, di):
+        self._deviceInstance = int(di)
+        logging.info("       %s has device instance %s" % (self._serviceName, self._deviceInstance))
+
+        # try to fetch everything in one go
+        self._expect(2, self._bulk_done)
+        self._call("/", "GetValue", partial(self._bulk_reply, self._values), self._bulk_error)
+        self._call("/", "GetText", partial(self._bulk_reply, self._texts), self._bulk_error)
+
+    def _bulk_reply(self, store, items):
+        if isinstance(items, dict):
+            store.update(items)
+        self._one_done()
+
+    def _bulk_error(self, exc):
+        self._one_done()
+
+    def _bulk_done(self):
+        # query the paths individually, which were not part of the bulk fetch
+        missing = [path for path in self._paths if self._values.get(path[1:], notfound) is notfound or self._texts.get(path[1:], notfound) is notfound]
+        self._expect(2 * len(missing), self._paths_done)
+        for path in missing:
+            self._call(path, "GetValue", partial(self._path_reply, self._values, path), partial(self._path_error, self._values, path))
+            self._call(path, "GetText", partial(self._path_reply, self._texts, path), partial(self._path_error, self._texts, path))
+
+    def _path_reply(self, store, path, value):
+        store[path[1:]] = value
+        self._one_done()
+
+    def _path_error(self, store, path, exc):
+        if isinstance(exc, dbus.exceptions.DBusException) and exc.get_dbus_name() in (
+            "org.freedesktop.DBus.Error.ServiceUnknown",
+            "org.freedesktop.DBus.Error.Disconnected",
+        ):
+            self._failed = True
+        elif store is self._values:
+            logging.debug("%s %s does not exist (yet)" % (self._serviceName, path))
+        self._one_done()
+
+    def _paths_done(self):
+        if self._failed:
+            logging.error("Ignoring %s because it disappeared while scanning" % self._serviceName)
+            self._finish(False)
+            return
+
+        monitor = self._monitor
+        service = monitor.make_service(self._serviceId, self._serviceName, self._deviceInstance)
+        for path, options in self._paths.items():
+            value = self._values.get(path[1:], None)
+            text = self._texts.get(path[1:], None)
+            if path[1:] in self._values:
+                service.set_seen(path)
+            service.paths[path] = monitor.make_monitor(service, path, unwrap_dbus_value(value), unwrap_dbus_value(text), options)
+
+        monitor.servicesByName[self._serviceName] = service
+        monitor.servicesById[self._serviceId] = service
+        monitor.servicesByClass[service.service_class].append(service)
+        self._finish(True)
+
+    def _finish(self, success):
+        self._onfinish(self._serviceName, success)
+
+
+# Services with up to this number of monitored paths are not scanned with GetItems, which returns
+# the whole tree of the service (several thousand items for com.victronenergy.settings), but with
+# GetValue requests for the monitored paths only
+TARGETED_SCAN_MAX_PATHS = 8
+
+
+class AsyncTargetedScan:
+    """
+    Scan of a service with only a few monitored paths.
+
+    Instead of GetItems, which unwraps the whole tree of the service, only the monitored
+    paths are requested with GetValue. The result is passed to the monitor in the same
+    format as a GetItems reply.
+    """
+
+    def __init__(self, monitor, serviceName, paths, onfinish, onerror):
+        """
+        :param onfinish: called with the items, or None if the service disappeared while scanning
+        :param onerror: called instead with the exception, if a request failed for another reason
+        """
+        self._monitor = monitor
+        self._serviceName = serviceName
+        self._paths = paths
+        self._onfinish = onfinish
+        self._onerror = onerror
+        self._items = {}
+        self._pending = 0
+        self._failed = False
+        self._exception = None
+
+    def start(self):
+        self._pending = len(self._paths)
+        for path in self._paths:
+            self._monitor.dbusConn.call_async(self._serviceName, path, VE_INTERFACE, "GetValue", "", [], partial(self._reply, path), self._error)
+
+    def _reply(self, path, value):
+        self._items[path] = {"Value": value}
+        self._one_done()
+
+    def _error(self, exc):
+        if isinstance(exc, dbus.exceptions.DBusException) and exc.get_dbus_name() in (
+            "org.freedesktop.DBus.Error.ServiceUnknown",
+            "org.freedesktop.DBus.Error.Disconnected",
+        ):
+            self._failed = True
+        elif self._exception is None:
+            # e.g. NoReply on a busy bus, the value would be missing until it changes
+            self._exception = exc
+        self._one_done()
+
+    def _one_done(self):
+        self._pending -= 1
+        if self._pending > 0:
+            return
+        if self._failed:
+            self._onfinish(None)
+        elif self._exception is not None:
+            self._onerror(self._exception)
+        else:
+            self._onfinish(self._items)
+
+
+class CompactDbusMonitor(AsyncDbusMonitor):
+    """
+    AsyncDbusMonitor storing its services and monitored values in slotted objects.
+
+    The path strings are the keys of the monitor list, which are interned once in DbusMon,
+    and all paths share the options object of the monitor list.
+
+    All services are scanned concurrently, also the ones which need the legacy scan. Services
+    with only a few monitored paths are scanned with targeted GetValue requests.
+    """
+
+    def __init__(self, dbusTree, bus=None, scanCompleteCallback=None, **kwargs):
+        """
+        :param bus: connection to use for everything, if None the monitor opens its own connections like DbusMonitor
+        """
+        # name owners of services, which failed the GetItems request, needed for the legacy scan
+        self._legacyOwners = {}
+        # {path: [callback]}, called synchronously when the value of the path changes
+        self.valueListeners = {}
+        if bus is None:
+            super().__init__(dbusTree, scanCompleteCallback=scanCompleteCallback, **kwargs)
+        else:
+            self._init_shared(dbusTree, bus, scanCompleteCallback, **kwargs)
+
+    def _init_shared(
+        self,
+        dbusTree,
+        bus,
+        scanCompleteCallback,
+        valueChangedCallback=None,
+        deviceAddedCallback=None,
+        deviceRemovedCallback=None,
+        namespace="com.victronenergy",
+        ignoreServices=(),
+    ):
+        # same as DbusMonitor.__init__, which always opens its own connections, but with the given connection
+        self.valueChangedCallback = valueChangedCallback
+        self.deviceAddedCallback = deviceAddedCallback
+        self.deviceRemovedCallback = deviceRemovedCallback
+        self.dbusTree = dbusTree
+        self.ignoreServices = list(ignoreServices)
+        self.servicesByName = {}
+        self.servicesById = {}
+        self.servicesByClass = defaultdict(list)
+        self.serviceWatches = defaultdict(list)
+        self.scanCompleteCallback = scanCompleteCallback
+
+        self.dbusConn = bus
+        add_name_owner_changed_receiver(bus, self.dbus_name_owner_changed, namespace)
+        bus.add_signal_receiver(
+            self.handler_value_changes, dbus_interface=VE_INTERFACE, signal_name="PropertiesChanged", path_keyword="path", sender_keyword="senderId"
+        )
+        bus.add_signal_receiver(self.handler_item_changes, dbus_interface=VE_INTERFACE, signal_name="ItemsChanged", path="/", sender_keyword="senderId")
+
+        logging.info("===== Scanning dbus... =====")
+        self._scan_dbus()
+
+    @staticmethod
+    def make_service(serviceId, serviceName, deviceInstance):
+        return CompactService(serviceId, serviceName, deviceInstance)
+
+    def make_monitor(self, service, path, value, text, options):
+        # the callers pass the values already unwrapped
+        return CompactMonitoredValue.for_options(options)(value, text)
+
+    def scan_dbus_services_async(self, services=None, callback=None):
+        serviceNames = list(services) if services else self.wanted_service_names()
+        if not serviceNames:
+            # ScanProgress only finishes after a completed service, so finish it here
+            if callback is not None:
+                GLib.idle_add(callback, [])
+            return
+        super().scan_dbus_services_async(services=serviceNames, callback=callback)
+
+    def get_name_owner_async_done(self, progress, serviceName, owner):
+        paths = self.dbusTree.get(".".join(serviceName.split(".")[0:3]), {})
+        if len(paths) > TARGETED_SCAN_MAX_PATHS:
+            super().get_name_owner_async_done(progress, serviceName, owner)
+            return
+
+        paths = list(paths)
+        # the device instance is needed to add the service, like the GetItems scan the
+        # legacy exceptions do not need it
+        if (
+            serviceName not in ("com.victronenergy.settings", "com.victronenergy.platform")
+            and not serviceName.startswith("com.victronenergy.vecan.")
+            and "/DeviceInstance" not in paths
+        ):
+            paths.append("/DeviceInstance")
+
+        logging.info("Found: %s, fetching %d monitored paths" % (serviceName, len(paths)))
+        scan = AsyncTargetedScan(
+            self,
+            serviceName,
+            paths,
+            partial(self._targeted_scan_done, progress, serviceName, owner),
+            partial(self._targeted_scan_error, progress, serviceName, owner),
+        )
+        scan.start()
+
+    def _targeted_scan_done(self, progress, serviceName, owner, items):
+        if items is None:
+            logging.error("Ignoring %s because it disappeared while scanning" % serviceName)
+            progress.complete(serviceName)
+        else:
+            # like after a failed GetItems request, the legacy scan needs the owner, if the service could not be added
+            self._legacyOwners[serviceName] = owner
+            self.get_items_async_done(progress, serviceName, owner, items)
+            if serviceName in self.servicesByName:
+                self._legacyOwners.pop(serviceName, None)
+
+    def _targeted_scan_error(self, progress, serviceName, owner, exc):
+        # scan it like a service with many paths, which falls back to the legacy scan if GetItems fails as well
+        logging.warning("Targeted scan of %s failed, scanning it with GetItems: %s" % (serviceName, exc))
+        super().get_name_owner_async_done(progress, serviceName, owner)
+
+    def handler_item_changes(self, items, senderId):
+        if not isinstance(items, dict):
+            return
+
+        try:
+            service = self.servicesById[senderId]
+        except KeyError:
+            # senderId isn't there, which means it hasn't been scanned yet.
+            return
+
+        # only unwrap the monitored paths, services like com.victronenergy.settings
+        # send many more items than we are interested in
+        paths = service.paths
+        for path, changes in items.items():
+            if path not in paths:
+                continue
+
+            try:
+                v = unwrap_dbus_value(changes["Value"])
+            except (KeyError, TypeError):
+                continue
+
+            try:
+                t = changes["Text"]
+            except KeyError:
+                t = str(v)
+            self._handler_value_changes(service, path, v, t)
+
+    def _handler_value_changes(self, service, path, value, text):
+        service.lastUpdate = time.monotonic()
+        listeners = self.valueListeners.get(path)
+        if listeners is None:
+            super()._handler_value_changes(service, path, value, text)
+            return
+
+        item = service.paths.get(path)
+        old = item.value if item is not None else None
+        super()._handler_value_changes(service, path, value, text)
+        if item is not None and item.value != old:
+            for callback in listeners:
+                callback(service.name, path, value)
+
+    def get_items_async_error(self, progress, serviceName, owner, exc):
+        self._legacyOwners[serviceName] = owner
+        super().get_items_async_error(progress, serviceName, owner, exc)
+
+    def _async_scan_callback(self, startup, errors):
+        # do a legacy scan on services that could not be scanned with GetItems, all at once
+        progress = ScanProgress(partial(self._legacy_scan_callback, startup))
+        progress.add(None)
+        for name in errors:
+            progress.add(name)
+            logging.info(f"Doing legacy scan on {name}")
+            scan = AsyncLegacyScan(self, name, self._legacyOwners.pop(name, None), partial(self._legacy_scan_done, progress))
+            scan.start()
+        # all scans are started, the progress can finish now
+        progress.complete(None)
+
+    def _legacy_scan_done(self, progress, serviceName, success):
+        if success and self.deviceAddedCallback is not None:
+            self.deviceAddedCallback(serviceName, self.get_device_instance(serviceName))
+        progress.complete(serviceName)
+
+    def _legacy_scan_callback(self, startup, errors):
+        if startup:
+            logging.info("===== Async scan complete =====")
+            if self.scanCompleteCallback is not None:
+                self.scanCompleteCallback(self)
+
+
+class RoutedMatch:
+    """
+    Handle of a receiver added to a SignalRouter, with the interface of a dbus SignalMatch.
+    """
+
+    def __init__(self, router, key, handler):
+        self._router = router
+        self._key = key
+        self._handler = handler
+
+    def remove(self):
+        self._router._remove(self._key, self._handler)
+
+    def __str__(self):
+        return self._router.match_rule(self._key)
+
+
+class SignalRouter:
+    """
+    Wrapper of a dbus connection, which routes the received signals to all receivers.
+
+    Receivers with the same match arguments share one match rule on the connection, so dbus-daemon
+    delivers each signal only once. All other attributes are passed through to the connection,
+    so the router can be used wherever the connection is expected.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        # {match arguments: [dbus SignalMatch, list of handlers]}
+        self._routes = {}
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def add_signal_receiver(self, handler_function, signal_name=None, **keywords):
+        key = (signal_name, tuple(sorted(keywords.items())))
+        route = self._routes.get(key)
+        if route is None:
+            handlers = []
+
+            def dispatch(*args, **kwargs):
+                for handler in list(handlers):
+                    handler(*args, **kwargs)
+
+            match = self.connection.add_signal_receiver(dispatch, signal_name=signal_name, **keywords)
+            route = self._routes[key] = [match, handlers]
+        route[1].append(handler_function)
+        return RoutedMatch(self, key, handler_function)
+
+    def _remove(self, key, handler):
+        route = self._routes.get(key)
+        if route is None:
+            return
+        if handler in route[1]:
+            route[1].remove(handler)
+        if not route[1]:
+            route[0].remove()
+            del self._routes[key]
+
+    def match_rule(self, key) -> str:
+        route = self._routes.get(key)
+        return str(route[0]) if route is not None else ""
+
+    def match_rules(self) -> list:
+        """
+        :return: list of (match rule, number of receivers) tuples
+        """
+        return [(str(match), len(handlers)) for match, handlers in self._routes.values()]
+
+
+def _connection_match_rules(connection):
+    """
+    Get the match rules registered on a dbus connection by a SignalRouter.
+
+    dbus-python does not offer a public way to list the match rules of a plain connection,
+    so only the rules added through a SignalRouter are known.
+
+    :param connection: dbus connection or SignalRouter
+    :return: list of (match rule, number of receivers) tuples, or None if the connection is not routed
+    """
+    if isinstance(connection, SignalRouter):
+        return connection.match_rules()
+    return None
+
+
+# failed writes are repeated up to WRITE_RETRIES times, the delay is doubled after every attempt
+WRITE_RETRIES = 3
+WRITE_RETRY_DELAY_MS = 500
+
+
+class WriteQueue:
+    """
+    Ordered queue of asynchronous SetValue calls to the monitored services.
+
+    Only one write is in flight at a time, so the writes arrive in the order they were queued.
+    A write to a path which is still queued replaces the queued value (latest wins) and keeps its place.
+    Failed writes are retried with an increasing delay, unless a newer value was queued meanwhile.
+    """
+
+    def __init__(self, monitor, retries=WRITE_RETRIES, retry_delay_ms=WRITE_RETRY_DELAY_MS):
+        self._monitor = monitor
+        self._retries = retries
+        self._retry_delay_ms = retry_delay_ms
+        # (service, path) keys in queue order and their latest values
+        self._order = deque()
+        self._values = {}
+        # {key: callback} of the queued writes with callback
+        self._callbacks = {}
+        # [key, value, attempt, callback] of the write in flight or waiting for retry
+        self._current = None
+        self.completed = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of writes not completed yet, including the one in flight.
+        """
+        return len(self._order) + (1 if self._current is not None else 0)
+
+    def write(self, serviceName, path, value, callback=None):
+        """
+        Queue a write and return immediately.
+
+        :param serviceName: name of the service, i.e. com.victronenergy.settings
+        :param path: object path of the item
+        :param value: value to write
+        :param callback: called with True when the value was written, with False when all attempts failed.
+            A write replacing the queued value replaces its callback as well.
+        """
+        key = (serviceName, path)
+        if key in self._values:
+            self.coalesced += 1
+        else:
+            self._order.append(key)
+        self._values[key] = value
+        self._callbacks.pop(key, None)
+        if callback is not None:
+            self._callbacks[key] = callback
+        self._next()
+
+    def _next(self):
+        if self._current is not None or not self._order:
+            return
+        key = self._order.popleft()
+        self._current = [key, self._values.pop(key), 0, self._callbacks.pop(key, None)]
+        self._send()
+
+    def _send(self):
+        (serviceName, path), value, _, _ = self._current
+        self._monitor.set_value_async(serviceName, path, value, reply_handler=self._reply, error_handler=self._error)
+        return False
+
+    def _reply(self, *args):
+        self.completed += 1
+        callback = self._current[3]
+        self._current = None
+        if callback is not None:
+            callback(True)
+        self._next()
+
+    def _error(self, exc):
+        key, value, attempt, callback = self._current
+        if key in self._values:
+            # a newer value is queued, no need to retry the old one, its result is reported to the callback
+            self.coalesced += 1
+            self._current = None
+            if callback is not None:
+                self._callbacks.setdefault(key, callback)
+        elif attempt < self._retries:
+            self._current[2] = attempt + 1
+            delay = self._retry_delay_ms << attempt
+            logging.warning("|- Write of %s to %s%s failed, retry in %d ms: %s" % (value, key[0], key[1], delay, exc))
+            GLib.timeout_add(delay, self._send)
+            return
+        else:
+            self.failed += 1
+            self._current = None
+            logging.error("|- Write of %s to %s%s failed after %d attempts: %s" % (value, key[0], key[1], attempt + 1, exc))
+            if callback is not None:
+                callback(False)
+        self._next()
+
+
+def _sizeof(obj) -> int:
+    """
+    Size of an object in bytes including its instance dictionary, if it has one.
+    None is a singleton and therefore not counted.
+    """
+    if obj is None:
+        return 0
+    size = sys.getsizeof(obj)
+    instance_dict = getattr(obj, "__dict__", None)
+    if isinstance(instance_dict, dict):
+        size += sys.getsizeof(instance_dict)
+    return size
 
 
 class DbusMon:
-    def __init__(self):
+    def __init__(self, scan_complete_callback=None, bus=None):
+        """
+        Start monitoring the dbus.
+
+        The dbus is scanned asynchronously, so the values are available after the
+        scan_complete_callback was called from the main loop.
+
+        :param scan_complete_callback: called with the DbusMon instance, when the initial scan is complete
+        :param bus: connection to share with the rest of the process, if None the monitor opens its own connection
+        """
+        # callbacks of devices added to or removed from the dbus, after the initial scan
+        self._deviceAddedListeners = []
+        self._deviceRemovedListeners = []
+        # signals of a shared connection are routed to the monitor and all other receivers
+        self._router = SignalRouter(bus) if bus is not None else None
+        self._scan_complete_callback = scan_complete_callback
+        self.scan_complete = False
+        self.scan_duration = None
+        self._scan_start = time.monotonic()
+
+        # one options object shared by all monitored paths
         dummy = {"code": None, "whenToLog": "configChange", "accessLevel": None}
         self.monitorlist = {
             "com.victronenergy.battery": {
@@ -39,6 +691,10 @@ class DbusMon:
                 "/System/MaxCellTemperature": dummy,
                 "/System/MinTemperatureCellId": dummy,
                 "/System/MinCellTemperature": dummy,
+                "/System/Temperature1": dummy,
+                "/System/Temperature2": dummy,
+                "/System/Temperature3": dummy,
+                "/System/Temperature4": dummy,
                 "/System/MaxVoltageCellId": dummy,
                 "/System/MaxCellVoltage": dummy,
                 "/System/MinVoltageCellId": dummy,
@@ -134,6 +790,7 @@ class DbusMon:
             },
             "com.victronenergy.settings": {
                 "/Settings/CGwacs/OvervoltageFeedIn": dummy,
+                "/Settings/Devices/aggregatebatteries/CustomName": dummy,
             },
             "com.victronenergy.system": {
                 "/SystemState/LowSoc": dummy,
@@ -141,7 +798,130 @@ class DbusMon:
             },
         }
 
-        self.dbusmon = DbusMonitor(self.monitorlist, ignoreServices=["com.victronenergy.battery.aggregate"])
+        # intern the paths, they are used as keys in the path dictionary of every monitored service
+        self.monitorlist = {service_class: {sys.intern(path): options for path, options in paths.items()} for service_class, paths in self.monitorlist.items()}
+
+        self.dbusmon = CompactDbusMonitor(
+            self.monitorlist,
+            ignoreServices=["com.victronenergy.battery.aggregate"],
+            deviceAddedCallback=self._device_added,
+            deviceRemovedCallback=self._device_removed,
+            scanCompleteCallback=self._scan_completed,
+            bus=self._router,
+        )
+        # writes to the monitored services, i.e. settings, never block the main loop
+        self.writes = WriteQueue(self.dbusmon)
+
+    def _scan_completed(self, monitor):
+        self.scan_complete = True
+        self.scan_duration = time.monotonic() - self._scan_start
+        logging.info("Dbusmonitor scan of %d services completed in %.3f s" % (len(monitor.servicesByName), self.scan_duration))
+        if self._scan_complete_callback is not None:
+            self._scan_complete_callback(self)
+
+    def _device_added(self, service_name, device_instance):
+        if not self.scan_complete:
+            return
+        for callback in list(self._deviceAddedListeners):
+            callback(str(service_name), device_instance)
+
+    def _device_removed(self, service_name, device_instance):
+        if not self.scan_complete:
+            return
+        for callback in list(self._deviceRemovedListeners):
+            callback(str(service_name), device_instance)
+
+    def add_device_listener(self, added=None, removed=None):
+        """
+        Call functions, when a monitored service appears on or disappears from the dbus after the initial scan.
+
+        The added callback is called after the values of the service were fetched.
+
+        :param added: function(service_name, device_instance)
+        :param removed: function(service_name, device_instance)
+        """
+        if added is not None:
+            self._deviceAddedListeners.append(added)
+        if removed is not None:
+            self._deviceRemovedListeners.append(removed)
+
+    def service_names(self, keyword="") -> list:
+        """
+        :param keyword: only return services which contain the keyword, i.e. com.victronenergy.battery
+        :return: sorted list of the names of the monitored services on the dbus
+        """
+        return sorted(name for name in self.dbusmon.servicesByName if keyword in name)
+
+    def add_value_listener(self, path, callback):
+        """
+        Call a function, when the value of a monitored path changes on any service.
+
+        The callback is called from the signal handler, without the idle round trip of the
+        valueChangedCallback, so it has to be short.
+
+        :param path: monitored path, i.e. /Settings/Devices/aggregatebatteries/CustomName
+        :param callback: function(service_name, path, value)
+        """
+        self.dbusmon.valueListeners.setdefault(sys.intern(path), []).append(callback)
+
+    def has_path(self, service_name, path) -> bool:
+        """
+        :return: True, if the monitored path was reported by the service, also when its value is None
+        """
+        service = self.dbusmon.servicesByName.get(service_name)
+        return service is not None and service.seen(path)
+
+    def data_age(self, service_name):
+        """
+        :return: seconds since the service sent the last value, or None if the service is unknown
+        """
+        service = self.dbusmon.servicesByName.get(service_name)
+        if service is None:
+            return None
+        return time.monotonic() - service.lastUpdate
+
+    def connection_report(self) -> list:
+        """
+        Get the dbus connections used by the monitor and their match rules.
+
+        :return: list of dictionaries with the keys "connection", "unique_name" and "match_rules",
+            match_rules being a list of (match rule, number of receivers) tuples, or None if the
+            rules of the connection are not tracked (no shared connection)
+        """
+        connections = [("monitor", self.dbusmon.dbusConn)]
+        if self._router is None:
+            # NameOwnerChanged is received on the standard bus of the process
+            connections.append(("name owner", dbus.SessionBus() if "DBUS_SESSION_BUS_ADDRESS" in os.environ else dbus.SystemBus()))
+
+        report = []
+        for label, connection in connections:
+            try:
+                unique_name = str(connection.get_unique_name())
+            except Exception:
+                unique_name = None
+            report.append({"connection": label, "unique_name": unique_name, "match_rules": _connection_match_rules(connection)})
+        return report
+
+    def memory_report(self) -> dict:
+        """
+        Get the memory held by the monitor for each service.
+
+        Objects shared by all services, like the interned path strings and the options object,
+        are not counted.
+
+        :return: dictionary with the service name as key and the size in bytes as value
+        """
+        report = {}
+        for name, service in list(self.dbusmon.servicesByName.items()):
+            size = _sizeof(service) + _sizeof(service.paths)
+            # the seen paths are private to the service class, which may change with velib
+            seen = getattr(service, "_seen", None)
+            if seen is not None:
+                size += _sizeof(seen)
+            for item in service.paths.values():
+                size += _sizeof(item) + _sizeof(item.value) + _sizeof(item.text)
+            report[name] = size
+        return report
 
     def print_values(self, service, mon_list):
         for path in self.monitorlist[mon_list]:
@@ -158,19 +938,23 @@ class DbusMon:
 def main():
     logging.basicConfig(level=logging.INFO)
     DBusGMainLoop(set_as_default=True)
-    dbusmon = DbusMon()
 
-    # dbusmon.print_values('com.victronenergy.battery.ttyUSB2', 'com.victronenergy.battery')
-    # dbusmon.print_values('com.victronenergy.vebus.ttyUSB0', 'com.victronenergy.vebus')
-    # dbusmon.print_values('com.victronenergy.solarcharger.ttyUSB1', 'com.victronenergy.solarcharger')
-    dbusmon.print_values("com.victronenergy.settings", "com.victronenergy.settings")
-    dbusmon.dbusmon.set_value("com.victronenergy.settings", "/Settings/CGwacs/OvervoltageFeedIn", 0)
+    def scan_complete(dbusmon):
+        # dbusmon.print_values('com.victronenergy.battery.ttyUSB2', 'com.victronenergy.battery')
+        # dbusmon.print_values('com.victronenergy.vebus.ttyUSB0', 'com.victronenergy.vebus')
+        # dbusmon.print_values('com.victronenergy.solarcharger.ttyUSB1', 'com.victronenergy.solarcharger')
+        dbusmon.print_values("com.victronenergy.settings", "com.victronenergy.settings")
+        for service, size in dbusmon.memory_report().items():
+            logging.info("%s: %d bytes" % (service, size))
+        dbusmon.dbusmon.set_value("com.victronenergy.settings", "/Settings/CGwacs/OvervoltageFeedIn", 0)
+
+    DbusMon(scan_complete_callback=scan_complete)
 
     # GLib.timeout_add(1000, dbusmon.print_values, 'com.victronenergy.battery.ttyUSB2')
-    # Start and run the mainloop
-    # logging.info("Battery monitor: Starting mainloop.\n")
-    # mainloop = GLib.MainLoop()
-    # mainloop.run()
+    # Start and run the mainloop, the scan is done asynchronously
+    logging.info("Battery monitor: Starting mainloop.\n")
+    mainloop = GLib.MainLoop()
+    mainloop.run()
 
 
 if __name__ == "__main__":
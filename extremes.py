@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import heapq
+
+# cell voltages of the batteries, the driver supports up to 32 cells per battery
+CELL_PATHS = tuple("/Voltages/Cell%d" % cell for cell in range(1, 33))
+# temperature sensors of the batteries
+TEMPERATURE_PATHS = tuple("/System/Temperature%d" % sensor for sensor in range(1, 5))
+
+
+class IndexedHeap:
+    """
+    Binary min-heap of (value, key) with the position of each key, so a value can be changed or removed in O(log n).
+    """
+
+    def __init__(self, sign=1):
+        """
+        :param sign: 1 for a min-heap, -1 for a max-heap
+        """
+        self._sign = sign
+        # [(sign * value, key), ...]
+        self._heap = []
+        # {key: position in the heap}
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._positions[heap[i][1]] = i
+        self._positions[heap[j][1]] = j
+
+    def _sift_up(self, i):
+        heap = self._heap
+        while i > 0:
+            parent = (i - 1) >> 1
+            if heap[i] >= heap[parent]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        heap = self._heap
+        size = len(heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < size and heap[child] < heap[smallest]:
+                    smallest = child
+            if smallest == i:
+                break
+            self._swap(i, smallest)
+            i = smallest
+
+    def set(self, key, value):
+        """
+        Add the key or change its value.
+        """
+        entry = (self._sign * value, key)
+        i = self._positions.get(key)
+        if i is None:
+            self._heap.append(entry)
+            i = self._positions[key] = len(self._heap) - 1
+            self._sift_up(i)
+        elif entry != self._heap[i]:
+            old = self._heap[i]
+            self._heap[i] = entry
+            if entry < old:
+                self._sift_up(i)
+            else:
+                self._sift_down(i)
+
+    def discard(self, key):
+        i = self._positions.pop(key, None)
+        if i is None:
+            return
+        last = self._heap.pop()
+        if i < len(self._heap):
+            self._heap[i] = last
+            self._positions[last[1]] = i
+            self._sift_up(i)
+            self._sift_down(self._positions[last[1]])
+
+    def top(self, k=1) -> list:
+        """
+        The k first entries are collected from the heap with a second small heap of the candidates in O(k log k).
+
+        :return: [(value, key), ...] of the k first entries in order
+        """
+        heap = self._heap
+        result = []
+        candidates = [(heap[0], 0)] if heap else []
+        while candidates and len(result) < k:
+            (priority, key), i = heapq.heappop(candidates)
+            result.append((self._sign * priority, key))
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(candidates, (heap[child], child))
+        return result
+
+
+class ExtremesIndex:
+    """
+    Index of the lowest and highest values of a kind of values of all aggregated batteries, e.g. all cell voltages.
+
+    The values are kept in a min-heap and a max-heap, which are updated when a value changes, so the min., max.,
+    the k lowest and highest values and the spread are known without reading all values again.
+    """
+
+    def __init__(self, dbusMon, paths):
+        """
+        :param dbusMon: DbusMon instance, which monitors the batteries
+        :param paths: paths of the values of each battery, e.g. CELL_PATHS
+        """
+        self._dbusMon = dbusMon
+        self._paths = tuple(paths)
+        self._services = set()
+        self._low = IndexedHeap(1)
+        self._high = IndexedHeap(-1)
+        for path in self._paths:
+            dbusMon.add_value_listener(path, self._value_changed)
+
+    def __contains__(self, service):
+        return service in self._services
+
+    def __len__(self):
+        """
+        :return: number of values in the index
+        """
+        return len(self._low)
+
+    def _set(self, key, value):
+        # a battery without a value, e.g. with less cells or sensors, is left out
+        if value is None:
+            self._low.discard(key)
+            self._high.discard(key)
+        else:
+            self._low.set(key, value)
+            self._high.set(key, value)
+
+    def add(self, service):
+        """
+        Add a battery and read all of its values.
+        """
+        if service not in self._services:
+            self._services.add(service)
+            self.refresh(service)
+
+    def remove(self, service):
+        self._services.remove(service)
+        for path in self._paths:
+            self._set((service, path), None)
+
+    def select(self, services):
+        """
+        Use the values of these batteries only, i.e. the batteries in the aggregation.
+
+        :param services: dbus services of the batteries
+        """
+        services = set(services)
+        for service in self._services - services:
+            self.remove(service)
+        for service in services:
+            self.add(service)
+
+    def refresh(self, service):
+        """
+        Read all values of the battery again.
+        """
+        dbusmon = self._dbusMon.dbusmon
+        for path in self._paths:
+            self._set((service, path), dbusmon.get_value(service, path))
+
+    def _value_changed(self, service_name, path, value):
+        if service_name in self._services:
+            self._set((service_name, path), value)
+
+    def lowest(self, k=1) -> list:
+        """
+        :return: [(value, service, path), ...] of the k lowest values, starting with the lowest
+        """
+        return [(value, service, path) for value, (service, path) in self._low.top(k)]
+
+    def highest(self, k=1) -> list:
+        """
+        :return: [(value, service, path), ...] of the k highest values, starting with the highest
+        """
+        return [(value, service, path) for value, (service, path) in self._high.top(k)]
+
+    def minimum(self):
+        """
+        :return: lowest value or None, if the index is empty
+        """
+        lowest = self._low.top(1)
+        return lowest[0][0] if lowest else None
+
+    def maximum(self):
+        """
+        :return: highest value or None, if the index is empty
+        """
+        highest = self._high.top(1)
+        return highest[0][0] if highest else None
+
+    def spread(self):
+        """
+        :return: difference of the highest and the lowest value or None, if the index is empty
+        """
+        return self.maximum() - self.minimum() if self._low else None
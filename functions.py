@@ -1,7 +1,65 @@
 #!/usr/bin/env python3
 
-import sys
-import logging
+import bisect
+import os
+
+
+class Curve:
+    """
+    Piecewise linear curve y = f(x) of the lists X and Y, compiled once when the settings are loaded.
+
+    Below the first and above the last point the first and last y is returned. The point is found by
+    bisection, so a lookup takes O(log n) independent of the position on the curve.
+    """
+
+    __slots__ = ("_x", "_y", "_slope")
+
+    def __init__(self, X, Y):
+        """
+        :param X: x values, increasing, i.e. cell voltages
+        :param Y: y values of the same length, i.e. factors of the max. current
+        :raises ValueError: if the lists do not form a valid curve
+        """
+        if len(X) != len(Y):
+            raise ValueError("Both lists must have the same length: %d != %d" % (len(X), len(Y)))
+        if len(X) < 2:
+            raise ValueError("At least 2 points are needed")
+        self._x = tuple(float(x) for x in X)
+        self._y = tuple(float(y) for y in Y)
+        if any(x2 < x1 for x1, x2 in zip(self._x, self._x[1:])):
+            raise ValueError("The x values must be increasing: %s" % (X,))
+        # a vertical step has no slope, it is never interpolated
+        self._slope = tuple((y2 - y1) / (x2 - x1) if x2 > x1 else 0.0 for x1, x2, y1, y2 in zip(self._x, self._x[1:], self._y, self._y[1:]))
+
+    def __call__(self, x) -> float:
+        if x >= self._x[-1]:
+            return self._y[-1]
+        # first point with X[i] >= x, so X[i - 1] < x <= X[i]
+        i = bisect.bisect_left(self._x, x)
+        if i == 0:
+            return self._y[0]
+        return self._y[i - 1] + self._slope[i - 1] * (x - self._x[i - 1])
+
+    def many(self, values) -> list:
+        """
+        Evaluate the curve for many values at once, i.e. for all cells.
+
+        :param values: x values, None is returned for None
+        :return: list of y values
+        """
+        xs, ys, slopes = self._x, self._y, self._slope
+        last_x, first_y, last_y = xs[-1], ys[0], ys[-1]
+        find = bisect.bisect_left
+        result = []
+        for x in values:
+            if x is None:
+                result.append(None)
+            elif x >= last_x:
+                result.append(last_y)
+            else:
+                i = find(xs, x)
+                result.append(first_y if i == 0 else ys[i - 1] + slopes[i - 1] * (x - xs[i - 1]))
+        return result
 
 
 class Functions:
@@ -21,23 +79,6 @@ class Functions:
         except Exception:
             return None
 
-    # Interpolate f(x) if given lists Y = f(X)
-
-    def _interpolate(self, X, Y, x):
-        if len(X) == len(Y):
-            _len = len(X)
-            if x <= X[0]:
-                return Y[0]
-            elif x >= X[_len - 1]:
-                return Y[_len - 1]
-            else:
-                for i in range(_len - 1):
-                    if x <= X[i + 1]:
-                        return Y[i] + (Y[i + 1] - Y[i]) / (X[i + 1] - X[i]) * (x - X[i])
-        else:
-            logging.error("Both lists must have the same length. Exiting.")
-            sys.exit()
-
     def get_venus_os_version() -> str:
         """
         Get the Venus OS version.
@@ -65,6 +106,19 @@ class Functions:
         with open("/sys/firmware/devicetree/base/model", "r") as f:
             return f.readline().strip()
 
+    def get_process_age() -> float:
+        """
+        Get the time since the start of this process, including the start of Python and the imports.
+
+        :return: seconds since the process was started
+        """
+        with open("/proc/self/stat", "r") as f:
+            # start time in clock ticks after boot, the 22nd field, counted after the command in brackets
+            start_ticks = int(f.readline().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.readline().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
 
 ################
 # test program #
@@ -74,18 +128,12 @@ class Functions:
 def main():
     import settings as s
 
-    fn = Functions()
     for x in range(0, 251):
         print(
             "%.2f %.0f"
             % (
                 x / 100.0,
-                s.MAX_CHARGE_CURRENT
-                * fn._interpolate(
-                    s.CELL_CHARGE_LIMITING_VOLTAGE,
-                    s.CELL_CHARGE_LIMITED_CURRENT,
-                    x / 100.0,
-                ),
+                s.MAX_CHARGE_CURRENT * s.CHARGE_CURVE(x / 100.0),
             )
         )
 
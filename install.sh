@@ -47,6 +47,12 @@ function backup_config {
         mv /data/dbus-aggregate-batteries/last_balancing /data/dbus-aggregate-batteries_last_balancing.backup
         echo "last_balancing backed up to /data/dbus-aggregate-batteries_last_balancing.backup"
     fi
+
+    # backup storedvalue_journal
+    if [ -f "/data/apps/dbus-aggregate-batteries/storedvalue_journal" ]; then
+        mv /data/apps/dbus-aggregate-batteries/storedvalue_journal /data/apps/dbus-aggregate-batteries_storedvalue_journal.backup
+        echo "storedvalue_journal backed up to /data/apps/dbus-aggregate-batteries_storedvalue_journal.backup"
+    fi
 }
 
 function restore_config {
@@ -135,6 +141,12 @@ function restore_config {
             echo "last_balancing restored to /data/dbus-aggregate-batteries/last_balancing"
         fi
     fi
+
+    # restore storedvalue_journal
+    if [ -f "/data/apps/dbus-aggregate-batteries_storedvalue_journal.backup" ] && [ -d "/data/apps/dbus-aggregate-batteries" ]; then
+        mv /data/apps/dbus-aggregate-batteries_storedvalue_journal.backup /data/apps/dbus-aggregate-batteries/storedvalue_journal
+        echo "storedvalue_journal restored to /data/apps/dbus-aggregate-batteries/storedvalue_journal"
+    fi
 }
 
 
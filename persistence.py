@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+import atexit
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+
+# the flash is written in blocks, so a small file costs at least one block
+BLOCK_SIZE = 4096
+
+
+def write_atomic(path: str, content: str) -> int:
+    """
+    Write content atomically to path via a temporary file and os.replace.
+    The directory is synced as well, so the new file survives a power loss.
+
+    :return: number of bytes written
+    """
+    dir_ = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile(mode="w", dir=dir_, delete=False, suffix=".tmp") as tmp:
+        tmp.write(content)
+        tmp.flush()
+        os.fsync(tmp.fileno())
+    os.replace(tmp.name, path)
+    dir_fd = os.open(dir_, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return len(content.encode())
+
+
+def append_durable(path: str, content: str) -> int:
+    """
+    Append content to path and sync it. The directory is synced as well, if the file is new.
+
+    :return: number of bytes written
+    """
+    created = not os.path.exists(path)
+    with open(path, "a") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    if created:
+        dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    return len(content.encode())
+
+
+class PersistenceScheduler:
+    """
+    Writes the state files on a worker thread, so the main loop never waits for the flash.
+
+    Only the latest content of each file is written. Writes, which are not critical, are limited
+    by a budget of bytes per day to reduce the wear of the eMMC/SD card, they are delayed until
+    the budget allows them again. Critical writes are served first, then appends, e.g. to the state journal,
+    then the other files. All pending writes are flushed on exit.
+    """
+
+    def __init__(self, bytes_per_day=0):
+        """
+        :param bytes_per_day: budget of the non critical writes, 0 for no limit
+        """
+        self._bytesPerDay = bytes_per_day
+        # the budget is a token bucket, which is refilled continuously and holds the bytes of one day
+        self._allowance = float(bytes_per_day)
+        self._allowanceTime = time.monotonic()
+        self._condition = threading.Condition()
+        # {path: (content, critical, append, callback, share)}
+        self._pending = {}
+        self._writing = False
+
+        # statistics, read from the main loop
+        self.writes = 0
+        self.failures = 0
+        self.bytes_written = 0
+        # seconds of the last write
+        self.latency = None
+
+        self._thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    @property
+    def pending(self) -> int:
+        """
+        :return: number of files waiting to be written
+        """
+        return len(self._pending)
+
+    def schedule(self, path, content, critical=False, append=False, callback=None, share=1.0):
+        """
+        Write the content to the file in the background. A pending content of the same file is replaced.
+
+        :param path: path of the state file
+        :param content: new content of the file
+        :param critical: if True, the file is written regardless of the budget
+        :param append: if True, the content is appended to the file. It must be complete in itself,
+                       because it replaces a pending append to the same file
+        :param callback: called on the worker thread with (append, success) after the content was written,
+                         it replaces the callback of a pending content, which is not written anymore
+        :param share: share of the budget of a day, which the file may use. It is written only while the rest of
+                      the budget is left for the other files
+        """
+        with self._condition:
+            if path in self._pending:
+                _, pending_critical, pending_append, _, _ = self._pending[path]
+                critical = critical or pending_critical
+                # a pending rewrite stays a rewrite
+                append = append and pending_append
+            self._pending[path] = (content, critical, append, callback, share)
+            self._condition.notify_all()
+
+    def flush(self, timeout=10):
+        """
+        Write all pending files regardless of the budget and wait until they are written.
+
+        :param timeout: max. seconds to wait
+        :return: True, if nothing is pending anymore
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._pending = {path: (content, True, append, callback, share) for path, (content, critical, append, callback, share) in self._pending.items()}
+            self._condition.notify_all()
+            while (self._pending or self._writing) and self._thread.is_alive():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.error("Persistence: %d file(s) not written at exit" % len(self._pending))
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _cost(self, content, share) -> int:
+        # a budget smaller than one block allows one write per day
+        return min(max(BLOCK_SIZE, len(content.encode())), share * self._bytesPerDay)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._allowance = min(self._bytesPerDay, self._allowance + (now - self._allowanceTime) * self._bytesPerDay / 86400)
+        self._allowanceTime = now
+
+    def _next(self):
+        """
+        :return: (path, content, append, callback) of the next file to write and the seconds to wait, if none is allowed yet
+        """
+        if self._bytesPerDay > 0:
+            self._refill()
+        wait = None
+        # critical writes first, then appends, then the files with the largest share
+        for path, (content, critical, append, callback, share) in sorted(self._pending.items(), key=self._order):
+            if critical or self._bytesPerDay <= 0:
+                return (path, content, append, callback), None
+            # the allowance, which must be left for the other files
+            reserve = (1 - share) * self._bytesPerDay
+            cost = self._cost(content, share)
+            if self._allowance - reserve >= cost:
+                self._allowance -= cost
+                return (path, content, append, callback), None
+            missing = (cost + reserve - self._allowance) * 86400 / self._bytesPerDay
+            wait = missing if wait is None else min(wait, missing)
+        return None, wait
+
+    @staticmethod
+    def _order(item):
+        _, (_, critical, append, _, share) = item
+        return (not critical, not append, -share)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    item, wait = self._next()
+                    if item is not None:
+                        break
+                    # wait for a new file or until the budget allows the next write
+                    self._condition.wait(wait)
+                path, content, append, callback = item
+                del self._pending[path]
+                self._writing = True
+
+            start = time.monotonic()
+            success = False
+            try:
+                written = append_durable(path, content) if append else write_atomic(path, content)
+                self.bytes_written += written
+                self.writes += 1
+                success = True
+            except Exception:
+                (
+                    exception_type,
+                    exception_object,
+                    exception_traceback,
+                ) = sys.exc_info()
+                file = exception_traceback.tb_frame.f_code.co_filename
+                line = exception_traceback.tb_lineno
+                logging.error(f"Could not write {path}: {repr(exception_object)} of type {exception_type} in {file} line #{line}")
+                self.failures += 1
+            self.latency = time.monotonic() - start
+            if callback is not None:
+                callback(append, success)
+
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class StateJournal:
+    """
+    Append-only journal of the controller state. Each record is one line with the CRC32 and the complete state as JSON,
+    so the latest valid record is the current state and a torn record at the end, e.g. after a power loss, is skipped.
+
+    The records are appended by the PersistenceScheduler. After compact_records records were written the journal
+    is rewritten with only the latest record.
+    """
+
+    def __init__(self, path, scheduler, compact_records=1000):
+        """
+        :param path: path of the journal file
+        :param scheduler: PersistenceScheduler, which writes the records
+        :param compact_records: number of records, after which the journal is compacted
+        """
+        self._path = path
+        self._scheduler = scheduler
+        self._compactRecords = compact_records
+        # number of records in the file, counted when the scheduler has written them
+        self._records = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _encode(state) -> str:
+        payload = json.dumps(state, separators=(",", ":"), sort_keys=True)
+        return "%08x %s\n" % (zlib.crc32(payload.encode()), payload)
+
+    @staticmethod
+    def _decode(line):
+        """
+        :return: state of the record or None, if the record is incomplete or corrupt
+        """
+        if not line.endswith("\n"):
+            return None
+        checksum, _, payload = line.rstrip("\n").partition(" ")
+        try:
+            if int(checksum, 16) != zlib.crc32(payload.encode()):
+                return None
+            state = json.loads(payload)
+        except ValueError:
+            return None
+        return state if isinstance(state, dict) else None
+
+    def load(self):
+        """
+        Replay the journal. If it contains corrupt records, it is compacted to the latest valid record,
+        or emptied if there is no valid record.
+
+        :return: latest valid state or None, if the journal does not exist or has no valid record
+        """
+        try:
+            with open(self._path, "r", errors="replace") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return None
+
+        state = None
+        corrupt = 0
+        for line in lines:
+            record = self._decode(line)
+            if record is None:
+                corrupt += 1
+            else:
+                state = record
+        with self._lock:
+            self._records = len(lines)
+
+        if corrupt:
+            logging.warning("State journal: %d of %d record(s) corrupt or incomplete, skipped" % (corrupt, len(lines)))
+            # the next record must not be appended to a torn one
+            if state is not None:
+                self.reset(state)
+            else:
+                write_atomic(self._path, "")
+                with self._lock:
+                    self._records = 0
+        return state
+
+    def reset(self, state):
+        """
+        Replace the journal by a single record synchronously, e.g. on migration of the old state files.
+        """
+        write_atomic(self._path, self._encode(state))
+        with self._lock:
+            self._records = 1
+
+    def record(self, state, critical=False):
+        """
+        Append the state in the background.
+
+        :param state: complete state, a dict serializable to JSON
+        :param critical: if True, the record is written regardless of the budget
+        """
+        with self._lock:
+            compact = self._records >= self._compactRecords
+        self._scheduler.schedule(self._path, self._encode(state), critical, append=not compact, callback=self._written)
+
+    def _written(self, append, success):
+        # called on the worker thread of the scheduler, records dropped or replaced before they were written are not counted
+        if not success:
+            return
+        with self._lock:
+            self._records = self._records + 1 if append else 1
@@ -0,0 +1,14 @@
+#!/bin/bash
+
+# remove comment for easier troubleshooting
+#set -x
+
+echo
+
+
+
+# read config.ini again without restarting the driver
+echo "Reloading config of dbus-aggregate-batteries..."
+pkill -HUP -f "python .*/dbus-aggregate-batteries/dbus-aggregate-batteries.py"
+
+echo
@@ -1,36 +1,30 @@
 # -*- coding: utf-8 -*-
-# Standard library importsimport bisect
+# Standard library imports
 import configparser
+import hashlib
+import json
 import logging
-import sys
+import os
 from pathlib import Path
-from time import sleep
+from time import monotonic
+from types import MappingProxyType
 from typing import List, Any, Callable
 
+from functions import Curve
+
+
+# to log the time needed to load the settings
+_load_start = monotonic()
 
 PATH_CONFIG_DEFAULT: str = "config.default.ini"
 PATH_CONFIG_USER: str = "config.ini"
+# values of the last config files without errors, see load()
+PATH_CONFIG_CACHE: str = "config.cache"
 
-config = configparser.ConfigParser()
 path = Path(__file__).parents[0]
 default_config_file_path = str(path.joinpath(PATH_CONFIG_DEFAULT).absolute())
 custom_config_file_path = str(path.joinpath(PATH_CONFIG_USER).absolute())
-try:
-    config.read([default_config_file_path, custom_config_file_path])
-
-    # Ensure the [DEFAULT] section exists and is uppercase
-    if "DEFAULT" not in config:
-        logging.error(f'The custom config file "{custom_config_file_path}" is missing the [DEFAULT] section.')
-        logging.error("Make sure the first line of the file is exactly (case-sensitive): [DEFAULT]")
-        sleep(60)
-        sys.exit(1)
-
-except configparser.MissingSectionHeaderError as error_message:
-    logging.error(f'Error reading "{custom_config_file_path}"')
-    logging.error("Make sure the first line is exactly: [DEFAULT]")
-    logging.error(f"{error_message}\n")
-    sleep(60)
-    sys.exit(1)
+cache_file_path = str(path.joinpath(PATH_CONFIG_CACHE).absolute())
 
 # Map config logging levels to logging module levels
 LOGGING_LEVELS = {
@@ -40,44 +34,74 @@ LOGGING_LEVELS = {
     "DEBUG": logging.DEBUG,
 }
 
-# Check if the LOGGING option is valid
-if "LOGGING" not in config["DEFAULT"] or config["DEFAULT"]["LOGGING"].upper() not in LOGGING_LEVELS:
-    logging.warning('Invalid "LOGGING" option "%s" in config file. Using default level "INFO".' % config["DEFAULT"].get("LOGGING"))
-    LOGGING = logging.INFO
-else:
-    LOGGING = LOGGING_LEVELS.get(config["DEFAULT"].get("LOGGING").upper())
-
-# Set logging level from config file
-logging.basicConfig(level=LOGGING)
+# config parsed by parse(), read by the helper functions
+config = None
 
 # List to store config errors
 # This is needed else the errors are not instantly visible
 errors_in_config = []
+# List to store config warnings, logged by the driver after the logging is set up
+warnings_in_config = []
+
+
+class Settings:
+    """
+    Immutable values of all options of the config files.
+
+    The values are available as attributes, i.e. ``Settings({"NR_OF_BATTERIES": 2}).NR_OF_BATTERIES``,
+    lists are stored as tuples.
+    """
 
-# Check if there are any options in the custom config file that are not in the default config file
-default_config = configparser.ConfigParser()
-custom_config = configparser.ConfigParser()
-# Ensure that option names are treated as case-sensitive
-default_config.optionxform = str
-custom_config.optionxform = str
-# Read the default and custom config files
-default_config.read(default_config_file_path)
-custom_config.read(custom_config_file_path)
+    __slots__ = ("_values", "errors", "warnings")
 
-for section in custom_config.sections() + ["DEFAULT"]:
-    if section not in default_config.sections() + ["DEFAULT"]:
-        errors_in_config.append(f'Section "{section}" in config.ini is not valid.')
-    else:
-        for option in custom_config[section]:
-            if option not in default_config[section]:
-                errors_in_config.append(f'Option "{option}" in config.ini is not valid.')
+    def __init__(self, values: dict, errors=(), warnings=()):
+        """
+        :param values: Dictionary with the name of the constant as key and its value
+        :param errors: Errors found while parsing the config files
+        :param warnings: Warnings found while parsing the config files
+        """
+        frozen = {name: tuple(value) if isinstance(value, list) else value for name, value in values.items()}
+        object.__setattr__(self, "_values", MappingProxyType(frozen))
+        object.__setattr__(self, "errors", tuple(errors))
+        object.__setattr__(self, "warnings", tuple(warnings))
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name) from None
 
-# Free up memory
-del default_config, custom_config, section
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings are immutable")
 
-# Check if option variable was set and if yes, free it
-if "option" in locals():
-    del option
+    def as_dict(self) -> dict:
+        return dict(self._values)
+
+
+def get_logging_level() -> int:
+    """
+    Get the logging level from the LOGGING option of the config file.
+
+    :return: Logging level of the logging module
+    """
+    # Check if the LOGGING option is valid
+    if "LOGGING" not in config["DEFAULT"] or config["DEFAULT"]["LOGGING"].upper() not in LOGGING_LEVELS:
+        warnings_in_config.append('Invalid "LOGGING" option "%s" in config file. Using default level "INFO".' % config["DEFAULT"].get("LOGGING"))
+        return logging.INFO
+    return LOGGING_LEVELS.get(config["DEFAULT"].get("LOGGING").upper())
+
+
+def check_options(default_config: configparser.ConfigParser, custom_config: configparser.ConfigParser) -> None:
+    """
+    Check if there are any options in the custom config file that are not in the default config file.
+    """
+    for section in custom_config.sections() + ["DEFAULT"]:
+        if section not in default_config.sections() + ["DEFAULT"]:
+            errors_in_config.append(f'Section "{section}" in config.ini is not valid.')
+        else:
+            for option in custom_config[section]:
+                if option not in default_config[section]:
+                    errors_in_config.append(f'Option "{option}" in config.ini is not valid.')
 
 
 # --------- Helper Functions ---------
@@ -109,8 +133,6 @@ def get_smartshunts_from_config(group: str, option: str):
     :param option: Option in the config file
     :return: bool or list
     """
-    import json
-
     raw = config[group].get(option, "False").strip()
     if not raw:
         return False
@@ -200,7 +222,6 @@ def get_list_from_config(group: str, option: str, mapper: Callable[[Any], Any] =
                 cleaned += line.rstrip(",").split(",")
         return [mapper(item.strip()) for item in cleaned if item.strip()]
     except KeyError:
-        logging.error(f"Missing config option '{option}' in group '{group}'")
         errors_in_config.append(f"Missing config option '{option}' in group '{group}'")
         return []
     except ValueError:
@@ -208,6 +229,44 @@ def get_list_from_config(group: str, option: str, mapper: Callable[[Any], Any] =
         return []
 
 
+def check_curve(option: str, X: List[float], Y: List[float]) -> bool:
+    """
+    Check if the lists form a valid curve and append a message to the errors_in_config list if not.
+
+    :param option: Name of the curve in the config file
+    :param X: x values, i.e. cell voltages
+    :param Y: y values, i.e. factors of the max. current
+    :return: True if valid
+    """
+    try:
+        Curve(X, Y)
+        return True
+    except (ValueError, TypeError) as error_message:
+        errors_in_config.append(f"Invalid curve {option}: {error_message}")
+        return False
+
+
+def get_curves_from_config(group: str, option: str) -> dict:
+    """
+    Get curves per battery from the config file, i.e. {"battery 1": [[3.2, 3.45, 3.55], [1, 1, 0]]}
+
+    :param group: Group in the config file
+    :param option: Option in the config file
+    :return: Dictionary with the battery name as key and [X, Y] as value
+    """
+    raw = config[group].get(option, "").strip()
+    if not raw:
+        return {}
+    try:
+        curves = json.loads(raw.replace("'", '"'))
+    except ValueError:
+        curves = None
+    if not isinstance(curves, dict) or not all(isinstance(curve, list) and len(curve) == 2 for curve in curves.values()):
+        errors_in_config.append(f"Invalid {option} value: {raw!r}. Expected {{battery name: [[cell voltages], [factors]], ...}}.")
+        return {}
+    return {name: curve for name, curve in curves.items() if check_curve(f"{option} of {name}", curve[0], curve[1])}
+
+
 def check_config_issue(condition: bool, message: str):
     """
     Check a condition and append a message to the errors_in_config list if the condition is True.
@@ -219,115 +278,340 @@ def check_config_issue(condition: bool, message: str):
         errors_in_config.append(f"{message}")
 
 
+def parse_values() -> dict:
+    """
+    Get the values of all options from the config file and check them.
+
+    :return: Dictionary with the name of the constant as key and its value
+    """
+
+    # ----- Needed hardware settings -----
+    NR_OF_BATTERIES: int = get_int_from_config("DEFAULT", "NR_OF_BATTERIES")
+    if NR_OF_BATTERIES < 2:
+        errors_in_config.append("NR_OF_BATTERIES must be at least 2. Currently set to %d." % NR_OF_BATTERIES)
+
+    NR_OF_CELLS_PER_BATTERY: int = get_int_from_config("DEFAULT", "NR_OF_CELLS_PER_BATTERY")
+    if NR_OF_CELLS_PER_BATTERY < 2:
+        errors_in_config.append("NR_OF_CELLS_PER_BATTERY must be at least 2. Currently set to %d." % NR_OF_CELLS_PER_BATTERY)
+
+    NR_OF_MPPTS: int = get_int_from_config("DEFAULT", "NR_OF_MPPTS")
+
+    # ----- DBus settings -----
+    BATTERY_SERVICE_NAME: str = config["DEFAULT"]["BATTERY_SERVICE_NAME"]
+    DCLOAD_SERVICE_NAME: str = config["DEFAULT"]["DCLOAD_SERVICE_NAME"]
+    BATTERY_PRODUCT_NAME_PATH: str = config["DEFAULT"]["BATTERY_PRODUCT_NAME_PATH"]
+    BATTERY_PRODUCT_NAME: str = config["DEFAULT"]["BATTERY_PRODUCT_NAME"]
+    BATTERY_INSTANCE_NAME_PATH: str = config["DEFAULT"]["BATTERY_INSTANCE_NAME_PATH"]
+    MULTI_KEYWORD: str = config["DEFAULT"]["MULTI_KEYWORD"]
+    MPPT_KEYWORD: str = config["DEFAULT"]["MPPT_KEYWORD"]
+    SMARTSHUNT_NAME_KEYWORD: str = config["DEFAULT"]["SMARTSHUNT_NAME_KEYWORD"]
+    SMARTSHUNT_INSTANCE_NAME_PATH: str = config["DEFAULT"]["SMARTSHUNT_INSTANCE_NAME_PATH"]
+    SHARED_DBUS_CONNECTION: bool = get_bool_from_config("DEFAULT", "SHARED_DBUS_CONNECTION")
+    SEARCH_TRIALS: int = get_int_from_config("DEFAULT", "SEARCH_TRIALS")
+    READ_TRIALS: int = get_int_from_config("DEFAULT", "READ_TRIALS")
+    BATTERY_STALE_TIME: int = get_int_from_config("DEFAULT", "BATTERY_STALE_TIME")
+    RECOVERY_LIMIT_FACTOR: float = get_float_from_config("DEFAULT", "RECOVERY_LIMIT_FACTOR")
+    RECOVERY_TIMEOUT: int = get_int_from_config("DEFAULT", "RECOVERY_TIMEOUT")
+    UPDATE_INTERVAL_FIND_DEVICES: int = get_int_from_config("DEFAULT", "UPDATE_INTERVAL_FIND_DEVICES")
+    UPDATE_INTERVAL_DATA: int = get_int_from_config("DEFAULT", "UPDATE_INTERVAL_DATA")
+    TIME_BEFORE_RESTART: int = get_int_from_config("DEFAULT", "TIME_BEFORE_RESTART")
+    RELOAD_ON_CONFIG_CHANGE: bool = get_bool_from_config("DEFAULT", "RELOAD_ON_CONFIG_CHANGE")
+
+    # ----- Options -----
+    CURRENT_FROM_VICTRON: bool = get_bool_from_config("DEFAULT", "CURRENT_FROM_VICTRON")
+    CAN_batteries: bool = get_bool_from_config("DEFAULT", "CAN_batteries")
+    USE_SMARTSHUNTS = get_smartshunts_from_config("DEFAULT", "USE_SMARTSHUNTS")
+    INVERT_SMARTSHUNTS: bool = get_bool_from_config("DEFAULT", "INVERT_SMARTSHUNTS")
+    SMARTSHUNT_AS_BATTERY_CURRENT: bool = get_bool_from_config("DEFAULT", "SMARTSHUNT_AS_BATTERY_CURRENT")
+    IGNORE_SMARTSHUNT_ABSENCE: bool = get_bool_from_config("DEFAULT", "IGNORE_SMARTSHUNT_ABSENCE")
+    CURRENT_STALE_TIME: int = get_int_from_config("DEFAULT", "CURRENT_STALE_TIME")
+    OWN_SOC: bool = get_bool_from_config("DEFAULT", "OWN_SOC")
+    ZERO_SOC: bool = get_bool_from_config("DEFAULT", "ZERO_SOC")
+    MAX_CELL_VOLTAGE_SOC_FULL: float = get_float_from_config("DEFAULT", "MAX_CELL_VOLTAGE_SOC_FULL")
+    MIN_CELL_VOLTAGE_SOC_EMPTY: float = get_float_from_config("DEFAULT", "MIN_CELL_VOLTAGE_SOC_EMPTY")
+    CHARGE_SAVE_PRECISION: float = get_float_from_config("DEFAULT", "CHARGE_SAVE_PRECISION")
+    CHARGE_SAVE_INTERVAL: int = get_int_from_config("DEFAULT", "CHARGE_SAVE_INTERVAL")
+    WRITE_BUDGET_PER_DAY: int = get_int_from_config("DEFAULT", "WRITE_BUDGET_PER_DAY")
+    CONTROLLER_STATE_MAX_AGE: int = get_int_from_config("DEFAULT", "CONTROLLER_STATE_MAX_AGE")
+    SNAPSHOT_INTERVAL: int = get_int_from_config("DEFAULT", "SNAPSHOT_INTERVAL")
+    SNAPSHOT_MAX_AGE: int = get_int_from_config("DEFAULT", "SNAPSHOT_MAX_AGE")
+    SNAPSHOT_LIMIT_FACTOR: float = get_float_from_config("DEFAULT", "SNAPSHOT_LIMIT_FACTOR")
+
+    # ----- Charge/Discharge parameters -----
+    OWN_CHARGE_PARAMETERS: bool = get_bool_from_config("DEFAULT", "OWN_CHARGE_PARAMETERS")
+    FAST_PATH_LIMITS: bool = get_bool_from_config("DEFAULT", "FAST_PATH_LIMITS")
+    BALANCING_VOLTAGE: float = get_float_from_config("DEFAULT", "BALANCING_VOLTAGE")
+    BALANCING_REPETITION: int = get_int_from_config("DEFAULT", "BALANCING_REPETITION")
+    CHARGE_VOLTAGE_LIST: List[float] = get_list_from_config("DEFAULT", "CHARGE_VOLTAGE_LIST", float)
+    MAX_CELL_VOLTAGE: float = get_float_from_config("DEFAULT", "MAX_CELL_VOLTAGE")
+    MIN_CELL_VOLTAGE: float = get_float_from_config("DEFAULT", "MIN_CELL_VOLTAGE")
+    MIN_CELL_HYSTERESIS: float = get_float_from_config("DEFAULT", "MIN_CELL_HYSTERESIS")
+    CELL_DIFF_MAX: float = get_float_from_config("DEFAULT", "CELL_DIFF_MAX")
+    BATTERY_EFFICIENCY: float = get_float_from_config("DEFAULT", "BATTERY_EFFICIENCY")
+    MAX_CHARGE_CURRENT: int = get_int_from_config("DEFAULT", "MAX_CHARGE_CURRENT")
+    MAX_DISCHARGE_CURRENT: int = get_int_from_config("DEFAULT", "MAX_DISCHARGE_CURRENT")
+
+    CELL_CHARGE_LIMITING_VOLTAGE: List[float] = get_list_from_config("DEFAULT", "CELL_CHARGE_LIMITING_VOLTAGE", float)
+    CELL_CHARGE_LIMITED_CURRENT: List[float] = get_list_from_config("DEFAULT", "CELL_CHARGE_LIMITED_CURRENT", float)
+    if not CELL_CHARGE_LIMITING_VOLTAGE or len(CELL_CHARGE_LIMITING_VOLTAGE) < 2 or len(CELL_CHARGE_LIMITING_VOLTAGE) != len(CELL_CHARGE_LIMITED_CURRENT):
+        if not len(CELL_CHARGE_LIMITING_VOLTAGE) == 0:
+            errors_in_config.append("CELL_CHARGE_LIMITING_VOLTAGE is not set or has less than 2 values. Using default values.")
+        CELL_CHARGE_LIMITING_VOLTAGE = [
+            MIN_CELL_VOLTAGE,
+            MIN_CELL_VOLTAGE + 0.05,
+            BALANCING_VOLTAGE - 0.1,
+            BALANCING_VOLTAGE,
+            MAX_CELL_VOLTAGE,
+        ]
+    if not CELL_CHARGE_LIMITED_CURRENT or len(CELL_CHARGE_LIMITED_CURRENT) < 2 or len(CELL_CHARGE_LIMITING_VOLTAGE) != len(CELL_CHARGE_LIMITED_CURRENT):
+        if not len(CELL_CHARGE_LIMITED_CURRENT) == 0:
+            errors_in_config.append("CELL_CHARGE_LIMITED_CURRENT is not set or has less than 2 values. Using default values.")
+        CELL_CHARGE_LIMITED_CURRENT = [0.2, 1, 1, 0.1, 0]
+
+    CELL_DISCHARGE_LIMITING_VOLTAGE: List[float] = get_list_from_config("DEFAULT", "CELL_DISCHARGE_LIMITING_VOLTAGE", float)
+    CELL_DISCHARGE_LIMITED_CURRENT: List[float] = get_list_from_config("DEFAULT", "CELL_DISCHARGE_LIMITED_CURRENT", float)
+    if (
+        not CELL_DISCHARGE_LIMITING_VOLTAGE
+        or len(CELL_DISCHARGE_LIMITING_VOLTAGE) < 2
+        or len(CELL_DISCHARGE_LIMITING_VOLTAGE) != len(CELL_DISCHARGE_LIMITED_CURRENT)
+    ):
+        if not len(CELL_DISCHARGE_LIMITING_VOLTAGE) == 0:
+            errors_in_config.append("CELL_DISCHARGE_LIMITING_VOLTAGE is not set or has less than 2 values. Using default values.")
+        CELL_DISCHARGE_LIMITING_VOLTAGE = [
+            MIN_CELL_VOLTAGE,
+            MIN_CELL_VOLTAGE + 0.1,
+            MIN_CELL_VOLTAGE + 0.2,
+        ]
+    if (
+        not CELL_DISCHARGE_LIMITED_CURRENT
+        or len(CELL_DISCHARGE_LIMITED_CURRENT) < 2
+        or len(CELL_DISCHARGE_LIMITING_VOLTAGE) != len(CELL_DISCHARGE_LIMITED_CURRENT)
+    ):
+        if not len(CELL_DISCHARGE_LIMITED_CURRENT) == 0:
+            errors_in_config.append("CELL_DISCHARGE_LIMITED_CURRENT is not set or has less than 2 values. Using default values.")
+        CELL_DISCHARGE_LIMITED_CURRENT = [0, 0.05, 1]
+
+    check_curve("CELL_CHARGE_LIMITING_VOLTAGE/CELL_CHARGE_LIMITED_CURRENT", CELL_CHARGE_LIMITING_VOLTAGE, CELL_CHARGE_LIMITED_CURRENT)
+    check_curve("CELL_DISCHARGE_LIMITING_VOLTAGE/CELL_DISCHARGE_LIMITED_CURRENT", CELL_DISCHARGE_LIMITING_VOLTAGE, CELL_DISCHARGE_LIMITED_CURRENT)
+    BATTERY_CHARGE_CURVES: dict = get_curves_from_config("DEFAULT", "BATTERY_CHARGE_CURVES")
+    BATTERY_DISCHARGE_CURVES: dict = get_curves_from_config("DEFAULT", "BATTERY_DISCHARGE_CURVES")
+
+    # --------- if OWN_CHARGE_PARAMETERS = False ---------
+    KEEP_MAX_CVL: bool = get_bool_from_config("DEFAULT", "KEEP_MAX_CVL")
+    SEND_CELL_VOLTAGES: int = get_int_from_config("DEFAULT", "SEND_CELL_VOLTAGES")
+    EXTREMES_TOP_K: int = get_int_from_config("DEFAULT", "EXTREMES_TOP_K")
+    CELL_STATISTICS_INTERVAL: int = get_int_from_config("DEFAULT", "CELL_STATISTICS_INTERVAL")
+    CELL_STATISTICS_TIME_CONSTANT: int = get_int_from_config("DEFAULT", "CELL_STATISTICS_TIME_CONSTANT")
+    CELL_STATISTICS_SAVE_INTERVAL: int = get_int_from_config("DEFAULT", "CELL_STATISTICS_SAVE_INTERVAL")
+    check_config_issue(CELL_STATISTICS_TIME_CONSTANT <= 0, "CELL_STATISTICS_TIME_CONSTANT must be greater than 0")
+    LOG_PERIOD: int = get_int_from_config("DEFAULT", "LOG_PERIOD")
+
+    return {name: value for name, value in locals().items() if not name.startswith("_")}
+
+
+def parse(default_config: str, custom_config: str = "") -> Settings:
+    """
+    Parse the content of the config files once and check the values.
+    Nothing is logged and the module globals are not changed, the errors and warnings are returned with the settings.
+
+    :param default_config: Content of config.default.ini
+    :param custom_config: Content of config.ini, which overrides the default values
+    :return: Settings, without values if the config files can not be parsed
+    """
+    global config, errors_in_config, warnings_in_config
+
+    # the helper functions use the module globals, they are restored afterwards
+    saved = (config, errors_in_config, warnings_in_config)
+    errors_in_config = []
+    warnings_in_config = []
+    values = {}
+    try:
+        # Ensure that option names are treated as case-sensitive
+        default_parser = configparser.ConfigParser()
+        default_parser.optionxform = str
+        default_parser.read_string(default_config, PATH_CONFIG_DEFAULT)
+        custom_parser = configparser.ConfigParser()
+        custom_parser.optionxform = str
+        custom_parser.read_string(custom_config, PATH_CONFIG_USER)
+        check_options(default_parser, custom_parser)
+
+        # the custom values override the default values
+        default_parser.read_dict(custom_parser)
+        config = default_parser
+        values = parse_values()
+        values["LOGGING"] = get_logging_level()
+    except configparser.MissingSectionHeaderError as error_message:
+        errors_in_config.append(f"Make sure the first line of {error_message.source} is exactly (case-sensitive): [DEFAULT]")
+    except (configparser.Error, KeyError) as error_message:
+        errors_in_config.append(f"Error reading the config files: {error_message!r}")
+    finally:
+        errors, warnings = errors_in_config, warnings_in_config
+        config, errors_in_config, warnings_in_config = saved
+    return Settings(values, errors, warnings)
+
+
+def _read(file_path: str) -> str:
+    try:
+        with open(file_path, "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return ""
+
+
+def _cache_key(file_path: str, content: str) -> list:
+    try:
+        mtime = os.stat(file_path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    return [mtime, hashlib.sha1(content.encode()).hexdigest()]
+
+
+def _code_version() -> str:
+    """
+    :return: hash of this module, so a new version of the parsing and checks does not use the cached values
+    """
+    with open(__file__, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load(default_path: str = None, custom_path: str = None, cache_path: str = None) -> Settings:
+    """
+    Load the settings from the config files.
+
+    The values and warnings of config files without errors are cached. If the mtimes and hashes of both files and
+    the version of this module are unchanged, the cached values are used without parsing the files again.
+
+    :param default_path: Path of config.default.ini
+    :param custom_path: Path of config.ini
+    :param cache_path: Path of the cache, None to use the default path
+    :return: Settings
+    """
+    default_path = default_path or default_config_file_path
+    custom_path = custom_path or custom_config_file_path
+    cache_path = cache_path or cache_file_path
+
+    default_config = _read(default_path)
+    custom_config = _read(custom_path)
+    key = [_cache_key(default_path, default_config), _cache_key(custom_path, custom_config), _code_version()]
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+        if cache["key"] == key:
+            return Settings(cache["values"], (), cache["warnings"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    settings = parse(default_config, custom_config)
+    if not settings.errors:
+        # imported here, so loading cached settings does not import the persistence
+        from persistence import write_atomic
+
+        try:
+            write_atomic(cache_path, json.dumps({"key": key, "values": settings.as_dict(), "warnings": settings.warnings}))
+        except OSError:
+            # the settings work without cache, i.e. on a read-only file system
+            pass
+    return settings
+
+
+# the settings of the config files, replaced by reload()
+current = load()
+errors_in_config = list(current.errors)
+warnings_in_config = list(current.warnings)
+
+# used for the error handling in the driver, also if the config files can not be parsed
+LOGGING: int = logging.INFO
+TIME_BEFORE_RESTART: int = 60
+
 # SAVE CONFIG VALUES to constants
+globals().update(current.as_dict())
+
 
-# ----- Needed hardware settings -----
-NR_OF_BATTERIES: int = get_int_from_config("DEFAULT", "NR_OF_BATTERIES")
-if NR_OF_BATTERIES < 2:
-    errors_in_config.append("NR_OF_BATTERIES must be at least 2. Currently set to %d." % NR_OF_BATTERIES)
-
-NR_OF_CELLS_PER_BATTERY: int = get_int_from_config("DEFAULT", "NR_OF_CELLS_PER_BATTERY")
-if NR_OF_CELLS_PER_BATTERY < 2:
-    errors_in_config.append("NR_OF_CELLS_PER_BATTERY must be at least 2. Currently set to %d." % NR_OF_CELLS_PER_BATTERY)
-
-NR_OF_MPPTS: int = get_int_from_config("DEFAULT", "NR_OF_MPPTS")
-
-
-# ----- DBus settings -----
-BATTERY_SERVICE_NAME: str = config["DEFAULT"]["BATTERY_SERVICE_NAME"]
-DCLOAD_SERVICE_NAME: str = config["DEFAULT"]["DCLOAD_SERVICE_NAME"]
-BATTERY_PRODUCT_NAME_PATH: str = config["DEFAULT"]["BATTERY_PRODUCT_NAME_PATH"]
-BATTERY_PRODUCT_NAME: str = config["DEFAULT"]["BATTERY_PRODUCT_NAME"]
-BATTERY_INSTANCE_NAME_PATH: str = config["DEFAULT"]["BATTERY_INSTANCE_NAME_PATH"]
-MULTI_KEYWORD: str = config["DEFAULT"]["MULTI_KEYWORD"]
-MPPT_KEYWORD: str = config["DEFAULT"]["MPPT_KEYWORD"]
-SMARTSHUNT_NAME_KEYWORD: str = config["DEFAULT"]["SMARTSHUNT_NAME_KEYWORD"]
-SMARTSHUNT_INSTANCE_NAME_PATH: str = config["DEFAULT"]["SMARTSHUNT_INSTANCE_NAME_PATH"]
-SEARCH_TRIALS: int = get_int_from_config("DEFAULT", "SEARCH_TRIALS")
-READ_TRIALS: int = get_int_from_config("DEFAULT", "READ_TRIALS")
-UPDATE_INTERVAL_FIND_DEVICES: int = get_int_from_config("DEFAULT", "UPDATE_INTERVAL_FIND_DEVICES")
-UPDATE_INTERVAL_DATA: int = get_int_from_config("DEFAULT", "UPDATE_INTERVAL_DATA")
-TIME_BEFORE_RESTART: int = get_int_from_config("DEFAULT", "TIME_BEFORE_RESTART")
-
-
-# ----- Options -----
-CURRENT_FROM_VICTRON: bool = get_bool_from_config("DEFAULT", "CURRENT_FROM_VICTRON")
-CAN_batteries: bool = get_bool_from_config("DEFAULT", "CAN_batteries")
-USE_SMARTSHUNTS = get_smartshunts_from_config("DEFAULT", "USE_SMARTSHUNTS")
-INVERT_SMARTSHUNTS: bool = get_bool_from_config("DEFAULT", "INVERT_SMARTSHUNTS")
-SMARTSHUNT_AS_BATTERY_CURRENT: bool = get_bool_from_config("DEFAULT", "SMARTSHUNT_AS_BATTERY_CURRENT")
-IGNORE_SMARTSHUNT_ABSENCE: bool = get_bool_from_config("DEFAULT", "IGNORE_SMARTSHUNT_ABSENCE")
-OWN_SOC: bool = get_bool_from_config("DEFAULT", "OWN_SOC")
-ZERO_SOC: bool = get_bool_from_config("DEFAULT", "ZERO_SOC")
-MAX_CELL_VOLTAGE_SOC_FULL: float = get_float_from_config("DEFAULT", "MAX_CELL_VOLTAGE_SOC_FULL")
-MIN_CELL_VOLTAGE_SOC_EMPTY: float = get_float_from_config("DEFAULT", "MIN_CELL_VOLTAGE_SOC_EMPTY")
-CHARGE_SAVE_PRECISION: float = get_float_from_config("DEFAULT", "CHARGE_SAVE_PRECISION")
-
-
-# ----- Charge/Discharge parameters -----
-OWN_CHARGE_PARAMETERS: bool = get_bool_from_config("DEFAULT", "OWN_CHARGE_PARAMETERS")
-BALANCING_VOLTAGE: float = get_float_from_config("DEFAULT", "BALANCING_VOLTAGE")
-BALANCING_REPETITION: int = get_int_from_config("DEFAULT", "BALANCING_REPETITION")
-CHARGE_VOLTAGE_LIST: List[float] = get_list_from_config("DEFAULT", "CHARGE_VOLTAGE_LIST", float)
-MAX_CELL_VOLTAGE: float = get_float_from_config("DEFAULT", "MAX_CELL_VOLTAGE")
-MIN_CELL_VOLTAGE: float = get_float_from_config("DEFAULT", "MIN_CELL_VOLTAGE")
-MIN_CELL_HYSTERESIS: float = get_float_from_config("DEFAULT", "MIN_CELL_HYSTERESIS")
-CELL_DIFF_MAX: float = get_float_from_config("DEFAULT", "CELL_DIFF_MAX")
-BATTERY_EFFICIENCY: float = get_float_from_config("DEFAULT", "BATTERY_EFFICIENCY")
-MAX_CHARGE_CURRENT: int = get_int_from_config("DEFAULT", "MAX_CHARGE_CURRENT")
-MAX_DISCHARGE_CURRENT: int = get_int_from_config("DEFAULT", "MAX_DISCHARGE_CURRENT")
-
-CELL_CHARGE_LIMITING_VOLTAGE: List[float] = get_list_from_config("DEFAULT", "CELL_CHARGE_LIMITING_VOLTAGE", float)
-CELL_CHARGE_LIMITED_CURRENT: List[float] = get_list_from_config("DEFAULT", "CELL_CHARGE_LIMITED_CURRENT", float)
-if not CELL_CHARGE_LIMITING_VOLTAGE or len(CELL_CHARGE_LIMITING_VOLTAGE) < 2 or len(CELL_CHARGE_LIMITING_VOLTAGE) != len(CELL_CHARGE_LIMITED_CURRENT):
-    if not len(CELL_CHARGE_LIMITING_VOLTAGE) == 0:
-        errors_in_config.append("CELL_CHARGE_LIMITING_VOLTAGE is not set or has less than 2 values. Using default values.")
-    CELL_CHARGE_LIMITING_VOLTAGE = [
-        MIN_CELL_VOLTAGE,
-        MIN_CELL_VOLTAGE + 0.05,
-        BALANCING_VOLTAGE - 0.1,
-        BALANCING_VOLTAGE,
-        MAX_CELL_VOLTAGE,
-    ]
-if not CELL_CHARGE_LIMITED_CURRENT or len(CELL_CHARGE_LIMITED_CURRENT) < 2 or len(CELL_CHARGE_LIMITING_VOLTAGE) != len(CELL_CHARGE_LIMITED_CURRENT):
-    if not len(CELL_CHARGE_LIMITED_CURRENT) == 0:
-        errors_in_config.append("CELL_CHARGE_LIMITED_CURRENT is not set or has less than 2 values. Using default values.")
-    CELL_CHARGE_LIMITED_CURRENT = [0.2, 1, 1, 0.1, 0]
-
-CELL_DISCHARGE_LIMITING_VOLTAGE: List[float] = get_list_from_config("DEFAULT", "CELL_DISCHARGE_LIMITING_VOLTAGE", float)
-CELL_DISCHARGE_LIMITED_CURRENT: List[float] = get_list_from_config("DEFAULT", "CELL_DISCHARGE_LIMITED_CURRENT", float)
-if (
-    not CELL_DISCHARGE_LIMITING_VOLTAGE
-    or len(CELL_DISCHARGE_LIMITING_VOLTAGE) < 2
-    or len(CELL_DISCHARGE_LIMITING_VOLTAGE) != len(CELL_DISCHARGE_LIMITED_CURRENT)
-):
-    if not len(CELL_DISCHARGE_LIMITING_VOLTAGE) == 0:
-        errors_in_config.append("CELL_DISCHARGE_LIMITING_VOLTAGE is not set or has less than 2 values. Using default values.")
-    CELL_DISCHARGE_LIMITING_VOLTAGE = [
-        MIN_CELL_VOLTAGE,
-        MIN_CELL_VOLTAGE + 0.1,
-        MIN_CELL_VOLTAGE + 0.2,
-    ]
-if not CELL_DISCHARGE_LIMITED_CURRENT or len(CELL_DISCHARGE_LIMITED_CURRENT) < 2 or len(CELL_DISCHARGE_LIMITING_VOLTAGE) != len(CELL_DISCHARGE_LIMITED_CURRENT):
-    if not len(CELL_DISCHARGE_LIMITED_CURRENT) == 0:
-        errors_in_config.append("CELL_DISCHARGE_LIMITED_CURRENT is not set or has less than 2 values. Using default values.")
-    CELL_DISCHARGE_LIMITED_CURRENT = [0, 0.05, 1]
-
-
-# --------- if OWN_CHARGE_PARAMETERS = False ---------
-KEEP_MAX_CVL: bool = get_bool_from_config("DEFAULT", "KEEP_MAX_CVL")
-SEND_CELL_VOLTAGES: int = get_int_from_config("DEFAULT", "SEND_CELL_VOLTAGES")
-LOG_PERIOD: int = get_int_from_config("DEFAULT", "LOG_PERIOD")
-
-
-# print errors and exit if there are any
-if errors_in_config:
-    logging.error("Errors in config file:")
-
-    for error in errors_in_config:
-        logging.error(f"|- {error}")
-
-    logging.error("")
-    logging.error("Please fix the errors in the config file and restart the program.")
-    sleep(60)
-    sys.exit(1)
+def compile_curves() -> None:
+    """
+    Compile the curves of the charge/discharge current limits from the values of the config files.
+    """
+    global CHARGE_CURVE, DISCHARGE_CURVE, CHARGE_CURVES_PER_BATTERY, DISCHARGE_CURVES_PER_BATTERY
+
+    CHARGE_CURVE = Curve(current.CELL_CHARGE_LIMITING_VOLTAGE, current.CELL_CHARGE_LIMITED_CURRENT)
+    DISCHARGE_CURVE = Curve(current.CELL_DISCHARGE_LIMITING_VOLTAGE, current.CELL_DISCHARGE_LIMITED_CURRENT)
+    # {battery name: Curve}, the batteries without own curve use the curves above
+    CHARGE_CURVES_PER_BATTERY = {name: Curve(X, Y) for name, (X, Y) in current.BATTERY_CHARGE_CURVES.items()}
+    DISCHARGE_CURVES_PER_BATTERY = {name: Curve(X, Y) for name, (X, Y) in current.BATTERY_DISCHARGE_CURVES.items()}
+
+
+if not errors_in_config:
+    compile_curves()
+
+# Options, which are used at the start only, i.e. to find the devices and to create the dbus paths.
+# A reload of the config file does not apply them, a restart is required
+RESTART_REQUIRED = frozenset(
+    (
+        "NR_OF_BATTERIES",
+        "NR_OF_CELLS_PER_BATTERY",
+        "NR_OF_MPPTS",
+        "BATTERY_SERVICE_NAME",
+        "DCLOAD_SERVICE_NAME",
+        "BATTERY_PRODUCT_NAME_PATH",
+        "BATTERY_PRODUCT_NAME",
+        "BATTERY_INSTANCE_NAME_PATH",
+        "MULTI_KEYWORD",
+        "MPPT_KEYWORD",
+        "SMARTSHUNT_NAME_KEYWORD",
+        "SMARTSHUNT_INSTANCE_NAME_PATH",
+        "SHARED_DBUS_CONNECTION",
+        "SEARCH_TRIALS",
+        "UPDATE_INTERVAL_FIND_DEVICES",
+        "UPDATE_INTERVAL_DATA",
+        "CURRENT_FROM_VICTRON",
+        "CAN_batteries",
+        "USE_SMARTSHUNTS",
+        "FAST_PATH_LIMITS",
+        "SEND_CELL_VOLTAGES",
+        "EXTREMES_TOP_K",
+        "CELL_STATISTICS_INTERVAL",
+        "CELL_STATISTICS_TIME_CONSTANT",
+        "RELOAD_ON_CONFIG_CHANGE",
+        "WRITE_BUDGET_PER_DAY",
+    )
+)
+
+
+# time needed to read and check the config files
+LOAD_DURATION: float = monotonic() - _load_start
+
+
+def reload() -> dict:
+    """
+    Read the config files again and apply the changed values, which do not need a restart.
+
+    The values are only applied, if the config files have no errors. Call it from the main loop,
+    so all values change at once between two updates.
+
+    :return: Dictionary with the name of each changed constant as key and (old value, new value),
+        None if the config files have errors
+    """
+    global current, LOGGING
+
+    settings = load()
+    for warning in settings.warnings:
+        logging.warning(warning)
+    if settings.errors:
+        logging.error("Errors in config file, the config is not reloaded:")
+        for error in settings.errors:
+            logging.error(f"|- {error}")
+        return None
+
+    current = settings
+    changed = {name: (globals().get(name), value) for name, value in settings.as_dict().items() if globals().get(name) != value}
+    for name, (old, value) in sorted(changed.items()):
+        if name in RESTART_REQUIRED:
+            logging.warning(f"|- {name} changed to {value!r}, a restart is required to apply it")
+        else:
+            logging.info(f"|- {name}: {old!r} -> {value!r}")
+    globals().update({name: value for name, (old, value) in changed.items() if name not in RESTART_REQUIRED and name != "LOGGING"})
+    compile_curves()
+    if settings.LOGGING != LOGGING:
+        LOGGING = settings.LOGGING
+        logging.getLogger().setLevel(LOGGING)
+    return changed
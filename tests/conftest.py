@@ -0,0 +1,139 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+# the modules of the driver are in the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import settings  # noqa: E402
+
+
+class FakeDbusMon:
+    """
+    Replacement of DbusMon with the values of the batteries in a dictionary {(service, path): value}.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.listeners = {}
+        self.removedListeners = []
+        # {service: device instance} of the services on the dbus
+        self.servicesByName = {}
+        # {service: seconds since the last value}
+        self.ages = {}
+        self.dbusmon = self
+
+    def get_value(self, service, path):
+        return self.values.get((service, path))
+
+    def get_device_instance(self, service):
+        return self.servicesByName.get(service)
+
+    def service_names(self, keyword=""):
+        return sorted(name for name in self.servicesByName if keyword in name)
+
+    def data_age(self, service):
+        return self.ages.get(service, 0) if service in self.servicesByName else None
+
+    def memory_report(self):
+        return {}
+
+    def add_value_listener(self, path, callback):
+        self.listeners.setdefault(path, []).append(callback)
+
+    def add_device_listener(self, added=None, removed=None):
+        if removed is not None:
+            self.removedListeners.append(removed)
+
+    def remove(self, service):
+        """
+        Remove a service from the dbus and call the listeners like the monitor.
+        """
+        device_instance = self.servicesByName.pop(service, None)
+        for key in [key for key in self.values if key[0] == service]:
+            del self.values[key]
+        for callback in self.removedListeners:
+            callback(service, device_instance)
+
+    def change(self, service, path, value):
+        """
+        Change a value and call the listeners like the signal handler of the monitor.
+        """
+        self.values[(service, path)] = value
+        for callback in self.listeners.get(path, []):
+            callback(service, path, value)
+
+
+@pytest.fixture
+def dbusMon():
+    return FakeDbusMon()
+
+
+class FakeVeDbusService(dict):
+    """
+    Replacement of VeDbusService with the published values in the dictionary.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+
+    def add_path(self, path, value, **kwargs):
+        self[path] = value
+
+    def register(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_aggregate = None
+
+
+@pytest.fixture
+def aggregate():
+    """
+    The module dbus-aggregate-batteries.py, skipped without dbus-python and PyGObject.
+    """
+    global _aggregate
+    pytest.importorskip("dbus")
+    pytest.importorskip("gi.repository")
+    if _aggregate is None:
+        spec = importlib.util.spec_from_file_location("dbus_aggregate_batteries", os.path.join(ROOT, "dbus-aggregate-batteries.py"))
+        _aggregate = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_aggregate)
+    return _aggregate
+
+
+@pytest.fixture
+def service(aggregate, dbusMon, tmp_path, monkeypatch):
+    """
+    DbusAggBatService of two batteries with 4 cells, its state files in tmp_path and without dbus.
+    The dbusmonitor is replaced by dbusMon, the VeDbusService by a FakeVeDbusService.
+    """
+    with open(settings.default_config_file_path, "r") as f:
+        parsed = settings.parse(f.read(), "[DEFAULT]\nNR_OF_BATTERIES = 2\nNR_OF_CELLS_PER_BATTERY = 4\nRELOAD_ON_CONFIG_CHANGE = False\n")
+    monkeypatch.setattr(settings, "current", parsed)
+    monkeypatch.setattr(settings, "warnings_in_config", [])
+    for name, value in parsed.as_dict().items():
+        monkeypatch.setattr(settings, name, value, raising=False)
+    for name in ("CHARGE_CURVE", "DISCHARGE_CURVE", "CHARGE_CURVES_PER_BATTERY", "DISCHARGE_CURVES_PER_BATTERY"):
+        monkeypatch.setattr(settings, name, None, raising=False)
+    settings.compile_curves()
+    for name in ("_STATE_FILE_JOURNAL", "_STATE_FILE_DISCOVERY", "_STATE_FILE_SNAPSHOT", "_STATE_FILE_CELL_STATISTICS"):
+        monkeypatch.setattr(aggregate, name, str(tmp_path / name.lower()))
+    monkeypatch.setattr(aggregate, "_LEGACY_STATE_FILES", {key: (str(tmp_path / key),) for key in aggregate._LEGACY_STATE_FILES})
+    monkeypatch.setattr(aggregate, "VeDbusService", FakeVeDbusService)
+    monkeypatch.setattr(aggregate, "get_bus", lambda: None)
+    monkeypatch.setattr(aggregate.DbusAggBatService, "_startMonitor", lambda self: None)
+
+    service = aggregate.DbusAggBatService()
+    service._dbusMon = dbusMon
+    yield service
+    service._persistence.flush()
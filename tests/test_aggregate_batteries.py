@@ -0,0 +1,450 @@
+import json
+import time
+import types
+
+import pytest
+
+import settings
+
+BATTERY1 = "com.victronenergy.battery.ttyUSB0"
+BATTERY2 = "com.victronenergy.battery.ttyUSB1"
+MULTI = "com.victronenergy.vebus.ttyS4"
+
+
+def add_battery(dbusMon, service, serial, device_instance, cells=4):
+    """
+    Put a battery with complete values on the fake dbus.
+    """
+    dbusMon.servicesByName[service] = device_instance
+    values = {
+        "/ProductName": "SerialBattery(JKBMS)",
+        "/Serial": serial,
+        "/CustomName": serial,
+        "/System/NrOfCellsPerBattery": cells,
+        "/Dc/0/Voltage": 13.2,
+        "/Dc/0/Current": 0.0,
+        "/Dc/0/Power": 0.0,
+        "/Voltages/Sum": 13.2,
+        "/InstalledCapacity": 100.0,
+        "/ConsumedAmphours": 0.0,
+        "/Capacity": 50.0,
+        "/Soc": 50.0,
+        "/Dc/0/Temperature": 20.0,
+        "/System/MaxCellTemperature": 21.0,
+        "/System/MinCellTemperature": 19.0,
+        "/System/MaxCellVoltage": 3.31,
+        "/System/MinCellVoltage": 3.29,
+        "/System/NrOfModulesOnline": 1,
+        "/System/NrOfModulesOffline": 0,
+        "/System/NrOfModulesBlockingCharge": 0,
+        "/System/NrOfModulesBlockingDischarge": 0,
+        "/Info/MaxChargeCurrent": 100.0,
+        "/Info/MaxDischargeCurrent": 100.0,
+        "/Info/MaxChargeVoltage": 13.8,
+    }
+    for path, value in values.items():
+        dbusMon.values[(service, path)] = value
+
+
+# recovery without restart
+
+
+def test_discovery_timeout_holds_safe_limits(service):
+    service._requirements = {"batteries": service._find_batteries}
+    service._dbusservice["/Info/MaxChargeCurrent"] = 50.0
+    service._dbusservice["/Info/MaxDischargeCurrent"] = 50.0
+
+    # the timeout is repeated and the search goes on, instead of an exit
+    assert service._discovery_timeout() is True
+    assert service._dbusservice["/Info/MaxChargeCurrent"] == 0
+    assert service._dbusservice["/Info/MaxDischargeCurrent"] == 0
+
+
+def test_find_batteries_skips_wrong_number_of_cells(service, dbusMon):
+    add_battery(dbusMon, BATTERY1, "A", 1)
+    add_battery(dbusMon, BATTERY2, "B", 2, cells=8)
+
+    assert service._find_batteries() is False
+    assert service._batteries_dict == {"A": BATTERY1}
+    assert "number of cells" in service._discoveryError
+
+    # a battery, which did not publish its number of cells yet, is searched again later
+    dbusMon.values[(BATTERY2, "/System/NrOfCellsPerBattery")] = None
+    assert service._find_batteries() is False
+    dbusMon.values[(BATTERY2, "/System/NrOfCellsPerBattery")] = 4
+    assert service._find_batteries() is True
+    assert service._batteries_dict == {"A": BATTERY1, "B": BATTERY2}
+
+
+def test_update_holds_safe_limits_after_read_trials(service, dbusMon):
+    service._batteries_dict = {"A": BATTERY1, "B": BATTERY2}
+    service._dbusservice["/Info/MaxChargeCurrent"] = 50.0
+    service._dbusservice["/Info/MaxDischargeCurrent"] = 50.0
+
+    # no battery on the dbus
+    for trial in range(settings.READ_TRIALS - 1):
+        assert service._update() is True
+    assert service._dbusservice["/Info/MaxChargeCurrent"] == 50.0
+    assert service._update() is True
+    assert service._dbusservice["/Info/MaxChargeCurrent"] == 0
+    assert service._dbusservice["/Info/MaxDischargeCurrent"] == 0
+    assert service._safeHold is not None
+
+
+def test_recovery_timeout_searches_missing_device(aggregate, service, dbusMon):
+    service._running = True
+    service._multi = MULTI
+    service._dbusservice["/Info/MaxChargeCurrent"] = 50.0
+    service._start_recovery(MULTI, "Multi/Quattro", 0)
+    assert service._dbusservice["/Info/MaxChargeCurrent"] == 50.0 * settings.RECOVERY_LIMIT_FACTOR
+
+    # not back yet, the limits are held and the search is repeated
+    assert service._recovery_timeout() is True
+    assert service._dbusservice["/Info/MaxChargeCurrent"] == 0
+
+    # back with another service name, i.e. connected to another port
+    dbusMon.servicesByName["com.victronenergy.vebus.ttyS5"] = 0
+    assert service._recovery_timeout() is False
+    assert service._multi == "com.victronenergy.vebus.ttyS5"
+    assert service._missingDevices == {}
+    assert service._recoveryTimeout is None
+
+
+# degraded mode
+
+
+def test_select_batteries_excludes_missing_and_stale(service, dbusMon):
+    add_battery(dbusMon, BATTERY1, "A", 1)
+    add_battery(dbusMon, BATTERY2, "B", 2)
+    service._batteries_dict = {"A": BATTERY1, "B": BATTERY2}
+    service._batteryCapacity = {"A": 100.0, "B": 300.0}
+    assert service._select_batteries() == {"A": BATTERY1, "B": BATTERY2}
+
+    dbusMon.values[(BATTERY2, "/Dc/0/Current")] = None
+    assert service._select_batteries() == {"A": BATTERY1}
+    assert service._excludedBatteries == {"B": "no value of /Dc/0/Current"}
+    # the limits are scaled to the capacity of the remaining battery
+    assert service._capacity_share({"A": BATTERY1}) == pytest.approx(0.25)
+
+    dbusMon.values[(BATTERY2, "/Dc/0/Current")] = 0.0
+    dbusMon.ages[BATTERY1] = settings.BATTERY_STALE_TIME + 1
+    assert service._select_batteries() == {"B": BATTERY2}
+    assert service._excludedBatteries["A"].startswith("no new values")
+
+    del dbusMon.servicesByName[BATTERY2]
+    assert service._select_batteries() == {}
+    assert service._excludedBatteries["B"] == "disappeared from the dbus"
+
+
+def test_stale_check_disabled(service, dbusMon, monkeypatch):
+    monkeypatch.setattr(settings, "BATTERY_STALE_TIME", 0)
+    add_battery(dbusMon, BATTERY1, "A", 1)
+    service._batteries_dict = {"A": BATTERY1}
+    dbusMon.ages[BATTERY1] = 86400
+    assert service._select_batteries() == {"A": BATTERY1}
+
+
+# discovery cache
+
+
+def save_discovery_cache(service, dbusMon):
+    add_battery(dbusMon, BATTERY1, "A", 1)
+    add_battery(dbusMon, BATTERY2, "B", 2)
+    service._batteries_dict = {"A": BATTERY1, "B": BATTERY2}
+    service._save_discovery_cache()
+    service._persistence.flush()
+    service._batteries_dict = {}
+
+
+def test_discovery_cache_valid(service, dbusMon):
+    save_discovery_cache(service, dbusMon)
+    assert service._use_discovery_cache() is True
+    assert service._batteries_dict == {"A": BATTERY1, "B": BATTERY2}
+    assert service._batteryCapacity == {"A": 100.0, "B": 100.0}
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        # another battery on the port
+        lambda dbusMon, monkeypatch: dbusMon.servicesByName.update({BATTERY2: 7}),
+        lambda dbusMon, monkeypatch: dbusMon.servicesByName.pop(BATTERY2),
+        lambda dbusMon, monkeypatch: dbusMon.values.update({(BATTERY1, "/System/NrOfCellsPerBattery"): None}),
+        lambda dbusMon, monkeypatch: monkeypatch.setattr(settings, "MPPT_KEYWORD", "mppt"),
+    ],
+    ids=["device instance", "battery missing", "number of cells", "settings"],
+)
+def test_discovery_cache_invalid(service, dbusMon, monkeypatch, change):
+    save_discovery_cache(service, dbusMon)
+    change(dbusMon, monkeypatch)
+    assert service._use_discovery_cache() is False
+    assert service._batteries_dict == {}
+
+
+def test_discovery_cache_waits_for_soc(service, dbusMon):
+    save_discovery_cache(service, dbusMon)
+    # the charge is taken from the batteries, which did not publish their SoC yet
+    service._ownCharge = -1
+    dbusMon.values[(BATTERY2, "/Soc")] = None
+    assert service._use_discovery_cache() is False
+
+    dbusMon.values[(BATTERY2, "/Soc")] = 50.0
+    assert service._use_discovery_cache() is True
+    assert service._ownCharge == pytest.approx(100.0)
+
+
+def test_discovery_cache_corrupt(aggregate, service):
+    with open(aggregate._STATE_FILE_DISCOVERY, "w") as f:
+        f.write("{")
+    assert service._use_discovery_cache() is False
+
+
+# snapshot of the published values
+
+
+def write_snapshot(aggregate, age, values):
+    with open(aggregate._STATE_FILE_SNAPSHOT, "w") as f:
+        json.dump({"time": time.time() - age, "values": values}, f)
+
+
+def test_snapshot_published_with_reduced_limits(aggregate, service):
+    service._dbusservice["/Soc"] = 80.0
+    service._dbusservice["/Dc/0/Voltage"] = 53.1
+    service._dbusservice["/Info/MaxChargeCurrent"] = 100.0
+    service._dbusservice["/Info/MaxDischargeCurrent"] = 0
+    service._save_snapshot()
+    service._persistence.flush()
+    for path in aggregate._SNAPSHOT_PATHS:
+        service._dbusservice[path] = None
+
+    service._publish_snapshot()
+    assert service._dbusservice["/Soc"] == 80.0
+    assert service._dbusservice["/Dc/0/Voltage"] == 53.1
+    assert service._dbusservice["/Info/MaxChargeCurrent"] == 100.0 * settings.SNAPSHOT_LIMIT_FACTOR
+    assert service._dbusservice["/Info/MaxDischargeCurrent"] == 0
+
+
+@pytest.mark.parametrize("age", [86400, -60], ids=["too old", "in the future"])
+def test_snapshot_not_published(aggregate, service, age):
+    write_snapshot(aggregate, age, {"/Soc": 80.0})
+    service._publish_snapshot()
+    assert service._dbusservice["/Soc"] is None
+
+
+def test_snapshot_corrupt(aggregate, service):
+    with open(aggregate._STATE_FILE_SNAPSHOT, "w") as f:
+        f.write('{"time": 1}')
+    service._publish_snapshot()
+    assert service._dbusservice["/Soc"] is None
+
+
+# fast path of the current limits
+
+
+def start_fast_path(service, dbusMon):
+    add_battery(dbusMon, BATTERY1, "A", 1)
+    add_battery(dbusMon, BATTERY2, "B", 2)
+    service._batteries_dict = {"A": BATTERY1, "B": BATTERY2}
+    service._running = True
+    service._dbusservice["/Info/MaxChargeCurrent"] = 100.0
+    service._dbusservice["/Info/MaxDischargeCurrent"] = 100.0
+
+
+def test_fast_limits_blocking_charge(service, dbusMon):
+    start_fast_path(service, dbusMon)
+    dbusMon.values[(BATTERY2, "/System/NrOfModulesBlockingCharge")] = 1
+    service._fast_limits(BATTERY2, "/System/NrOfModulesBlockingCharge", 1)
+    assert service._dbusservice["/Info/MaxChargeCurrent"] == 0
+    assert service._dbusservice["/Info/MaxDischargeCurrent"] == 100.0
+    assert service._dbusservice["/Diagnostics/FastPathUpdates"] == 1
+
+
+def test_fast_limits_are_never_raised(service, dbusMon, monkeypatch):
+    monkeypatch.setattr(settings, "OWN_CHARGE_PARAMETERS", True)
+    start_fast_path(service, dbusMon)
+
+    dbusMon.values[(BATTERY1, "/System/MaxCellVoltage")] = 3.40
+    service._fast_limits(BATTERY1, "/System/MaxCellVoltage", 3.40)
+    assert service._dbusservice["/Info/MaxChargeCurrent"] == pytest.approx(settings.MAX_CHARGE_CURRENT * settings.CHARGE_CURVE(3.40))
+
+    # raising the limits is left to the regular update
+    dbusMon.values[(BATTERY1, "/System/MaxCellVoltage")] = 3.31
+    service._fast_limits(BATTERY1, "/System/MaxCellVoltage", 3.31)
+    assert service._dbusservice["/Info/MaxChargeCurrent"] == pytest.approx(settings.MAX_CHARGE_CURRENT * settings.CHARGE_CURVE(3.40))
+
+    dbusMon.values[(BATTERY2, "/System/MinCellVoltage")] = settings.MIN_CELL_VOLTAGE
+    service._fast_limits(BATTERY2, "/System/MinCellVoltage", settings.MIN_CELL_VOLTAGE)
+    assert service._dbusservice["/Info/MaxDischargeCurrent"] == 0
+
+
+def test_fast_limits_ignore_excluded_batteries(service, dbusMon):
+    start_fast_path(service, dbusMon)
+    service._excludedBatteries = {"B": "no new values for 301 s"}
+    dbusMon.values[(BATTERY2, "/System/NrOfModulesBlockingCharge")] = 1
+    service._fast_limits(BATTERY2, "/System/NrOfModulesBlockingCharge", 1)
+    assert service._dbusservice["/Info/MaxChargeCurrent"] == 100.0
+
+    # and do nothing before the aggregation runs
+    service._excludedBatteries = {}
+    service._running = False
+    service._fast_limits(BATTERY2, "/System/NrOfModulesBlockingCharge", 1)
+    assert service._dbusservice["/Info/MaxChargeCurrent"] == 100.0
+
+
+# controller state restored after a restart
+
+CONTROLLER_STATE = {
+    "charge": 123.4,
+    "lastBalancing": 42,
+    "balancing": 1,
+    "dynamicCVL": True,
+    "dynCVLactivated": True,
+    "DCfeedActive": True,
+    "fullyDischarged": False,
+}
+
+
+def test_state_invalid(service):
+    assert service._state_invalid(service._journal_record(CONTROLLER_STATE)) is None
+    assert service._state_invalid(CONTROLLER_STATE) == "no time stamp"
+    old = dict(service._journal_record(CONTROLLER_STATE), time=time.time() - settings.CONTROLLER_STATE_MAX_AGE - 10)
+    assert service._state_invalid(old).startswith("saved")
+    other_day = service._journal_record(CONTROLLER_STATE)
+    other_day["day"] = other_day["day"] % 365 + 1
+    assert service._state_invalid(other_day) == "saved on another day"
+
+
+def test_load_recent_state(service):
+    service._journal.reset(service._journal_record(CONTROLLER_STATE))
+    service._load_state()
+    assert service._ownCharge == pytest.approx(123.4)
+    assert service._lastBalancing == 42
+    assert service._balancing == 1
+    assert service._dynamicCVL is True
+    assert service._restoreFeedIn is None
+
+
+def test_load_old_state(service):
+    old = dict(service._journal_record(CONTROLLER_STATE), time=time.time() - settings.CONTROLLER_STATE_MAX_AGE - 10)
+    service._journal.reset(old)
+    service._load_state()
+    # the charge and the day of the last balancing are always restored, the transient state is not
+    assert service._ownCharge == pytest.approx(123.4)
+    assert service._lastBalancing == 42
+    assert service._balancing == 0
+    assert service._dynamicCVL is False
+    # the PV feed-in disabled by the dynamic CVL reduction is enabled again, when the settings are found
+    assert service._restoreFeedIn is True
+
+
+def test_heartbeat_of_active_state(aggregate, service, monkeypatch):
+    service._balancing = 1
+    service._save_state()
+    service._persistence.flush()
+
+    # restart after a crash, more than CONTROLLER_STATE_MAX_AGE after the start of the balancing
+    later = time.time() + settings.CONTROLLER_STATE_MAX_AGE + 60
+    monkeypatch.setattr(aggregate.tt, "time", lambda: later)
+    service._stateRecorded -= settings.CONTROLLER_STATE_MAX_AGE + 60
+    service._save_state()
+    service._persistence.flush()
+    service._balancing = 0
+    service._load_state()
+    assert service._balancing == 1
+
+
+def test_no_heartbeat_of_idle_state(aggregate, service):
+    service._stateRecorded -= settings.CONTROLLER_STATE_MAX_AGE
+    service._save_state()
+    service._persistence.flush()
+    with open(aggregate._STATE_FILE_JOURNAL, "r") as f:
+        assert len(f.readlines()) == 1
+
+
+def test_load_without_journal(aggregate, service):
+    assert service._ownCharge == 0
+    # the journal is created with the initial state
+    assert aggregate.StateJournal(aggregate._STATE_FILE_JOURNAL, service._persistence).load()["charge"] == 0
+
+
+# reload of the config files
+
+
+class FakeGLib:
+    """
+    Replacement of GLib, which keeps the timeouts until they are run.
+    """
+
+    def __init__(self):
+        self.timeouts = {}
+
+    def timeout_add_seconds(self, seconds, function, *args):
+        source = len(self.timeouts) + 1
+        self.timeouts[source] = function
+        return source
+
+    def run_timeouts(self):
+        timeouts, self.timeouts = self.timeouts, {}
+        for function in timeouts.values():
+            function()
+
+
+class FileMonitorEvent:
+    CHANGED = 0
+    CHANGES_DONE_HINT = 1
+    CREATED = 3
+
+
+class FakeReload:
+    """
+    Replacement of settings.reload(), which returns the queued changes.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.changes = [{"CHARGE_SAVE_PRECISION": (0.0025, 0.005)}]
+
+    def __call__(self):
+        self.calls += 1
+        return self.changes.pop(0)
+
+
+@pytest.fixture
+def reload(aggregate, service, monkeypatch):
+    reload = FakeReload()
+    monkeypatch.setattr(settings, "reload", reload)
+    monkeypatch.setattr(aggregate, "GLib", FakeGLib())
+    monkeypatch.setattr(aggregate, "Gio", types.SimpleNamespace(FileMonitorEvent=FileMonitorEvent))
+    return reload
+
+
+def test_reload_on_sighup(service, reload):
+    reload.changes.append({"NR_OF_BATTERIES": (2, 3)})
+    # the signal handler is kept
+    assert service._sighup() is True
+    assert service._dbusservice["/Diagnostics/ConfigReloads"] == 1
+    assert service._dbusservice["/Diagnostics/RestartRequired"] == 0
+
+    service._sighup()
+    assert service._dbusservice["/Diagnostics/ConfigReloads"] == 2
+    assert service._dbusservice["/Diagnostics/RestartRequired"] == 1
+
+
+def test_reload_on_config_change(aggregate, service, reload):
+    service._config_changed(None, None, None, FileMonitorEvent.CHANGED)
+    assert aggregate.GLib.timeouts == {}
+
+    # the events of one save cause one reload after the editor has finished writing
+    service._config_changed(None, None, None, FileMonitorEvent.CREATED)
+    service._config_changed(None, None, None, FileMonitorEvent.CHANGES_DONE_HINT)
+    assert len(aggregate.GLib.timeouts) == 1
+    assert reload.calls == 0
+    aggregate.GLib.run_timeouts()
+    assert reload.calls == 1
+    assert service._reloadTimeout is None
+
+
+def test_reload_with_errors(service, reload):
+    reload.changes[0] = None
+    service._sighup()
+    assert service._dbusservice["/Diagnostics/ConfigReloads"] == 0
@@ -0,0 +1,63 @@
+from alarms import ALARM_PATHS, AlarmMatrix
+
+LOW_VOLTAGE = "/Alarms/LowVoltage"
+HIGH_TEMPERATURE = "/Alarms/HighTemperature"
+
+
+def make_matrix(dbusMon):
+    for service in ("bat1", "bat2", "bat3"):
+        dbusMon.values[(service, LOW_VOLTAGE)] = 0
+    # bat3 does not publish the temperature alarm
+    dbusMon.values[("bat1", HIGH_TEMPERATURE)] = 0
+    dbusMon.values[("bat2", HIGH_TEMPERATURE)] = 1
+    matrix = AlarmMatrix(dbusMon)
+    matrix.select(["bat1", "bat2", "bat3"])
+    return matrix
+
+
+def test_missing_alarms(dbusMon):
+    matrix = make_matrix(dbusMon)
+    assert len(matrix) == 3
+    assert matrix.missing(LOW_VOLTAGE) == 0
+    assert matrix.missing(HIGH_TEMPERATURE) == 1
+    # an alarm without any value has no level
+    assert matrix.missing("/Alarms/BmsCable") == 3
+    assert matrix.maximum("/Alarms/BmsCable") is None
+
+
+def test_raised_alarms(dbusMon):
+    matrix = make_matrix(dbusMon)
+    assert matrix.maximum(LOW_VOLTAGE) == 0
+    assert matrix.maximum(HIGH_TEMPERATURE) == 1
+    assert matrix.raised_by(HIGH_TEMPERATURE) == {"bat2": 1}
+
+    dbusMon.change("bat1", LOW_VOLTAGE, 2)
+    dbusMon.change("bat3", LOW_VOLTAGE, 1)
+    assert matrix.maximum(LOW_VOLTAGE) == 2
+    assert matrix.raised_by(LOW_VOLTAGE) == {"bat1": 2, "bat3": 1}
+
+    # values above the max. level are limited, a value of None counts as missing
+    dbusMon.change("bat1", LOW_VOLTAGE, 5)
+    dbusMon.change("bat3", LOW_VOLTAGE, None)
+    assert matrix.raised_by(LOW_VOLTAGE) == {"bat1": 2}
+    assert matrix.missing(LOW_VOLTAGE) == 1
+
+    dbusMon.change("bat1", LOW_VOLTAGE, 0)
+    assert matrix.maximum(LOW_VOLTAGE) == 0
+    assert matrix.raised_by(LOW_VOLTAGE) == {}
+
+
+def test_removed_battery(dbusMon):
+    matrix = make_matrix(dbusMon)
+    matrix.select(["bat1", "bat3"])
+    assert "bat2" not in matrix
+    assert matrix.raised_by(HIGH_TEMPERATURE) == {}
+    assert matrix.maximum(HIGH_TEMPERATURE) == 0
+    assert matrix.missing(HIGH_TEMPERATURE) == 1
+
+    # changes of removed batteries are ignored, a battery added again reads all alarms
+    dbusMon.change("bat2", LOW_VOLTAGE, 2)
+    assert matrix.maximum(LOW_VOLTAGE) == 0
+    matrix.select(["bat1", "bat2", "bat3"])
+    assert matrix.raised_by(LOW_VOLTAGE) == {"bat2": 2}
+    assert all(matrix.missing(path) <= 3 for path in ALARM_PATHS)
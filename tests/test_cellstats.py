@@ -0,0 +1,135 @@
+import json
+
+import pytest
+
+import cellstats
+from cellstats import FIELDS, CellStatistics
+
+CELLS = 2
+CELL1 = "/Voltages/Cell1"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cellstats.time, "monotonic", clock)
+    return clock
+
+
+def make_statistics(dbusMon):
+    return CellStatistics(dbusMon, CELLS, time_constant=3600, low=3.0, high=3.5)
+
+
+def feed(dbusMon, clock, samples):
+    """
+    :param samples: [(seconds since the last sample, voltage of cell 1), ...]
+    """
+    for dt, voltage in samples:
+        clock.now += dt
+        dbusMon.change("bat1", CELL1, voltage)
+
+
+def cell_state(statistics, cell=0):
+    return dict(zip(FIELDS, statistics.state()["batteries"]["bat"]["cells"][cell]))
+
+
+SAMPLES = [(10, 3.30), (5, 3.32), (600, 3.28), (1, 3.60), (30, 3.31), (3600, 2.90), (20, 3.30), (7, 3.29)]
+
+
+def test_mean_and_variance_weighted_with_time(dbusMon, clock):
+    dbusMon.values[("bat1", CELL1)] = 3.30
+    statistics = make_statistics(dbusMon)
+    statistics.add("bat", "bat1")
+    feed(dbusMon, clock, SAMPLES[1:])
+
+    # each voltage is held until the next change
+    voltages = [voltage for _, voltage in SAMPLES[:-1]]
+    seconds = [dt for dt, _ in SAMPLES[1:]]
+    total = sum(seconds)
+    mean = sum(v * dt for v, dt in zip(voltages, seconds)) / total
+    variance = sum(dt * (v - mean) ** 2 for v, dt in zip(voltages, seconds)) / total
+
+    state = cell_state(statistics)
+    assert state["seconds"] == pytest.approx(total)
+    assert state["mean"] == pytest.approx(mean)
+    assert state["m2"] / state["seconds"] == pytest.approx(variance)
+    assert state["timeAbove"] == pytest.approx(30)
+    assert state["timeBelow"] == pytest.approx(20)
+
+
+def test_flat_cell_is_not_outweighed_by_changes(dbusMon, clock):
+    dbusMon.values[("bat1", CELL1)] = 3.30
+    statistics = make_statistics(dbusMon)
+    statistics.add("bat", "bat1")
+    # 1 hour flat, then 100 changes within 100 seconds
+    feed(dbusMon, clock, [(3600, 3.40)] + [(1, 3.40 + (i % 2) / 100) for i in range(100)])
+    assert cell_state(statistics)["mean"] == pytest.approx((3.30 * 3600 + 3.405 * 100) / 3700, abs=1e-4)
+
+
+def test_merge_after_restore(dbusMon, clock):
+    """
+    The statistics restored after a restart and continued are the same as without restart.
+    """
+    dbusMon.values[("bat1", CELL1)] = 3.30
+    whole = make_statistics(dbusMon)
+    whole.add("bat", "bat1")
+    first = make_statistics(dbusMon)
+    first.add("bat", "bat1")
+    feed(dbusMon, clock, SAMPLES[1:4])
+
+    # restart: the statistics are saved as JSON and restored in a new instance
+    saved = json.loads(json.dumps(first.state()))
+    first.remove("bat1")
+    second = make_statistics(dbusMon)
+    second.restore(saved)
+    second.add("bat", "bat1")
+    feed(dbusMon, clock, SAMPLES[4:])
+
+    for field in ("seconds", "mean", "m2", "timeAbove", "timeBelow"):
+        assert cell_state(second)[field] == pytest.approx(cell_state(whole)[field])
+
+
+def test_state_round_trip(dbusMon, clock):
+    dbusMon.values[("bat1", CELL1)] = 3.30
+    statistics = make_statistics(dbusMon)
+    statistics.add("bat", "bat1")
+    feed(dbusMon, clock, SAMPLES[1:])
+    statistics.summary()
+    state = json.loads(json.dumps(statistics.state()))
+
+    restored = make_statistics(dbusMon)
+    restored.restore(state)
+    # the statistics are applied, when the battery is added
+    assert restored.state()["batteries"]["bat"] == state["batteries"]["bat"]
+    restored.add("bat", "bat2")
+    assert restored.state()["batteries"]["bat"]["cells"] == state["batteries"]["bat"]["cells"]
+
+
+def test_restore_changed_fields(dbusMon):
+    statistics = make_statistics(dbusMon)
+    with pytest.raises(ValueError):
+        statistics.restore({"fields": ["samples", "mean"], "batteries": {}})
+
+
+def test_summary(dbusMon, clock):
+    dbusMon.values[("bat1", CELL1)] = 3.30
+    dbusMon.values[("bat1", "/Voltages/Cell2")] = 3.40
+    statistics = make_statistics(dbusMon)
+    statistics.add("bat", "bat1")
+    feed(dbusMon, clock, [(100, 3.30), (100, 3.32)])
+
+    summary = statistics.summary(k=1)
+    assert summary["batteries"]["bat"]["spread"] == pytest.approx(0.10, abs=1e-3)
+    drift, name, cell, deviation = summary["cells"][0]
+    assert name == "bat"
+    assert abs(drift) == pytest.approx(0.05, abs=1e-3)
+    # both cells kept their voltage for the whole time
+    assert deviation == 0.0
@@ -0,0 +1,108 @@
+import pytest
+
+from currents import CoulombCounter, CurrentSources
+
+
+def test_coulomb_counter_trapezoid():
+    counter = CoulombCounter()
+    counter.sample(10.0, now=0)
+    counter.sample(20.0, now=1800)
+    counter.sample(20.0, now=3600)
+    assert counter.take() == pytest.approx(7.5 + 10)
+    assert counter.take() == 0
+    assert counter.error == pytest.approx(2.5)
+
+
+def test_coulomb_counter_efficiency_at_zero_crossing():
+    counter = CoulombCounter()
+    counter.sample(10.0, efficiency=0.9, now=0)
+    counter.sample(-10.0, efficiency=0.9, now=3600)
+    # 2.5 Ah charged with the efficiency, 2.5 Ah discharged without
+    assert counter.take() == pytest.approx(2.5 * 0.9 - 2.5)
+
+
+def test_coulomb_counter_reset():
+    counter = CoulombCounter()
+    counter.sample(10.0, now=0)
+    counter.reset()
+    # the time without samples is not counted
+    counter.sample(10.0, now=3600)
+    counter.sample(10.0, now=7200)
+    assert counter.take() == pytest.approx(10)
+
+
+# current source registry
+
+MULTI = "com.victronenergy.vebus.ttyS4"
+MPPT = "com.victronenergy.solarcharger.ttyUSB1"
+SHUNT = "com.victronenergy.battery.ttyUSB2"
+DC_METER = "com.victronenergy.dcload.ttyUSB3"
+
+
+@pytest.fixture
+def sources(dbusMon):
+    dbusMon.values.update(
+        {
+            (MULTI, "/Connected"): 1,
+            (MULTI, "/Dc/0/Current"): -20.0,
+            (MPPT, "/Dc/0/Current"): 15.0,
+            (SHUNT, "/Dc/0/Current"): 3.0,
+            (DC_METER, "/Dc/0/Current"): 1.0,
+        }
+    )
+    dbusMon.servicesByName.update({MULTI: 0, MPPT: 1, SHUNT: 2, DC_METER: 3})
+    sources = CurrentSources(dbusMon)
+    sources.add(MULTI, "Multi/Quattro")
+    sources.add(MPPT, "MPPT")
+    sources.add(SHUNT, "SmartShunt")
+    sources.add(DC_METER, "SmartShunt DC meter")
+    return sources
+
+
+def test_current_sources_totals(sources):
+    assert len(sources) == 4
+    assert sources.total("ve") == pytest.approx(-5.0)
+    # the current of a SmartShunt in DC metering mode flows out of the batteries
+    assert sources.total("shunts") == pytest.approx(2.0)
+    assert sources.connected(MULTI)
+
+
+def test_current_sources_follow_changes(dbusMon, sources):
+    dbusMon.change(MPPT, "/Dc/0/Current", 25.0)
+    assert sources.total("ve") == pytest.approx(5.0)
+    # the current of a switched off MultiPlus/Quattro is not counted
+    dbusMon.change(MULTI, "/Connected", 0)
+    assert sources.total("ve") == pytest.approx(25.0)
+    assert not sources.connected(MULTI)
+    # changes of other services are ignored
+    dbusMon.change("com.victronenergy.solarcharger.ttyUSB9", "/Dc/0/Current", 100.0)
+    assert sources.total("ve") == pytest.approx(25.0)
+
+
+def test_current_sources_remove_and_replace(dbusMon, sources):
+    assert sources.remove(MPPT) == "MPPT"
+    assert MPPT not in sources
+    assert sources.total("ve") == pytest.approx(-20.0)
+
+    # the MPPT reappears with another service name
+    dbusMon.values[("com.victronenergy.solarcharger.ttyUSB5", "/Dc/0/Current")] = 10.0
+    sources.add(MPPT, "MPPT")
+    sources.replace(MPPT, "com.victronenergy.solarcharger.ttyUSB5")
+    assert MPPT not in sources
+    assert sources.total("ve") == pytest.approx(-10.0)
+
+    with pytest.raises(ValueError):
+        sources.add(MPPT, "Inverter")
+
+
+def test_current_sources_faults(dbusMon, sources):
+    assert sources.faults("ve") == []
+    # the current of a disappeared source is invalid
+    dbusMon.remove(MPPT)
+    assert sources.faults("ve") == [(MPPT, "returns None as current")]
+    assert sources.total("ve") == pytest.approx(-20.0)
+    assert sources.faults("shunts") == []
+
+    dbusMon.ages[SHUNT] = 120
+    assert sources.faults("shunts", max_age=60) == [(SHUNT, "no new values for 120 s")]
+    assert sources.faults("shunts") == []
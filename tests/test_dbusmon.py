@@ -0,0 +1,450 @@
+from collections import defaultdict
+
+import pytest
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi.repository")
+
+import dbusmon  # noqa: E402
+
+SETTINGS = "com.victronenergy.settings"
+FEED_IN = "/Settings/CGwacs/OvervoltageFeedIn"
+CUSTOM_NAME = "/Settings/Devices/aggregatebatteries/CustomName"
+
+
+def dbus_error(name):
+    return dbus.exceptions.DBusException("failed", name=name)
+
+
+class FakeConnection:
+    """
+    Replacement of a dbus connection, which keeps the asynchronous calls until they are answered.
+    """
+
+    def __init__(self):
+        # [(service, path, method, reply_handler, error_handler)]
+        self.calls = []
+
+    def call_async(self, service, path, interface, method, signature, args, reply_handler, error_handler):
+        self.calls.append((service, path, method, reply_handler, error_handler))
+
+    def answer(self, path, value=None, error=None, method="GetValue"):
+        (call,) = [call for call in self.calls if call[1] == path and call[2] == method]
+        self.calls.remove(call)
+        if error is None:
+            call[3](value)
+        else:
+            call[4](error)
+
+
+class FakeProgress:
+    def __init__(self):
+        self.completed = []
+
+    def complete(self, service):
+        self.completed.append(service)
+
+
+@pytest.fixture
+def connection():
+    return FakeConnection()
+
+
+@pytest.fixture
+def monitor(connection):
+    # without the constructor, which scans the dbus
+    monitor = dbusmon.CompactDbusMonitor.__new__(dbusmon.CompactDbusMonitor)
+    monitor.dbusConn = connection
+    monitor.dbusTree = {SETTINGS: {FEED_IN: {}, CUSTOM_NAME: {}}}
+    monitor.servicesByName = {}
+    monitor.servicesById = {}
+    monitor.servicesByClass = defaultdict(list)
+    monitor.valueChangedCallback = None
+    monitor.valueListeners = {}
+    monitor._legacyOwners = {}
+    return monitor
+
+
+# legacy scan of services without GetItems
+
+
+def legacy_scan(monitor):
+    results = []
+    dbusmon.AsyncLegacyScan(monitor, SETTINGS, ":1.5", lambda name, success: results.append((name, success))).start()
+    return results
+
+
+def test_legacy_scan(monitor, connection):
+    results = legacy_scan(monitor)
+    # everything is requested at once, the settings have no device instance
+    assert [(call[1], call[2]) for call in connection.calls] == [("/", "GetValue"), ("/", "GetText")]
+    connection.answer("/", {FEED_IN[1:]: 1}, method="GetValue")
+    connection.answer("/", error=dbus_error("org.freedesktop.DBus.Error.UnknownMethod"), method="GetText")
+
+    # the paths missing in the bulk replies are requested one by one
+    assert sorted((call[1], call[2]) for call in connection.calls) == [
+        (FEED_IN, "GetText"),
+        (FEED_IN, "GetValue"),
+        (CUSTOM_NAME, "GetText"),
+        (CUSTOM_NAME, "GetValue"),
+    ]
+    connection.answer(FEED_IN, 1)
+    connection.answer(FEED_IN, "1", method="GetText")
+    connection.answer(CUSTOM_NAME, error=dbus_error("com.victronenergy.BusItem.Error.UnknownPath"))
+    connection.answer(CUSTOM_NAME, error=dbus_error("com.victronenergy.BusItem.Error.UnknownPath"), method="GetText")
+
+    assert results == [(SETTINGS, True)]
+    service = monitor.servicesByName[SETTINGS]
+    assert monitor.servicesById[":1.5"] is service
+    assert monitor.servicesByClass[SETTINGS] == [service]
+    assert (service.paths[FEED_IN].value, service.paths[FEED_IN].text) == (1, "1")
+    assert service.paths[CUSTOM_NAME].value is None
+    assert service.seen(FEED_IN)
+    assert not service.seen(CUSTOM_NAME)
+
+
+def test_legacy_scan_disappeared(monitor, connection):
+    results = legacy_scan(monitor)
+    connection.answer("/", error=dbus_error("org.freedesktop.DBus.Error.ServiceUnknown"), method="GetValue")
+    connection.answer("/", error=dbus_error("org.freedesktop.DBus.Error.ServiceUnknown"), method="GetText")
+    for call in list(connection.calls):
+        connection.answer(call[1], error=dbus_error("org.freedesktop.DBus.Error.ServiceUnknown"), method=call[2])
+
+    assert results == [(SETTINGS, False)]
+    assert SETTINGS not in monitor.servicesByName
+
+
+# targeted scan of services with few paths
+
+
+def scan(monitor, paths):
+    results = []
+    targeted = dbusmon.AsyncTargetedScan(monitor, SETTINGS, paths, lambda items: results.append(("items", items)), lambda exc: results.append(("error", exc)))
+    targeted.start()
+    return results
+
+
+def test_targeted_scan_items(monitor, connection):
+    results = scan(monitor, [FEED_IN, CUSTOM_NAME])
+    # one GetValue per path
+    assert [(call[1], call[2]) for call in connection.calls] == [(FEED_IN, "GetValue"), (CUSTOM_NAME, "GetValue")]
+
+    connection.answer(FEED_IN, 1)
+    assert results == []
+    connection.answer(CUSTOM_NAME, "Bank")
+    assert results == [("items", {FEED_IN: {"Value": 1}, CUSTOM_NAME: {"Value": "Bank"}})]
+
+
+def test_targeted_scan_disappeared(monitor, connection):
+    results = scan(monitor, [FEED_IN, CUSTOM_NAME])
+    connection.answer(FEED_IN, error=dbus_error("org.freedesktop.DBus.Error.NoReply"))
+    connection.answer(CUSTOM_NAME, error=dbus_error("org.freedesktop.DBus.Error.ServiceUnknown"))
+    assert results == [("items", None)]
+
+
+def test_targeted_scan_error(monitor, connection):
+    results = scan(monitor, [FEED_IN, CUSTOM_NAME])
+    error = dbus_error("org.freedesktop.DBus.Error.NoReply")
+    connection.answer(FEED_IN, error=error)
+    connection.answer(CUSTOM_NAME, "Bank")
+    assert results == [("error", error)]
+
+
+def test_targeted_scan_falls_back_to_get_items(monitor, connection):
+    progress = FakeProgress()
+    monitor.get_name_owner_async_done(progress, SETTINGS, ":1.5")
+    connection.answer(FEED_IN, error=dbus_error("org.freedesktop.DBus.Error.NoReply"))
+    connection.answer(CUSTOM_NAME, "Bank")
+
+    # the service is scanned again with GetItems instead of being added without the value
+    assert [(call[0], call[1], call[2]) for call in connection.calls] == [(SETTINGS, "/", "GetItems")]
+    assert progress.completed == []
+    assert SETTINGS not in monitor.servicesByName
+
+
+# ordered write queue
+
+
+class FakeGLib:
+    """
+    Replacement of GLib, which keeps the timeouts until they are run.
+    """
+
+    def __init__(self):
+        # [(ms, function)]
+        self.timeouts = []
+
+    def timeout_add(self, ms, function, *args):
+        self.timeouts.append((ms, function))
+
+    def run_timeouts(self):
+        timeouts, self.timeouts = self.timeouts, []
+        for _, function in timeouts:
+            function()
+
+
+class FakeWriter:
+    """
+    Replacement of the monitor, which keeps the writes until they are answered.
+    """
+
+    def __init__(self):
+        # [(service, path, value, reply_handler, error_handler)]
+        self.writes = []
+
+    def set_value_async(self, serviceName, path, value, reply_handler=None, error_handler=None):
+        self.writes.append((serviceName, path, value, reply_handler, error_handler))
+
+    def reply(self):
+        write = self.writes.pop(0)
+        write[3]()
+        return write[:3]
+
+    def fail(self):
+        write = self.writes.pop(0)
+        write[4](dbus_error("org.freedesktop.DBus.Error.NoReply"))
+        return write[:3]
+
+
+@pytest.fixture
+def glib(monkeypatch):
+    glib = FakeGLib()
+    monkeypatch.setattr(dbusmon, "GLib", glib)
+    return glib
+
+
+@pytest.fixture
+def writer():
+    return FakeWriter()
+
+
+def test_write_queue_order_and_coalescing(writer):
+    queue = dbusmon.WriteQueue(writer)
+    queue.write(SETTINGS, FEED_IN, 0)
+    queue.write(SETTINGS, CUSTOM_NAME, "Bank")
+    queue.write(SETTINGS, FEED_IN, 1)
+    # the second write to the feed-in is queued behind the first one, which is in flight
+    assert queue.pending == 3
+    queue.write(SETTINGS, CUSTOM_NAME, "Bank 2")
+    assert queue.coalesced == 1
+    # only one write in flight at a time
+    assert len(writer.writes) == 1
+
+    assert writer.reply() == (SETTINGS, FEED_IN, 0)
+    assert writer.reply() == (SETTINGS, CUSTOM_NAME, "Bank 2")
+    assert writer.reply() == (SETTINGS, FEED_IN, 1)
+    assert queue.pending == 0
+    assert queue.completed == 3
+
+
+def test_write_queue_retry_backoff(writer, glib):
+    results = []
+    queue = dbusmon.WriteQueue(writer, retries=2, retry_delay_ms=100)
+    queue.write(SETTINGS, FEED_IN, 1, results.append)
+
+    writer.fail()
+    assert [ms for ms, _ in glib.timeouts] == [100]
+    glib.run_timeouts()
+    writer.fail()
+    # the delay is doubled after every attempt
+    assert [ms for ms, _ in glib.timeouts] == [200]
+    glib.run_timeouts()
+    writer.fail()
+
+    assert glib.timeouts == []
+    assert results == [False]
+    assert queue.failed == 1
+    assert queue.pending == 0
+
+
+def test_write_queue_retry_succeeds(writer, glib):
+    results = []
+    queue = dbusmon.WriteQueue(writer)
+    queue.write(SETTINGS, FEED_IN, 1, results.append)
+    writer.fail()
+    glib.run_timeouts()
+    assert writer.reply() == (SETTINGS, FEED_IN, 1)
+    assert results == [True]
+
+
+def test_write_queue_drops_failed_write_for_newer_value(writer, glib):
+    results = []
+    queue = dbusmon.WriteQueue(writer)
+    queue.write(SETTINGS, FEED_IN, 0, lambda success: results.append(("old", success)))
+    queue.write(SETTINGS, FEED_IN, 1)
+
+    # the failed old value is not retried, the newer value is written instead
+    assert writer.fail() == (SETTINGS, FEED_IN, 0)
+    assert glib.timeouts == []
+    assert results == []
+    # the callback of the old value is handed over to the newer value, which did not have one
+    assert writer.reply() == (SETTINGS, FEED_IN, 1)
+    assert results == [("old", True)]
+    assert queue.failed == 0
+
+
+def test_write_queue_newer_callback_replaces_queued_one(writer):
+    results = []
+    queue = dbusmon.WriteQueue(writer)
+    queue.write(SETTINGS, CUSTOM_NAME, "Bank")
+    queue.write(SETTINGS, FEED_IN, 0, lambda success: results.append(("first", success)))
+    queue.write(SETTINGS, FEED_IN, 1, lambda success: results.append(("second", success)))
+
+    writer.reply()
+    assert writer.reply() == (SETTINGS, FEED_IN, 1)
+    assert results == [("second", True)]
+
+
+# shared connection
+
+
+class FakeMatch:
+    def __init__(self, bus, handler, rule):
+        self.bus = bus
+        self.handler = handler
+        self.rule = rule
+
+    def remove(self):
+        self.bus.matches.remove(self)
+
+    def __str__(self):
+        return self.rule
+
+
+class FakeBus:
+    def __init__(self):
+        self.matches = []
+
+    def add_signal_receiver(self, handler, signal_name=None, **keywords):
+        rule = "type='signal',member='%s'" % signal_name
+        match = FakeMatch(self, handler, rule)
+        self.matches.append(match)
+        return match
+
+    def get_unique_name(self):
+        return ":1.7"
+
+    def emit(self, *args):
+        for match in list(self.matches):
+            match.handler(*args)
+
+
+def test_signal_router_shares_match_rules():
+    bus = FakeBus()
+    router = dbusmon.SignalRouter(bus)
+    received = []
+    first = router.add_signal_receiver(lambda value: received.append(("first", value)), signal_name="ItemsChanged", path="/")
+    second = router.add_signal_receiver(lambda value: received.append(("second", value)), signal_name="ItemsChanged", path="/")
+    router.add_signal_receiver(lambda value: received.append(("other", value)), signal_name="PropertiesChanged")
+
+    # the same match arguments share one match rule on the connection
+    assert len(bus.matches) == 2
+    assert str(first) == "type='signal',member='ItemsChanged'"
+    assert sorted(dbusmon._connection_match_rules(router)) == [("type='signal',member='ItemsChanged'", 2), ("type='signal',member='PropertiesChanged'", 1)]
+    bus.matches[0].handler(1)
+    assert received == [("first", 1), ("second", 1)]
+
+    first.remove()
+    bus.matches[0].handler(2)
+    assert received[2:] == [("second", 2)]
+    # the match rule is removed with its last receiver
+    second.remove()
+    assert [str(match) for match in bus.matches] == ["type='signal',member='PropertiesChanged'"]
+
+
+def test_signal_router_passes_through_the_connection():
+    bus = FakeBus()
+    router = dbusmon.SignalRouter(bus)
+    assert router.get_unique_name() == ":1.7"
+    # the rules of a plain connection are not known
+    assert dbusmon._connection_match_rules(bus) is None
+
+
+# compact storage of the monitored values
+
+
+def test_monitored_values_share_the_options(monitor):
+    options = {"code": None, "whenToLog": "configChange", "accessLevel": None}
+    service = dbusmon.CompactService(":1.5", SETTINGS, 0)
+    feed_in = monitor.make_monitor(service, FEED_IN, 1, "1", options)
+    name = monitor.make_monitor(service, CUSTOM_NAME, "Bank", "Bank", options)
+    other = monitor.make_monitor(service, CUSTOM_NAME, "Bank", "Bank", dict(options))
+
+    assert type(feed_in) is type(name)
+    assert type(other) is not type(feed_in)
+    assert feed_in.options is options
+    assert not hasattr(feed_in, "__dict__")
+    # like the tuple of the velib MonitoredValue
+    value, text, item_options = name
+    assert (value, text, item_options) == ("Bank", "Bank", options)
+
+
+def test_compact_service(monitor):
+    service = dbusmon.CompactService(":1.5", SETTINGS, 0)
+    service.paths[FEED_IN] = monitor.make_monitor(service, FEED_IN, None, None, {})
+    service.set_seen(FEED_IN)
+    assert service.seen(FEED_IN)
+    assert not service.seen(CUSTOM_NAME)
+    assert service["deviceInstance"] == 0
+    assert service.service_class == SETTINGS
+    assert not hasattr(service, "__dict__")
+
+    mon = dbusmon.DbusMon.__new__(dbusmon.DbusMon)
+    mon.dbusmon = monitor
+    monitor.servicesByName[SETTINGS] = service
+    assert mon.memory_report()[SETTINGS] > 0
+
+
+# value listeners
+
+
+@pytest.fixture
+def mon(monitor):
+    # DbusMon without the constructor, which starts the monitor
+    mon = dbusmon.DbusMon.__new__(dbusmon.DbusMon)
+    mon.dbusmon = monitor
+    mon.scan_complete = False
+    mon._deviceAddedListeners = []
+    mon._deviceRemovedListeners = []
+    service = dbusmon.CompactService(":1.5", SETTINGS, 0)
+    for path in (FEED_IN, CUSTOM_NAME):
+        service.paths[path] = monitor.make_monitor(service, path, None, None, {})
+    monitor.servicesByName[SETTINGS] = service
+    monitor.servicesById[":1.5"] = service
+    return mon
+
+
+def test_value_listener(mon):
+    changes = []
+    mon.add_value_listener(CUSTOM_NAME, lambda *change: changes.append(change))
+    assert not mon.has_path(SETTINGS, CUSTOM_NAME)
+
+    mon.dbusmon.handler_item_changes({CUSTOM_NAME: {"Value": "Bank", "Text": "Bank"}, FEED_IN: {"Value": 1, "Text": "1"}}, ":1.5")
+    assert changes == [(SETTINGS, CUSTOM_NAME, "Bank")]
+    assert mon.has_path(SETTINGS, CUSTOM_NAME)
+    assert mon.dbusmon.get_value(SETTINGS, FEED_IN) == 1
+
+    # only changes are reported
+    mon.dbusmon.handler_item_changes({CUSTOM_NAME: {"Value": "Bank", "Text": "Bank"}}, ":1.5")
+    assert len(changes) == 1
+    # services, which are not scanned yet, are ignored
+    mon.dbusmon.handler_item_changes({CUSTOM_NAME: {"Value": "Other", "Text": "Other"}}, ":1.9")
+    assert len(changes) == 1
+
+
+# device listeners
+
+
+def test_device_listeners(mon):
+    added, removed = [], []
+    mon.add_device_listener(added=lambda *device: added.append(device), removed=lambda *device: removed.append(device))
+
+    # the devices of the initial scan are not reported
+    mon._device_added(dbus.String(SETTINGS), 0)
+    assert added == []
+
+    mon.scan_complete = True
+    mon._device_added(dbus.String("com.victronenergy.battery.ttyUSB0"), 1)
+    mon._device_removed(dbus.String("com.victronenergy.battery.ttyUSB0"), 1)
+    assert added == removed == [("com.victronenergy.battery.ttyUSB0", 1)]
+    assert type(added[0][0]) is str
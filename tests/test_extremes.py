@@ -0,0 +1,58 @@
+import random
+
+from extremes import CELL_PATHS, ExtremesIndex, IndexedHeap
+
+
+def test_indexed_heap_against_sorted_reference():
+    rng = random.Random(42)
+    low = IndexedHeap(1)
+    high = IndexedHeap(-1)
+    reference = {}
+    for _ in range(5000):
+        key = rng.randrange(50)
+        if rng.random() < 0.25:
+            low.discard(key)
+            high.discard(key)
+            reference.pop(key, None)
+        else:
+            # few distinct values, so equal values are ordered by key
+            value = rng.randrange(20) / 10
+            low.set(key, value)
+            high.set(key, value)
+            reference[key] = value
+
+        k = rng.randrange(1, 8)
+        assert len(low) == len(high) == len(reference)
+        assert all(key in low for key in reference)
+        assert low.top(k) == sorted((value, key) for key, value in reference.items())[:k]
+        assert high.top(k) == sorted(((value, key) for key, value in reference.items()), key=lambda entry: (-entry[0], entry[1]))[:k]
+
+
+def test_indexed_heap_empty():
+    heap = IndexedHeap()
+    assert heap.top(3) == []
+    heap.discard("missing")
+    assert len(heap) == 0
+
+
+def test_extremes_index(dbusMon):
+    for cell, voltage in enumerate([3.30, 3.35, 3.20], 1):
+        dbusMon.values[("bat1", "/Voltages/Cell%d" % cell)] = voltage
+    for cell, voltage in enumerate([3.40, 3.25], 1):
+        dbusMon.values[("bat2", "/Voltages/Cell%d" % cell)] = voltage
+
+    index = ExtremesIndex(dbusMon, CELL_PATHS)
+    index.select(["bat1", "bat2"])
+    assert len(index) == 5
+    assert index.lowest(2) == [(3.20, "bat1", "/Voltages/Cell3"), (3.25, "bat2", "/Voltages/Cell2")]
+    assert index.highest(1) == [(3.40, "bat2", "/Voltages/Cell1")]
+
+    dbusMon.change("bat2", "/Voltages/Cell1", 3.10)
+    assert index.minimum() == 3.10
+    assert index.maximum() == 3.35
+
+    # the values of removed batteries and changes of other batteries are left out
+    index.select(["bat1"])
+    dbusMon.change("bat3", "/Voltages/Cell1", 1.0)
+    assert index.lowest(5) == [(3.20, "bat1", "/Voltages/Cell3"), (3.30, "bat1", "/Voltages/Cell1"), (3.35, "bat1", "/Voltages/Cell2")]
+    assert index.spread() == 3.35 - 3.20
@@ -0,0 +1,51 @@
+import pytest
+
+from functions import Curve
+
+VOLTAGES = [2.90, 2.95, 3.30, 3.40, 3.45]
+FACTORS = [0.2, 1, 1, 0.1, 0]
+
+
+def test_curve_points_and_interpolation():
+    curve = Curve(VOLTAGES, FACTORS)
+    for x, y in zip(VOLTAGES, FACTORS):
+        assert curve(x) == pytest.approx(y)
+    assert curve(2.925) == pytest.approx(0.6)
+    assert curve(3.35) == pytest.approx(0.55)
+
+
+def test_curve_out_of_range():
+    curve = Curve(VOLTAGES, FACTORS)
+    assert curve(0) == 0.2
+    assert curve(2.89) == 0.2
+    assert curve(3.46) == 0
+    assert curve(10) == 0
+
+
+def test_curve_step():
+    # a vertical step at 3.0 V: the first y up to the step, the second y above it
+    curve = Curve([2.5, 3.0, 3.0, 3.5], [0, 0, 1, 1])
+    assert curve(2.9) == 0
+    assert curve(3.0) == 0
+    assert curve(3.0001) == 1
+    assert curve(3.5) == 1
+
+
+def test_curve_many():
+    curve = Curve(VOLTAGES, FACTORS)
+    values = [0, 2.925, None, 3.3, 3.35, 4.0]
+    assert curve.many(values) == [None if x is None else curve(x) for x in values]
+    assert curve.many([]) == []
+
+
+@pytest.mark.parametrize(
+    "X, Y",
+    [
+        ([2.9, 3.0], [1]),
+        ([2.9], [1]),
+        ([3.0, 2.9], [1, 0]),
+    ],
+)
+def test_curve_invalid(X, Y):
+    with pytest.raises(ValueError):
+        Curve(X, Y)
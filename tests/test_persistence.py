@@ -0,0 +1,159 @@
+import os
+import time
+
+import pytest
+
+from persistence import BLOCK_SIZE, PersistenceScheduler, StateJournal, append_durable, write_atomic
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = PersistenceScheduler()
+    yield scheduler
+    scheduler.flush()
+
+
+def read_lines(path):
+    with open(path, "r") as f:
+        return f.readlines()
+
+
+def test_write_atomic_and_append(tmp_path):
+    path = str(tmp_path / "state")
+    write_atomic(path, "a\n")
+    append_durable(path, "b\n")
+    assert read_lines(path) == ["a\n", "b\n"]
+    write_atomic(path, "c\n")
+    assert read_lines(path) == ["c\n"]
+    assert os.listdir(str(tmp_path)) == ["state"]
+
+
+def wait_for_writes(scheduler, writes, timeout=5):
+    deadline = time.monotonic() + timeout
+    while scheduler.writes < writes and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return scheduler.writes
+
+
+def test_exhausted_budget(tmp_path):
+    first, delayed, critical = (str(tmp_path / name) for name in ("first", "delayed", "critical"))
+    # one block a day
+    scheduler = PersistenceScheduler(bytes_per_day=BLOCK_SIZE)
+    scheduler.schedule(first, "1\n")
+    assert wait_for_writes(scheduler, 1) == 1
+
+    scheduler.schedule(delayed, "2\n")
+    scheduler.schedule(critical, "3\n", critical=True)
+    assert wait_for_writes(scheduler, 2) == 2
+    time.sleep(0.1)
+    # the budget is exhausted for a day, only the critical file was written
+    assert os.path.isfile(critical)
+    assert not os.path.exists(delayed)
+    assert scheduler.pending == 1
+
+    # on exit the delayed file is written regardless of the budget
+    assert scheduler.flush()
+    assert read_lines(delayed) == ["2\n"]
+
+
+def test_write_order(tmp_path):
+    journal, snapshot, critical = (str(tmp_path / name) for name in ("journal", "snapshot", "critical"))
+    scheduler = PersistenceScheduler(bytes_per_day=4 * BLOCK_SIZE)
+    # hold the lock, so the worker does not write anything meanwhile
+    with scheduler._condition:
+        scheduler.schedule(snapshot, "s\n", share=0.5)
+        scheduler.schedule(journal, "j\n", append=True)
+        scheduler.schedule(critical, "c\n", critical=True)
+
+        assert scheduler._next()[0][0] == critical
+        del scheduler._pending[critical]
+        # the journal is served before the snapshot
+        assert scheduler._next()[0][0] == journal
+        del scheduler._pending[journal]
+        assert scheduler._next()[0][0] == snapshot
+        assert scheduler._allowance == pytest.approx(2 * BLOCK_SIZE, abs=1)
+
+        # the snapshot may only use the allowance above the half of the budget, which is left for the journal
+        item, wait = scheduler._next()
+        assert item is None
+        assert wait == pytest.approx(86400 / 4, abs=1)
+        scheduler.schedule(journal, "j\n", append=True)
+        assert scheduler._next()[0][0] == journal
+    scheduler.flush()
+
+
+def test_journal_replay(tmp_path, scheduler):
+    path = str(tmp_path / "journal")
+    journal = StateJournal(path, scheduler)
+    assert journal.load() is None
+    for charge in range(3):
+        journal.record({"charge": charge})
+        scheduler.flush()
+
+    assert len(read_lines(path)) == 3
+    assert StateJournal(path, scheduler).load() == {"charge": 2}
+
+
+def test_journal_torn_record(tmp_path, scheduler):
+    path = str(tmp_path / "journal")
+    journal = StateJournal(path, scheduler)
+    journal.reset({"charge": 1})
+    # power loss while appending the next record
+    append_durable(path, StateJournal._encode({"charge": 2})[:10])
+
+    journal = StateJournal(path, scheduler)
+    assert journal.load() == {"charge": 1}
+    # the journal is compacted, so the next record is not appended to the torn one
+    assert read_lines(path) == [StateJournal._encode({"charge": 1})]
+    journal.record({"charge": 3})
+    scheduler.flush()
+    assert StateJournal(path, scheduler).load() == {"charge": 3}
+
+
+def test_journal_crc_mismatch(tmp_path, scheduler):
+    path = str(tmp_path / "journal")
+    journal = StateJournal(path, scheduler)
+    journal.reset({"charge": 1})
+    append_durable(path, StateJournal._encode({"charge": 2}).replace('"charge":2', '"charge":9'))
+    append_durable(path, "no checksum\n")
+
+    assert StateJournal(path, scheduler).load() == {"charge": 1}
+
+
+def test_journal_without_valid_record(tmp_path, scheduler):
+    path = str(tmp_path / "journal")
+    write_atomic(path, "00000000 {}\n")
+    journal = StateJournal(path, scheduler)
+    assert journal.load() is None
+    # the garbage is removed, so the next record is not appended to it
+    assert read_lines(path) == []
+    journal.record({"charge": 1})
+    scheduler.flush()
+    assert read_lines(path) == [StateJournal._encode({"charge": 1})]
+
+
+def test_journal_counts_written_records(tmp_path):
+    path = str(tmp_path / "journal")
+    # the budget allows only one write a day, the other records are replaced while pending
+    scheduler = PersistenceScheduler(bytes_per_day=1)
+    journal = StateJournal(path, scheduler, compact_records=3)
+    journal.load()
+    for charge in range(5):
+        journal.record({"charge": charge})
+    scheduler.flush()
+
+    assert journal._records == len(read_lines(path)) < 5
+    assert StateJournal(path, scheduler).load() == {"charge": 4}
+
+
+def test_journal_compaction(tmp_path, scheduler):
+    path = str(tmp_path / "journal")
+    journal = StateJournal(path, scheduler, compact_records=3)
+    journal.load()
+    for charge in range(5):
+        journal.record({"charge": charge})
+        scheduler.flush()
+
+    # the 4th record replaced the journal, the 5th was appended to it
+    assert read_lines(path) == [StateJournal._encode({"charge": 3}), StateJournal._encode({"charge": 4})]
+    assert StateJournal(path, scheduler).load() == {"charge": 4}
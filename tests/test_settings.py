@@ -0,0 +1,165 @@
+import json
+import os
+
+import pytest
+
+import settings
+
+with open(settings.default_config_file_path, "r") as f:
+    DEFAULT_CONFIG = f.read()
+
+VALID_CONFIG = "[DEFAULT]\nNR_OF_BATTERIES = 3\nNR_OF_CELLS_PER_BATTERY = 16\n"
+
+
+def test_parse_valid():
+    parsed = settings.parse(DEFAULT_CONFIG, VALID_CONFIG)
+    assert parsed.errors == ()
+    assert parsed.NR_OF_BATTERIES == 3
+    assert parsed.NR_OF_CELLS_PER_BATTERY == 16
+    # lists are stored as tuples, so the settings can not be changed
+    assert isinstance(parsed.CELL_CHARGE_LIMITING_VOLTAGE, tuple)
+
+
+def test_parse_invalid_value():
+    parsed = settings.parse(DEFAULT_CONFIG, "[DEFAULT]\nNR_OF_BATTERIES = 1\nNR_OF_CELLS_PER_BATTERY = x\n")
+    assert "NR_OF_BATTERIES must be at least 2. Currently set to 1." in parsed.errors
+    assert "Invalid value 'x' for option 'NR_OF_CELLS_PER_BATTERY' in group 'DEFAULT'." in parsed.errors
+
+
+def test_parse_unknown_option():
+    parsed = settings.parse(DEFAULT_CONFIG, VALID_CONFIG + "NO_SUCH_OPTION = 1\n")
+    assert parsed.errors == ('Option "NO_SUCH_OPTION" in config.ini is not valid.',)
+
+
+def test_parse_missing_section():
+    parsed = settings.parse(DEFAULT_CONFIG, "NR_OF_BATTERIES = 3\n")
+    assert parsed.errors == ("Make sure the first line of config.ini is exactly (case-sensitive): [DEFAULT]",)
+    assert parsed.as_dict() == {}
+
+
+def test_parse_keeps_module_globals():
+    config = settings.config
+    errors = list(settings.errors_in_config)
+    warnings = list(settings.warnings_in_config)
+    nr_of_batteries = settings.NR_OF_BATTERIES
+
+    settings.parse(DEFAULT_CONFIG, VALID_CONFIG)
+    settings.parse(DEFAULT_CONFIG, "[DEFAULT]\nNR_OF_BATTERIES = 1\n")
+
+    assert settings.config is config
+    assert settings.errors_in_config == errors
+    assert settings.warnings_in_config == warnings
+    assert settings.NR_OF_BATTERIES == nr_of_batteries
+
+
+def test_settings_are_immutable():
+    parsed = settings.Settings({"NR_OF_BATTERIES": 2})
+    with pytest.raises(AttributeError):
+        parsed.NR_OF_BATTERIES = 3
+    assert parsed.NR_OF_BATTERIES == 2
+
+
+def test_load_uses_cache(tmp_path):
+    default_path = str(tmp_path / "config.default.ini")
+    custom_path = str(tmp_path / "config.ini")
+    cache_path = str(tmp_path / "config.cache")
+    with open(default_path, "w") as f:
+        f.write(DEFAULT_CONFIG)
+    with open(custom_path, "w") as f:
+        f.write(VALID_CONFIG)
+
+    assert settings.load(default_path, custom_path, cache_path).NR_OF_BATTERIES == 3
+    assert os.path.exists(cache_path)
+
+    # the cached values are used as long as the files are unchanged
+    with open(cache_path, "r") as f:
+        cache = json.load(f)
+    cache["values"]["NR_OF_BATTERIES"] = 4
+    with open(cache_path, "w") as f:
+        json.dump(cache, f)
+    assert settings.load(default_path, custom_path, cache_path).NR_OF_BATTERIES == 4
+
+    # a changed config file is parsed again
+    with open(custom_path, "w") as f:
+        f.write(VALID_CONFIG.replace("NR_OF_BATTERIES = 3", "NR_OF_BATTERIES = 5"))
+    assert settings.load(default_path, custom_path, cache_path).NR_OF_BATTERIES == 5
+
+
+def test_load_without_cache_on_errors(tmp_path):
+    default_path = str(tmp_path / "config.default.ini")
+    cache_path = str(tmp_path / "config.cache")
+    with open(default_path, "w") as f:
+        f.write(DEFAULT_CONFIG)
+
+    loaded = settings.load(default_path, str(tmp_path / "config.ini"), cache_path)
+    assert loaded.errors
+    assert not os.path.exists(cache_path)
+
+
+def test_load_keeps_warnings_in_cache(tmp_path):
+    default_path = str(tmp_path / "config.default.ini")
+    custom_path = str(tmp_path / "config.ini")
+    cache_path = str(tmp_path / "config.cache")
+    with open(default_path, "w") as f:
+        f.write(DEFAULT_CONFIG)
+    with open(custom_path, "w") as f:
+        f.write(VALID_CONFIG + "LOGGING = LOUD\n")
+
+    parsed = settings.load(default_path, custom_path, cache_path)
+    assert parsed.errors == ()
+    assert len(parsed.warnings) == 1
+    # the warnings are logged on every start, also if the cached values are used
+    assert settings.load(default_path, custom_path, cache_path).warnings == parsed.warnings
+
+
+@pytest.fixture
+def config_files(tmp_path, monkeypatch):
+    """
+    Let reload() read the config files in tmp_path and restore the module globals it changes.
+    """
+    with open(str(tmp_path / "config.default.ini"), "w") as f:
+        f.write(DEFAULT_CONFIG)
+    monkeypatch.setattr(settings, "default_config_file_path", str(tmp_path / "config.default.ini"))
+    monkeypatch.setattr(settings, "custom_config_file_path", str(tmp_path / "config.ini"))
+    monkeypatch.setattr(settings, "cache_file_path", str(tmp_path / "config.cache"))
+    for name in list(settings.current.as_dict()) + ["current", "CHARGE_CURVE", "DISCHARGE_CURVE", "CHARGE_CURVES_PER_BATTERY", "DISCHARGE_CURVES_PER_BATTERY"]:
+        if hasattr(settings, name):
+            monkeypatch.setattr(settings, name, getattr(settings, name))
+    level = settings.logging.getLogger().level
+    yield str(tmp_path / "config.ini")
+    settings.logging.getLogger().setLevel(level)
+
+
+def write_config(path, config):
+    with open(path, "w") as f:
+        f.write(config)
+
+
+def test_reload(config_files):
+    write_config(config_files, VALID_CONFIG + "CHARGE_SAVE_PRECISION = 0.0025\n")
+    settings.reload()
+    assert settings.CHARGE_SAVE_PRECISION == 0.0025
+    nr_of_batteries = settings.NR_OF_BATTERIES
+    curve = settings.CHARGE_CURVE
+
+    write_config(config_files, VALID_CONFIG.replace("NR_OF_BATTERIES = 3", "NR_OF_BATTERIES = 4") + "CHARGE_SAVE_PRECISION = 0.005\n")
+    changed = settings.reload()
+    assert changed["CHARGE_SAVE_PRECISION"] == (0.0025, 0.005)
+    assert settings.CHARGE_SAVE_PRECISION == 0.005
+    # a value, which needs a restart, is reported but not applied
+    assert changed["NR_OF_BATTERIES"] == (nr_of_batteries, 4)
+    assert settings.NR_OF_BATTERIES == nr_of_batteries
+    assert settings.current.NR_OF_BATTERIES == 4
+    # the curves are compiled again
+    assert settings.CHARGE_CURVE is not curve
+
+
+def test_reload_with_errors(config_files):
+    write_config(config_files, VALID_CONFIG)
+    settings.reload()
+    current = settings.current
+
+    write_config(config_files, VALID_CONFIG + "CHARGE_SAVE_PRECISION = x\n")
+    assert settings.reload() is None
+    assert settings.current is current
+    assert settings.CHARGE_SAVE_PRECISION == current.CHARGE_SAVE_PRECISION